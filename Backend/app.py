@@ -1,93 +1,243 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, has_request_context, make_response, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import sqlite3
 import os
 import json
+import hashlib
 from datetime import datetime, timedelta
 import subprocess
 import tempfile
 import logging
+import signal
+import sys
+import random
+import threading
+import time
+import uuid
 import jwt
 import bcrypt
 from functools import wraps
+from batch import BatchError, BatchRunner, group_by_model, parse_batch, summarize
+from cancellation import CancelRegistry, Cancelled, run_process
+from circuit_breaker import merge_snapshots
 from llama_integration import LLMClient
+import logging_setup
+from maintenance import Maintenance
+from database import connect, init_db
+from endpoint_pool import merge_stats
+from http_cache import compress_response, not_modified, with_etag
+from persistence import MessageWriter
+from profiler import RequestProfiler, list_profiles
+from rate_limit import RateLimiter, create_store
+from routing import CascadeRouter
+from semantic_cache import SemanticCache
+from shared_state import MetricsPublisher, SharedState, sum_counters
+from singleflight import SingleFlight
+from storage import Storage
+from transfer import ImportFormatError, export_records, gzip_ndjson, import_records, read_ndjson
+from usage import GROUPINGS, RequestUsage, UsageRollup, query_usage
 import config
 
+# Configurar logging (cola + hilo escritor: las peticiones no esperan a la escritura del log)
+logging_setup.setup_logging(
+    level=config.LOG_LEVEL,
+    log_file=config.LOG_FILE,
+    json_format=config.LOG_FORMAT == 'json',
+    max_bytes=config.LOG_MAX_BYTES,
+    backup_count=config.LOG_BACKUP_COUNT,
+    rotate_seconds=config.LOG_ROTATE_SECONDS,
+    debug_sample_rate=config.LOG_DEBUG_SAMPLE_RATE,
+    queue_size=config.LOG_QUEUE_SIZE
+)
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['Retry-After', 'X-RateLimit-Limit', 'X-RateLimit-Remaining', 'X-RateLimit-Reset', 'X-Request-Id', 'ETag'])
 
 # Inicializar cliente LLM (vLLM)
 llm_client = LLMClient()
 
+# Enrutado en cascada (modelo pequeño para turnos simples)
+cascade_router = CascadeRouter(
+    llm_client,
+    config.SMALL_MODEL,
+    enabled=config.CASCADE_ENABLED,
+    max_chars=config.CASCADE_MAX_CHARS,
+    max_history=config.CASCADE_MAX_HISTORY
+)
+
+# Caché semántica de respuestas (opcional)
+semantic_cache = SemanticCache(
+    llm_client.embed,
+    threshold=config.SEMANTIC_CACHE_THRESHOLD,
+    max_entries=config.SEMANTIC_CACHE_MAX_ENTRIES,
+    path=config.SEMANTIC_CACHE_PATH
+) if config.SEMANTIC_CACHE_ENABLED else None
+
 # Configuración
 DB_PATH = config.DB_PATH
-LOG_FILE = config.LOG_FILE
+
+# Conversaciones y mensajes: en DB_PATH o en un fragmento por usuario (STORAGE_MODE)
+storage = Storage(
+    DB_PATH,
+    mode=config.STORAGE_MODE,
+    shard_dir=config.SHARD_DIR,
+    cache_size=config.SHARD_CACHE_SIZE
+)
+
+# Escritor de mensajes con commits agrupados
+message_writer = MessageWriter(
+    DB_PATH,
+    flush_interval_ms=config.WRITE_BATCH_INTERVAL_MS,
+    max_batch_rows=config.WRITE_BATCH_MAX_ROWS,
+    resolve=storage.path_for,
+    writers=config.WRITE_THREADS,
+    max_open=config.WRITER_MAX_OPEN
+)
+
+# Lotes de prompts de evaluación (/api/batch)
+batch_runner = BatchRunner(llm_client, max_concurrency=config.BATCH_MAX_CONCURRENCY)
+
+# Métricas compartidas entre workers (cada proceso publica las suyas)
+shared_state = SharedState(config.SHARED_STATE_PATH)
+
+# Peticiones en curso que se pueden cancelar (desconexión del cliente o /api/chat/<id>/cancel)
+cancel_registry = CancelRegistry(shared_state, poll_interval=config.CANCEL_POLL_INTERVAL)
+cancel_registry.start()
+
+# Peticiones de chat idénticas en curso comparten una sola generación
+single_flight = SingleFlight(shared_state, result_ttl=config.SINGLEFLIGHT_RESULT_TTL)
+
+metrics_publisher = MetricsPublisher(shared_state, {
+    'endpoints': llm_client.endpoint_stats,
+    'breakers': llm_client.breaker_stats,
+    'routing': cascade_router.snapshot,
+    'writer': lambda: dict(message_writer.stats),
+    'cancellation': cancel_registry.snapshot,
+    'singleflight': single_flight.snapshot,
+    'batch': batch_runner.snapshot,
+    'logging': logging_setup.stats,
+    **({'semantic_cache': semantic_cache.snapshot} if semantic_cache else {})
+}, interval=config.METRICS_PUBLISH_INTERVAL)
+metrics_publisher.start()
+
+# Límites por usuario (peticiones/minuto, tokens/hora y ejecuciones simultáneas)
+rate_limiter = RateLimiter(
+    create_store(config.RATE_LIMIT_BACKEND, config.RATE_LIMIT_DB),
+    requests_per_minute=config.RATE_LIMIT_REQUESTS_PER_MINUTE,
+    tokens_per_hour=config.RATE_LIMIT_TOKENS_PER_HOUR,
+    max_concurrent=config.RATE_LIMIT_CONCURRENT
+)
+
+def charge_user_tokens(model, usage):
+    """Descuenta del usuario de la petición en curso los tokens generados"""
+    if has_request_context() and g.get('rate_limit_user') is not None:
+        rate_limiter.charge_tokens(g.rate_limit_user, usage.get('eval_tokens', 0))
+
+llm_client.usage_listeners.append(charge_user_tokens)
+
+def record_request_usage(model, usage):
+    """Acumula el uso de las llamadas al modelo de la petición de chat en curso"""
+    if has_request_context() and g.get('request_usage') is not None:
+        g.request_usage.add(model, usage)
+
+llm_client.usage_listeners.append(record_request_usage)
+
+# Agregación periódica del uso por hora, usuario y modelo
+usage_rollup = UsageRollup(DB_PATH, interval=config.USAGE_ROLLUP_INTERVAL, storage=storage)
+usage_rollup.start()
+
+# Retención (archivado de conversaciones inactivas) y mantenimiento de SQLite
+maintenance = Maintenance(
+    DB_PATH,
+    config.ARCHIVE_DIR,
+    retention_days=config.ARCHIVE_AFTER_DAYS,
+    interval=config.MAINTENANCE_INTERVAL,
+    batch=config.MAINTENANCE_BATCH,
+    vacuum_pages=config.MAINTENANCE_VACUUM_PAGES,
+    pause_ms=config.MAINTENANCE_PAUSE_MS,
+    shared_state=shared_state,
+    is_busy=lambda: message_writer.pending() > 0,
+    storage=storage
+)
+maintenance.start()
 JWT_SECRET = os.getenv('JWT_SECRET', 'tu-secret-key-cambiar-en-produccion')
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
-# Configurar logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
-
 logger = logging.getLogger(__name__)
+access_logger = logging.getLogger('access')
 
-def init_db():
-    """Inicializa la base de datos SQLite"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Tabla de usuarios
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            language TEXT DEFAULT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Migración: agregar columna language si no existe
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN language TEXT DEFAULT NULL')
-    except sqlite3.OperationalError:
-        pass  # La columna ya existe
-    
-    # Tabla de conversaciones (ahora con user_id)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            title TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    ''')
-    
-    # Tabla de mensajes
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id INTEGER,
-            role TEXT,
-            content TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations(id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    logger.info("Base de datos inicializada")
+# Rutas de sondeo: se registran en DEBUG (muestreado) para no llenar el log
+QUIET_PATHS = ('/api/health', '/api/ready')
+
+@app.before_request
+def bind_request_log_context():
+    """Contexto de logging de la petición (request_id, método y ruta)"""
+    g.request_start = time.monotonic()
+    request_id = str(request.headers.get('X-Request-Id') or uuid.uuid4().hex)[:64]
+    g.log_context = logging_setup.bind_context(request_id=request_id, method=request.method, path=request.path)
+
+@app.after_request
+def log_request(response):
+    """Línea de acceso con estado, duración y uso del modelo"""
+    context = logging_setup.get_context()
+    fields = {'status': response.status_code}
+    if 'request_start' in g:
+        fields['duration_ms'] = round((time.monotonic() - g.request_start) * 1000, 1)
+    if g.get('request_usage') is not None:
+        usage = g.request_usage.as_row()
+        fields.update({key: usage[key] for key in ('model', 'prompt_tokens', 'eval_tokens', 'eval_ms')})
+    g.response_status = response.status_code
+    level = logging.DEBUG if request.path in QUIET_PATHS else logging.INFO
+    access_logger.log(level, f"{request.method} {request.path} {response.status_code}", extra=fields)
+    if context.get('request_id'):
+        response.headers['X-Request-Id'] = context['request_id']
+    return response
+
+@app.after_request
+def compress(response):
+    """gzip/brotli para respuestas grandes (historiales con salida de comandos)"""
+    if not config.COMPRESS_MIN_BYTES:
+        return response
+    return compress_response(
+        response,
+        min_bytes=config.COMPRESS_MIN_BYTES,
+        gzip_level=config.COMPRESS_LEVEL,
+        brotli_quality=config.BROTLI_QUALITY
+    )
+
+@app.teardown_request
+def clear_request_log_context(exc):
+    logging_setup.clear_context(g.pop('log_context', None))
+
+@app.before_request
+def start_request_profiler():
+    """
+    Perfila la petición si lo pide un administrador (cabecera X-Profile: 1) o
+    si sale en el muestreo de PROFILE_SAMPLE_RATE. Sin ninguno de los dos no
+    se crea nada.
+    """
+    requested = request.headers.get('X-Profile') == '1'
+    if not requested and not (config.PROFILE_SAMPLE_RATE and random.random() < config.PROFILE_SAMPLE_RATE):
+        return
+    if requested:
+        user = get_user_from_token()
+        if not user or user['username'] not in config.ADMIN_USERS:
+            return
+    g.profiler = RequestProfiler(
+        config.PROFILE_DIR,
+        logging_setup.get_context().get('request_id') or uuid.uuid4().hex,
+        method=request.method,
+        path=request.path,
+        interval_ms=config.PROFILE_INTERVAL_MS,
+        keep=config.PROFILE_KEEP
+    ).start()
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop(g.get('response_status', 500 if exc else None))
 
 def generate_token(user_id, username):
     """Genera un token JWT para el usuario"""
@@ -134,13 +284,255 @@ def require_auth(f):
         user = get_user_from_token()
         if not user:
             return jsonify({'error': 'No autorizado. Token requerido.'}), 401
+        logging_setup.bind_context(user_id=user['user_id'])
         return f(*args, **kwargs)
     return decorated_function
 
+def rate_limited(f):
+    """Decorador que aplica los límites por usuario (usar después de require_auth)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not config.RATE_LIMIT_ENABLED:
+            return f(*args, **kwargs)
+        user = get_user_from_token()
+        decision = rate_limiter.check(user['user_id'])
+        if not decision.allowed:
+            logger.warning(f"Límite alcanzado para {user['username']}: {decision.reason}")
+            response = jsonify({
+                'error': f"{decision.reason}. Inténtalo de nuevo en {decision.retry_after} s",
+                'retry_after': decision.retry_after
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = str(decision.retry_after)
+            response.headers.update(decision.headers)
+            return response
+        g.rate_limit_user = user['user_id']
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            rate_limiter.release(user['user_id'], decision)
+            raise
+        if response.is_streamed:
+            # Respuestas en streaming (/api/batch): el trabajo se hace mientras se
+            # envían, así que la petición ocupa su hueco hasta que terminan
+            response.call_on_close(lambda: rate_limiter.release(user['user_id'], decision))
+        else:
+            rate_limiter.release(user['user_id'], decision)
+        response.headers.update(decision.headers)
+        return response
+    return decorated_function
+
+def register_cancel_token(user_id):
+    """
+    Registra la petición en curso para poder cancelarla
+    
+    El id lo elige el cliente (campo request_id o cabecera X-Request-Id) para
+    poder cancelarla antes de recibir la respuesta; si no lo envía se usa el
+    request_id del log. Solo tiene que ser único entre las peticiones en curso
+    del mismo usuario.
+    """
+    request_id = (request.get_json(silent=True) or {}).get('request_id')
+    if request_id:
+        logging_setup.bind_context(request_id=str(request_id)[:64])
+    request_id = logging_setup.get_context().get('request_id')
+    # Socket del cliente (gunicorn o servidor de desarrollo) para detectar la desconexión
+    sock = request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+    return cancel_registry.register(request_id, user_id, sock)
+
+def worker_metrics(scope, live):
+    """Métricas publicadas por todos los workers, con las de este proceso al día"""
+    try:
+        snapshots = shared_state.collect(scope)
+    except sqlite3.Error as e:
+        logger.warning(f"No se pudieron leer las métricas compartidas: {str(e)}")
+        snapshots = {}
+    snapshots[os.getpid()] = live()
+    return list(snapshots.values())
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Endpoint de salud para verificar que el backend está funcionando"""
-    return jsonify({'status': 'ok', 'service': 'chat-backend'})
+    """
+    Endpoint de salud para verificar que el backend está funcionando
+    
+    La inferencia se informa según el último sondeo en segundo plano y los
+    circuit breakers (sin peticiones a Ollama): 'degraded' si algún backend
+    no responde o hay circuitos abiertos. El backend sigue vivo (200).
+    """
+    inference = llm_client.health()
+    degraded = inference['open_circuits'] > 0 or not all(b['healthy'] for b in inference['backends'].values())
+    return jsonify({
+        'status': 'degraded' if degraded else 'ok',
+        'service': 'chat-backend',
+        'inference': inference
+    })
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Indica si el backend está listo: BD inicializada, inferencia alcanzable y modelos cargados"""
+    try:
+        conn = connect(DB_PATH)
+        cursor = conn.cursor()
+        # Con fragmentos, conversations y messages están en cada fragmento
+        tables = ('users', 'shard_map') if storage.sharded else ('users', 'conversations', 'messages')
+        cursor.execute(
+            f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' for _ in tables)})",
+            tables
+        )
+        db_ready = cursor.fetchone()[0] == len(tables)
+        conn.close()
+    except sqlite3.Error:
+        db_ready = False
+    
+    checks = {'database': db_ready}
+    checks.update(llm_client.readiness(config.WARMUP_MODELS))
+    ready = (
+        db_ready
+        and checks['inference_reachable']
+        and all(checks['models_available'].values())
+        and all(checks['models_resident'].values())
+    )
+    return jsonify({'ready': ready, 'checks': checks}), 200 if ready else 503
+
+@app.route('/api/inference/endpoints', methods=['GET'])
+@require_auth
+def inference_endpoints():
+    """Estado, latencia y errores de cada endpoint de inferencia (todos los workers)"""
+    return jsonify(merge_stats(worker_metrics('endpoints', llm_client.endpoint_stats)))
+
+@app.route('/api/inference/breakers', methods=['GET'])
+@require_auth
+def inference_breakers():
+    """Estado de los circuit breakers por endpoint y modelo y sus transiciones (todos los workers)"""
+    return jsonify(merge_snapshots(worker_metrics('breakers', llm_client.breaker_stats)))
+
+@app.route('/api/inference/routing', methods=['GET'])
+@require_auth
+def inference_routing():
+    """Decisiones y latencia por nivel del enrutado en cascada (todos los workers)"""
+    return jsonify(cascade_router.report(sum_counters(worker_metrics('routing', cascade_router.snapshot))))
+
+@app.route('/api/cache/semantic', methods=['GET'])
+@require_auth
+def semantic_cache_report():
+    """Aciertos, entradas y latencia de la caché semántica (todos los workers)"""
+    if not semantic_cache:
+        return jsonify({'enabled': False})
+    report = semantic_cache.report(sum_counters(worker_metrics('semantic_cache', semantic_cache.snapshot)))
+    report['enabled'] = True
+    return jsonify(report)
+
+@app.route('/api/metrics', methods=['GET'])
+@require_auth
+def metrics():
+    """Resumen de métricas agregadas de todos los workers"""
+    writer = worker_metrics('writer', lambda: dict(message_writer.stats))
+    return jsonify({
+        'workers': len(writer),
+        'writer': sum_counters(writer),
+        'routing': cascade_router.report(sum_counters(worker_metrics('routing', cascade_router.snapshot))),
+        'cancellation': sum_counters(worker_metrics('cancellation', cancel_registry.snapshot)),
+        'singleflight': sum_counters(worker_metrics('singleflight', single_flight.snapshot)),
+        'batch': sum_counters(worker_metrics('batch', batch_runner.snapshot)),
+        'logging': sum_counters(worker_metrics('logging', logging_setup.stats)),
+        'breakers': merge_snapshots(worker_metrics('breakers', llm_client.breaker_stats))
+    })
+
+@app.route('/api/usage', methods=['GET'])
+@require_auth
+def usage_report():
+    """
+    Uso agregado: peticiones, errores (generaciones fallidas), tokens y latencias
+    
+    Parámetros: from / to (YYYY-MM-DD o YYYY-MM-DD HH), group_by (hour, day,
+    model, user; separados por comas) y all=1 para ver todos los usuarios
+    (solo usuarios de ADMIN_USERS).
+    """
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    group_by = request.args.get('group_by', 'day,model').split(',')
+    unknown = [g for g in group_by if g not in GROUPINGS]
+    if unknown:
+        return jsonify({'error': f"group_by no válido: {', '.join(unknown)}"}), 400
+    
+    bounds = {}
+    for param in ('from', 'to'):
+        value = request.args.get(param)
+        if not value:
+            continue
+        try:
+            parsed = datetime.strptime(value, '%Y-%m-%d %H' if ' ' in value else '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': f'{param} debe ser YYYY-MM-DD o YYYY-MM-DD HH'}), 400
+        if param == 'to':
+            # Límite incluido: hasta el final de ese día u hora
+            parsed += timedelta(hours=1) if ' ' in value else timedelta(days=1)
+        bounds[param] = parsed.strftime('%Y-%m-%d %H:00:00')
+    
+    show_all = request.args.get('all') == '1'
+    if show_all and user['username'] not in config.ADMIN_USERS:
+        return jsonify({'error': 'Solo administradores'}), 403
+    if 'user' in group_by and not show_all:
+        group_by.remove('user')
+    
+    try:
+        # Las respuestas posteriores a la última agregación se leen sin escribir
+        # (la agregación la hace el hilo de usage_rollup)
+        report = query_usage(
+            DB_PATH,
+            user_id=None if show_all else user['user_id'],
+            start=bounds.get('from'),
+            end=bounds.get('to'),
+            group_by=group_by,
+            rollup=usage_rollup
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Error consultando el uso: {str(e)}")
+        return jsonify({'error': 'Error consultando el uso'}), 500
+    return jsonify(report)
+
+@app.route('/api/maintenance', methods=['GET', 'POST'])
+@require_auth
+def maintenance_report():
+    """
+    Estado del mantenimiento de la base de datos (solo ADMIN_USERS)
+    
+    POST ejecuta una ronda ahora (archivado, incremental_vacuum, ANALYZE y checkpoint).
+    """
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    if user['username'] not in config.ADMIN_USERS:
+        return jsonify({'error': 'Solo administradores'}), 403
+    
+    if request.method == 'POST':
+        try:
+            maintenance.run_once()
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Error en el mantenimiento: {str(e)}")
+            return jsonify({'error': f'Error en el mantenimiento: {str(e)}'}), 500
+    return jsonify(maintenance.snapshot())
+
+@app.route('/api/profiles', methods=['GET'])
+@require_auth
+def get_profiles():
+    """Perfiles de peticiones más recientes (solo ADMIN_USERS)"""
+    user = get_user_from_token()
+    if user['username'] not in config.ADMIN_USERS:
+        return jsonify({'error': 'Solo administradores'}), 403
+    return jsonify(list_profiles(config.PROFILE_DIR, limit=request.args.get('limit', 50, type=int)))
+
+@app.route('/api/profiles/<name>', methods=['GET'])
+@require_auth
+def download_profile(name):
+    """Descarga un perfil (<nombre>.speedscope.json o <nombre>.collapsed.txt)"""
+    user = get_user_from_token()
+    if user['username'] not in config.ADMIN_USERS:
+        return jsonify({'error': 'Solo administradores'}), 403
+    if not name.endswith(('.speedscope.json', '.collapsed.txt')):
+        return jsonify({'error': 'Perfil no encontrado'}), 404
+    return send_from_directory(os.path.abspath(config.PROFILE_DIR), name, as_attachment=True)
 
 @app.route('/api/auth/register', methods=['POST'])
 def register():
@@ -156,7 +548,7 @@ def register():
     if len(password) < 6:
         return jsonify({'error': 'La contraseña debe tener al menos 6 caracteres'}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
     
     # Verificar si el usuario o email ya existen
@@ -204,7 +596,7 @@ def login():
     if not email or not password:
         return jsonify({'error': 'Email y contraseña son requeridos'}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
     
     # Buscar usuario por email
@@ -225,7 +617,7 @@ def login():
     token = generate_token(user_id, username)
     
     # Obtener idioma del usuario
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('SELECT language FROM users WHERE id = ?', (user_id,))
     language_result = cursor.fetchone()
@@ -253,9 +645,9 @@ def get_current_user():
     if not user:
         return jsonify({'error': 'No autorizado'}), 401
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute('SELECT id, username, email, language FROM users WHERE id = ?', (user['user_id'],))
+    cursor.execute('SELECT id, username, email, language, retention_days FROM users WHERE id = ?', (user['user_id'],))
     user_data = cursor.fetchone()
     conn.close()
     
@@ -267,7 +659,8 @@ def get_current_user():
         'username': user_data[1],
         'email': user_data[2],
         'language': user_data[3] if len(user_data) > 3 else None,
-        'needs_language': user_data[3] is None if len(user_data) > 3 else True
+        'needs_language': user_data[3] is None if len(user_data) > 3 else True,
+        'retention_days': user_data[4]
     })
 
 @app.route('/api/auth/language', methods=['POST'])
@@ -284,7 +677,7 @@ def set_language():
     if language not in ['es', 'en']:
         return jsonify({'error': 'Idioma inválido. Use "es" o "en"'}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('UPDATE users SET language = ? WHERE id = ?', (language, user['user_id']))
     conn.commit()
@@ -296,6 +689,35 @@ def set_language():
         'language': language
     })
 
+@app.route('/api/auth/retention', methods=['POST'])
+@require_auth
+def set_retention():
+    """
+    Establece los días sin actividad tras los que se archivan las conversaciones
+    del usuario (0 = nunca, null = valor por defecto del servidor)
+    """
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    data = request.json or {}
+    days = data.get('days')
+    if days is not None and (not isinstance(days, int) or isinstance(days, bool) or days < 0):
+        return jsonify({'error': 'days debe ser un entero >= 0 o null'}), 400
+    
+    conn = connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET retention_days = ? WHERE id = ?', (days, user['user_id']))
+    conn.commit()
+    conn.close()
+    
+    logger.info(f"Retención establecida para usuario {user['username']}: {days}")
+    return jsonify({
+        'success': True,
+        'retention_days': days,
+        'effective_days': config.ARCHIVE_AFTER_DAYS if days is None else days
+    })
+
 @app.route('/api/conversations', methods=['GET'])
 @require_auth
 def get_conversations():
@@ -304,10 +726,21 @@ def get_conversations():
     if not user:
         return jsonify({'error': 'No autorizado'}), 401
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = storage.connect(user['user_id'])
     cursor = conn.cursor()
+    # Lectura consistente: versión y lista en la misma transacción
+    cursor.execute('BEGIN')
+    cursor.execute('SELECT version FROM conversation_versions WHERE user_id = ?', (user['user_id'],))
+    row = cursor.fetchone()
+    etag = f"u{user['user_id']}-v{row[0] if row else 0}"
+    cached = not_modified(etag)
+    if cached is not None:
+        conn.close()
+        return cached
+    
+    # El resumen (número de mensajes, último mensaje) lo mantienen los triggers de messages
     cursor.execute('''
-        SELECT id, title, created_at, updated_at 
+        SELECT id, title, created_at, updated_at, message_count, last_message_id, last_preview
         FROM conversations 
         WHERE user_id = ?
         ORDER BY updated_at DESC
@@ -318,10 +751,13 @@ def get_conversations():
             'id': row[0],
             'title': row[1],
             'created_at': row[2],
-            'updated_at': row[3]
+            'updated_at': row[3],
+            'message_count': row[4],
+            'last_message_id': row[5],
+            'last_preview': row[6]
         })
     conn.close()
-    return jsonify(conversations)
+    return with_etag(jsonify(conversations), etag)
 
 @app.route('/api/conversations', methods=['POST'])
 @require_auth
@@ -333,7 +769,7 @@ def create_conversation():
     
     data = request.json
     title = data.get('title', 'Nueva conversación')
-    conn = sqlite3.connect(DB_PATH)
+    conn = storage.connect(user['user_id'])
     cursor = conn.cursor()
     cursor.execute('INSERT INTO conversations (user_id, title) VALUES (?, ?)', (user['user_id'], title))
     conversation_id = cursor.lastrowid
@@ -350,43 +786,102 @@ def delete_conversation(conversation_id):
     if not user:
         return jsonify({'error': 'No autorizado'}), 401
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = storage.connect(user['user_id'])
     cursor = conn.cursor()
-    # Verificar que la conversación pertenece al usuario
-    cursor.execute('SELECT id FROM conversations WHERE id = ? AND user_id = ?', (conversation_id, user['user_id']))
-    if not cursor.fetchone():
-        conn.close()
-        return jsonify({'error': 'Conversación no encontrada'}), 404
-    
-    cursor.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
-    cursor.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+    # Solo conversaciones del usuario; los mensajes se borran en cascada
+    cursor.execute('DELETE FROM conversations WHERE id = ? AND user_id = ?', (conversation_id, user['user_id']))
+    deleted = cursor.rowcount
     conn.commit()
     conn.close()
+    if not deleted:
+        return jsonify({'error': 'Conversación no encontrada'}), 404
     logger.info(f"Conversación eliminada: {conversation_id} por usuario {user['username']}")
     return jsonify({'success': True})
 
+@app.route('/api/archive', methods=['GET'])
+@require_auth
+def get_archived_conversations():
+    """Conversaciones archivadas del usuario actual (por inactividad)"""
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    return jsonify(maintenance.list_archived(user['user_id']))
+
+@app.route('/api/archive/<int:archive_id>/restore', methods=['POST'])
+@require_auth
+def restore_archived_conversation(archive_id):
+    """Devuelve una conversación archivada a la lista de conversaciones"""
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    try:
+        restored = maintenance.restore(archive_id, user['user_id'])
+    except (OSError, sqlite3.Error, ImportFormatError) as e:
+        logger.error(f"Error restaurando el archivo {archive_id}: {str(e)}")
+        return jsonify({'error': 'No se pudo restaurar la conversación'}), 500
+    if restored is None:
+        return jsonify({'error': 'Conversación archivada no encontrada'}), 404
+    logger.info(f"Conversación {restored['conversation_id']} restaurada por usuario {user['username']}")
+    return jsonify(restored)
+
 @app.route('/api/conversations/<int:conversation_id>/messages', methods=['GET'])
 @require_auth
 def get_messages(conversation_id):
-    """Obtiene los mensajes de una conversación del usuario actual"""
+    """
+    Obtiene los mensajes de una conversación del usuario actual
+    
+    Query params opcionales:
+        limit: Devuelve solo los últimos N mensajes
+        before: Solo mensajes con id menor (para cargar páginas anteriores)
+    """
     user = get_user_from_token()
     if not user:
         return jsonify({'error': 'No autorizado'}), 401
     
-    conn = sqlite3.connect(DB_PATH)
+    limit = request.args.get('limit', type=int)
+    before = request.args.get('before', type=int)
+    
+    conn = storage.connect(user['user_id'])
     cursor = conn.cursor()
+    # Lectura consistente: resumen y mensajes en la misma transacción
+    cursor.execute('BEGIN')
     # Verificar que la conversación pertenece al usuario
-    cursor.execute('SELECT id FROM conversations WHERE id = ? AND user_id = ?', (conversation_id, user['user_id']))
-    if not cursor.fetchone():
+    cursor.execute(
+        'SELECT last_message_id, message_count FROM conversations WHERE id = ? AND user_id = ?',
+        (conversation_id, user['user_id'])
+    )
+    summary = cursor.fetchone()
+    if not summary:
         conn.close()
         return jsonify({'error': 'Conversación no encontrada'}), 404
     
-    cursor.execute('''
-        SELECT id, role, content, created_at 
-        FROM messages 
-        WHERE conversation_id = ? 
-        ORDER BY created_at ASC
-    ''', (conversation_id,))
+    # Los mensajes no se editan: el último id y el número de mensajes identifican el contenido.
+    # Con fragmentos los ids empiezan en 1 para cada usuario: el usuario forma parte del ETag
+    etag = f"u{user['user_id']}-c{conversation_id}-m{summary[0] or 0}-n{summary[1]}-l{limit or 0}-b{before or 0}"
+    cached = not_modified(etag)
+    if cached is not None:
+        conn.close()
+        return cached
+    
+    if limit:
+        # Página: los últimos `limit` mensajes anteriores a `before`, en orden cronológico
+        cursor.execute('''
+            SELECT id, role, content, created_at FROM (
+                SELECT id, role, content, created_at
+                FROM messages
+                WHERE conversation_id = ? AND id < ?
+                ORDER BY id DESC
+                LIMIT ?
+            ) ORDER BY id ASC
+        ''', (conversation_id, before or sys.maxsize, min(limit, 500)))
+    else:
+        cursor.execute('''
+            SELECT id, role, content, created_at 
+            FROM messages 
+            WHERE conversation_id = ? 
+            ORDER BY created_at ASC
+        ''', (conversation_id,))
     messages = []
     for row in cursor.fetchall():
         messages.append({
@@ -396,12 +891,63 @@ def get_messages(conversation_id):
             'created_at': row[3]
         })
     conn.close()
-    return jsonify(messages)
+    return with_etag(jsonify(messages), etag)
+
+@app.route('/api/export', methods=['GET'])
+@require_auth
+def export_conversations():
+    """Exporta las conversaciones del usuario actual como NDJSON comprimido (streaming)"""
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    # Incluir los mensajes que aún están en la cola del escritor
+    message_writer.flush(timeout=5)
+    filename = f"gp-test-{user['username']}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.ndjson.gz"
+    logger.info(f"Exportación iniciada para usuario {user['username']}")
+    return Response(
+        gzip_ndjson(export_records(storage.path_for(user['user_id']), user['user_id'], user['username'])),
+        mimetype='application/gzip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/api/import', methods=['POST'])
+@require_auth
+def import_conversations():
+    """Importa conversaciones desde un NDJSON (gzip o plano) leído en streaming"""
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    try:
+        stats = import_records(
+            storage.path_for(user['user_id']),
+            user['user_id'],
+            read_ndjson(request.stream),
+            batch_rows=config.IMPORT_BATCH_ROWS
+        )
+    except ImportFormatError as e:
+        logger.warning(f"Importación inválida de {user['username']}: {str(e)}")
+        return jsonify({'error': str(e), 'imported': e.stats}), 400
+    except sqlite3.Error as e:
+        logger.error(f"Error importando conversaciones de {user['username']}: {str(e)}")
+        return jsonify({'error': 'Error guardando la importación', 'imported': e.stats}), 500
+    return jsonify({'success': True, 'imported': stats})
 
 @app.route('/api/chat', methods=['POST'])
 @require_auth
+@rate_limited
 def chat():
-    """Procesa un mensaje del chat"""
+    """
+    Procesa un mensaje del chat
+    
+    Las peticiones idénticas en curso (misma conversación, mismo estado y
+    mismo mensaje) comparten una sola generación. Con la cabecera
+    Idempotency-Key (o el campo idempotency_key), un reintento que llega
+    cuando la respuesta ya se generó recibe esa misma respuesta. Sin ella solo
+    se repiten durante unos segundos las respuestas correctas de una
+    conversación existente.
+    """
     user = get_user_from_token()
     if not user:
         return jsonify({'error': 'No autorizado'}), 401
@@ -409,80 +955,160 @@ def chat():
     data = request.json
     message = data.get('message')
     conversation_id = data.get('conversation_id')
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
     
     if not message:
         return jsonify({'error': 'Mensaje requerido'}), 400
     
-    username = user['username']
-    
-    # Guardar mensaje del usuario
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
+    last_reply_id = None
     if conversation_id:
         # Verificar que la conversación pertenece al usuario
+        conn = storage.connect(user['user_id'])
+        cursor = conn.cursor()
         cursor.execute('SELECT id FROM conversations WHERE id = ? AND user_id = ?', (conversation_id, user['user_id']))
         if not cursor.fetchone():
             conn.close()
             return jsonify({'error': 'Conversación no encontrada'}), 404
-        
-        cursor.execute('''
-            INSERT INTO messages (conversation_id, role, content) 
-            VALUES (?, ?, ?)
-        ''', (conversation_id, 'user', message))
-        cursor.execute('''
-            UPDATE conversations SET updated_at = CURRENT_TIMESTAMP 
-            WHERE id = ?
-        ''', (conversation_id,))
+        # Estado de la conversación: última respuesta (los mensajes del usuario
+        # que se guardan mientras tanto no cambian la clave del duplicado)
+        cursor.execute("SELECT MAX(id) FROM messages WHERE conversation_id = ? AND role != 'user'", (conversation_id,))
+        last_reply_id = cursor.fetchone()[0]
+        conn.close()
+    
+    idempotency_key = f"{user['user_id']}:{str(idempotency_key)[:128]}" if idempotency_key else None
+    if idempotency_key:
+        replayed = single_flight.replay(f'idempotency:{idempotency_key}')
+        if replayed is not None:
+            body, status = replayed
+            return jsonify(dict(body, deduplicated='replayed')), status
+    
+    cancel = register_cancel_token(user['user_id'])
+    if cancel is None:
+        return jsonify({'error': 'Ya hay una petición en curso con ese request_id'}), 409
+    
+    flight_key = hashlib.sha256(json.dumps([
+        user['user_id'], conversation_id, last_reply_id, message,
+        llm_client.llama_model, cascade_router.enabled and cascade_router.small_model
+    ]).encode('utf-8')).hexdigest()
+    try:
+        (body, status), role = single_flight.run(
+            flight_key,
+            lambda token: answer_chat(user, message, conversation_id, token),
+            cancel=cancel,
+            # Solo se repiten las respuestas correctas en conversaciones que ya
+            # existían: un chat nuevo crea su conversación en cada petición (los
+            # reintentos de un chat nuevo se deduplican con Idempotency-Key)
+            cacheable=lambda result: bool(conversation_id) and result[1] == 200
+        )
+    except Cancelled as e:
+        logger.info(f"Chat de {user['username']} cancelado ({cancel.request_id}): {str(e)}")
+        # 499: el cliente cerró la petición (la respuesta solo llega si canceló con /cancel)
+        return jsonify({
+            'conversation_id': conversation_id,
+            'request_id': cancel.request_id,
+            'cancelled': True
+        }), 499
+    finally:
+        cancel_registry.unregister(cancel)
+    
+    if idempotency_key and role == 'leader' and status == 200:
+        single_flight.remember(f'idempotency:{idempotency_key}', [body, status], ttl=config.IDEMPOTENCY_TTL)
+    body = dict(body, request_id=cancel.request_id)
+    if role != 'leader':
+        logger.info(f"Chat de {user['username']} deduplicado ({role}): {cancel.request_id}")
+        body['deduplicated'] = role
+    response = jsonify(body)
+    if status == 503 and body.get('retry_after'):
+        response.headers['Retry-After'] = str(body['retry_after'])
+    return response, status
+
+def answer_chat(user, message, conversation_id, cancel):
+    """
+    Guarda el mensaje, genera la respuesta y la guarda (una vez por generación compartida)
+    
+    Returns:
+        (cuerpo JSON, código HTTP)
+    
+    Raises:
+        Cancelled si se cancelan todas las peticiones que esperan la respuesta
+    """
+    username = user['username']
+    
+    # Guardar mensaje del usuario
+    if conversation_id:
+        ticket = message_writer.enqueue_message(conversation_id, 'user', message, user_id=user['user_id'])
     else:
         # Crear nueva conversación para el usuario
+        conn = storage.connect(user['user_id'])
+        cursor = conn.cursor()
         cursor.execute('INSERT INTO conversations (user_id, title) VALUES (?, ?)', (user['user_id'], message[:50]))
         conversation_id = cursor.lastrowid
-        cursor.execute('''
-            INSERT INTO messages (conversation_id, role, content) 
-            VALUES (?, ?, ?)
-        ''', (conversation_id, 'user', message))
+        conn.commit()
+        conn.close()
+        ticket = message_writer.enqueue_message(conversation_id, 'user', message, user_id=user['user_id'])
     
-    conn.commit()
-    conn.close()
+    # Esperar a que el mensaje del usuario esté confirmado (entra en el historial)
+    try:
+        ticket.wait(timeout=30)
+    except sqlite3.Error as e:
+        logger.error(f"Error guardando mensaje del usuario: {str(e)}")
+        return {'error': 'Error guardando el mensaje'}, 500
     
     # Procesar con Llama usando Ollama
+    g.request_usage = RequestUsage()
     try:
-        response = process_with_llama(message, username, conversation_id, user['user_id'])
+        response = process_with_llama(message, username, conversation_id, user['user_id'], cancel=cancel)
         
-        # Guardar respuesta
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO messages (conversation_id, role, content) 
-            VALUES (?, ?, ?)
-        ''', (conversation_id, 'assistant', response.get('content', 'Error al generar respuesta')))
-        conn.commit()
-        conn.close()
+        # Guardar respuesta con su uso (se confirma en el siguiente commit agrupado);
+        # una generación fallida solo cuenta como error en /api/usage
+        failed = bool(response.get('failed') or response.get('unavailable'))
+        reply_ticket = message_writer.enqueue_message(
+            conversation_id, 'assistant',
+            response.get('content', 'Error al generar respuesta'),
+            usage=g.request_usage.as_row(
+                'cache' if response.get('cached') else llm_client.llama_model if failed else None,
+                failed=failed
+            ),
+            user_id=user['user_id']
+        )
+        # Con la respuesta confirmada, un mensaje nuevo igual ya no coincide con esta generación
+        try:
+            reply_ticket.wait(timeout=30)
+        except sqlite3.Error as e:
+            logger.error(f"Error guardando la respuesta: {str(e)}")
         
-        return jsonify({
+        if response.get('unavailable'):
+            # Circuito abierto: 503 inmediato con Retry-After en lugar de esperar al timeout
+            return {
+                'conversation_id': conversation_id,
+                'response': response,
+                'error': response['content'],
+                'retry_after': response.get('retry_after')
+            }, 503
+        
+        return {
             'conversation_id': conversation_id,
             'response': response
-        })
+        }, 200
+    except Cancelled:
+        message_writer.enqueue_message(conversation_id, 'assistant', '⏹️ Generación cancelada', user_id=user['user_id'])
+        raise
     except Exception as e:
         logger.error(f"Error procesando mensaje: {str(e)}", exc_info=True)
         error_message = str(e)
         
         # Guardar mensaje de error
+        error_content = f"Error al procesar el mensaje: {error_message}"
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            error_content = f"Error al procesar el mensaje: {error_message}"
-            cursor.execute('''
-                INSERT INTO messages (conversation_id, role, content) 
-                VALUES (?, ?, ?)
-            ''', (conversation_id, 'assistant', error_content))
-            conn.commit()
-            conn.close()
+            message_writer.enqueue_message(
+                conversation_id, 'assistant', error_content,
+                usage=g.request_usage.as_row(llm_client.llama_model, failed=True),
+                user_id=user['user_id']
+            )
         except Exception as db_error:
             logger.error(f"Error guardando mensaje de error en BD: {str(db_error)}")
         
-        return jsonify({
+        return {
             'conversation_id': conversation_id,
             'response': {
                 'content': error_content,
@@ -491,10 +1117,134 @@ def chat():
                 'language': None
             },
             'error': error_message
-        }), 500
+        }, 500
+
+@app.route('/api/chat/<request_id>/cancel', methods=['POST'])
+@require_auth
+def cancel_request(request_id):
+    """Cancela un chat o ejecución en curso del usuario: se cierra la generación y se matan sus procesos"""
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    result = cancel_registry.cancel(request_id, user['user_id'])
+    if result == 'pending':
+        # La petición está activa en otro worker: la recoge su vigilante
+        return jsonify({'cancelled': 'pending', 'request_id': request_id}), 202
+    if not result:
+        return jsonify({'error': 'Petición no encontrada'}), 404
+    return jsonify({'cancelled': True, 'request_id': request_id})
+
+@app.route('/api/batch', methods=['POST'])
+@require_auth
+@rate_limited
+def run_batch():
+    """
+    Ejecuta un lote de prompts de evaluación (formato en batch.py)
+    
+    Responde en streaming con NDJSON: una línea {"type": "start"}, una
+    {"type": "result"} por prompt según van terminando y una {"type": "summary"}
+    con las latencias y tokens por modelo. No guarda nada en las conversaciones
+    salvo con "persist": true (una conversación con cada prompt y su respuesta).
+    Se cancela como un chat (request_id y /api/chat/<id>/cancel) o cerrando la conexión.
+    """
+    user = get_user_from_token()
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    data = request.get_json(silent=True)
+    
+    # Idioma del usuario para los prompts que no indican otro
+    conn = connect(DB_PATH)
+    row = conn.execute('SELECT language FROM users WHERE id = ?', (user['user_id'],)).fetchone()
+    conn.close()
+    
+    try:
+        items = parse_batch(
+            data,
+            llm_client.llama_model,
+            default_language=(row and row[0]) or 'es',
+            max_prompts=config.BATCH_MAX_PROMPTS
+        )
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    concurrency = data.get('concurrency', config.BATCH_DEFAULT_CONCURRENCY)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        return jsonify({'error': 'concurrency debe ser un entero positivo'}), 400
+    concurrency = min(concurrency, config.BATCH_MAX_CONCURRENCY)
+    
+    cancel = register_cancel_token(user['user_id'])
+    if cancel is None:
+        return jsonify({'error': 'Ya hay una petición en curso con ese request_id'}), 409
+    
+    conversation_id = None
+    if data.get('persist'):
+        title = data.get('title') or f"Lote {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        conn = storage.connect(user['user_id'])
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO conversations (user_id, title) VALUES (?, ?)', (user['user_id'], str(title)[:50]))
+        conversation_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+    
+    logger.info(f"Lote de {len(items)} prompts de {user['username']} ({cancel.request_id})")
+    
+    def ndjson(record):
+        return json.dumps(record, ensure_ascii=False) + '\n'
+    
+    def stream():
+        start = time.monotonic()
+        results = []
+        runs = batch_runner.run(items, concurrency, user['username'], cancel=cancel)
+        try:
+            yield ndjson({
+                'type': 'start',
+                'batch_id': cancel.request_id,
+                'items': len(items),
+                'models': {model: len(group) for model, group in group_by_model(items).items()},
+                'concurrency': concurrency,
+                'conversation_id': conversation_id
+            })
+            for result in runs:
+                results.append(result)
+                if config.RATE_LIMIT_ENABLED:
+                    rate_limiter.charge_tokens(user['user_id'], result['usage']['eval_tokens'])
+                if conversation_id and result['status'] != 'cancelled':
+                    timings = result['timings']
+                    message_writer.enqueue_message(
+                        conversation_id, 'user', items[result['index']].prompt, user_id=user['user_id']
+                    )
+                    message_writer.enqueue_message(
+                        conversation_id, 'assistant', result['content'] or '',
+                        usage=dict(
+                            result['usage'],
+                            model=result['model'],
+                            load_ms=timings['load_ms'],
+                            prompt_eval_ms=timings['prompt_eval_ms'],
+                            eval_ms=timings['eval_ms'],
+                            latency_ms=timings['latency_ms']
+                        ) if result['status'] == 'ok' else {'model': result['model'], 'failed': 1},
+                        user_id=user['user_id']
+                    )
+                yield ndjson(dict(result, type='result'))
+            summary = summarize(results, time.monotonic() - start)
+            if cancel.is_cancelled:
+                summary['cancelled'] = cancel.reason
+            logger.info(f"Lote {cancel.request_id} terminado: {summary['statuses']} en {summary['elapsed_ms']} ms")
+            yield ndjson(dict(summary, type='summary'))
+        finally:
+            # El cliente dejó de leer a mitad del lote: se cortan las generaciones en curso
+            if len(results) < len(items):
+                cancel.cancel('lote interrumpido')
+            runs.close()
+            cancel_registry.unregister(cancel)
+    
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache'})
 
 @app.route('/api/execute', methods=['POST'])
 @require_auth
+@rate_limited
 def execute_script():
     """Ejecuta un script generado"""
     user = get_user_from_token()
@@ -508,17 +1258,32 @@ def execute_script():
     if not script_content:
         return jsonify({'error': 'Script requerido'}), 400
     
+    cancel = register_cancel_token(user['user_id'])
+    if cancel is None:
+        return jsonify({'error': 'Ya hay una petición en curso con ese request_id'}), 409
+    
     try:
-        result = run_script(script_content, language)
+        result = run_script(script_content, language, cancel=cancel)
+        result['request_id'] = cancel.request_id
         return jsonify(result)
+    except Cancelled as e:
+        logger.info(f"Ejecución cancelada ({cancel.request_id}): {str(e)}")
+        return jsonify({'request_id': cancel.request_id, 'cancelled': True}), 499
     except Exception as e:
         logger.error(f"Error ejecutando script: {str(e)}")
         return jsonify({'error': f'Error ejecutando script: {str(e)}'}), 500
+    finally:
+        cancel_registry.unregister(cancel)
 
-def process_with_llama(message, username, conversation_id, user_id=None):
-    """Procesa el mensaje con Llama usando Ollama"""
-    # Obtener historial de la conversación y idioma del usuario
-    conn = sqlite3.connect(DB_PATH)
+def process_with_llama(message, username, conversation_id, user_id=None, cancel=None):
+    """
+    Procesa el mensaje con Llama usando Ollama
+    
+    Raises:
+        Cancelled si se cancela la petición (cancel es su CancelToken)
+    """
+    # Obtener historial de la conversación (en la base de datos del usuario)
+    conn = storage.connect(user_id) if user_id else connect(DB_PATH)
     cursor = conn.cursor()
     cursor.execute('''
         SELECT role, content FROM messages 
@@ -526,8 +1291,11 @@ def process_with_llama(message, username, conversation_id, user_id=None):
         ORDER BY created_at ASC
     ''', (conversation_id,))
     history = cursor.fetchall()
+    conn.close()
     
     # Obtener idioma del usuario
+    conn = connect(DB_PATH)
+    cursor = conn.cursor()
     user_language = 'es'  # Por defecto español
     if user_id:
         cursor.execute('SELECT language FROM users WHERE id = ?', (user_id,))
@@ -540,15 +1308,29 @@ def process_with_llama(message, username, conversation_id, user_id=None):
     logger.info(f"Procesando mensaje para usuario {user_id} ({username}) en idioma: {user_language}")
     conn.close()
     
-    # Procesar con Llama usando Ollama
-    response = llm_client.generate(message, None, history, username, language=user_language, use_deepseek=False)
+    # Respuesta cacheada de un mensaje parecido del mismo usuario, solo en el
+    # primer turno (solo el texto del modelo; los comandos se vuelven a ejecutar
+    # más abajo). El historial ya incluye el mensaje actual
+    previous_turns = history[:-1] if history and tuple(history[-1]) == ('user', message) else history
+    response, cache_vector = (
+        semantic_cache.lookup(message, user_language, user_id, previous_turns) if semantic_cache else (None, None)
+    )
+    
+    if response is None:
+        # Procesar con Llama usando Ollama (o con el modelo pequeño si el turno es simple)
+        response = cascade_router.generate(message, history, username, language=user_language, cancel=cancel)
+        if response.get('unavailable'):
+            # Circuito abierto: no hay respuesta del modelo que analizar
+            return response
+        if semantic_cache:
+            semantic_cache.store(message, user_language, user_id, response, cache_vector)
     
     # Si detecta comandos del sistema, ejecutarlos directamente
     if response.get('needs_code') and response.get('is_system_command'):
         command = response.get('code')
         logger.info(f"Ejecutando comando del sistema: {command}")
         try:
-            command_result = run_system_command(command)
+            command_result = run_system_command(command, cancel=cancel)
             if command_result.get('success'):
                 output = command_result.get('output', '').strip()
                 # Mantener solo la primera línea/frase de la respuesta original
@@ -582,6 +1364,8 @@ def process_with_llama(message, username, conversation_id, user_id=None):
                     response['content'] += f"\n❌ {error}"
             # No necesita código para ejecutar, ya se ejecutó
             response['needs_code'] = False
+        except Cancelled:
+            raise
         except Exception as e:
             logger.error(f"Error ejecutando comando: {str(e)}")
             first_line = response['content'].split('\n')[0] if response.get('content') else "Error"
@@ -600,7 +1384,7 @@ def process_with_llama(message, username, conversation_id, user_id=None):
             if len(command.split()) > 1:
                 logger.info(f"Comando detectado en texto, ejecutando: {command}")
                 try:
-                    command_result = run_system_command(command)
+                    command_result = run_system_command(command, cancel=cancel)
                     if command_result.get('success'):
                         output = command_result.get('output', '').strip()
                         first_line = response['content'].split('\n')[0]
@@ -628,6 +1412,8 @@ def process_with_llama(message, username, conversation_id, user_id=None):
                                 response['content'] += f"\n\n❌ {error}"
                         else:
                             response['content'] += f"\n❌ {error}"
+                except Cancelled:
+                    raise
                 except Exception as e:
                     logger.error(f"Error ejecutando comando detectado: {str(e)}")
     
@@ -650,7 +1436,8 @@ Historial de conversación relevante: {str(history[-3:]) if history else 'Ningun
             requirements=deepseek_requirements,
             language=language,
             context=context_for_deepseek,
-            user_language=user_language  # Reutilizar la variable ya obtenida
+            user_language=user_language,  # Reutilizar la variable ya obtenida
+            cancel=cancel
         )
         
         if deepseek_result.get('success'):
@@ -774,7 +1561,7 @@ def detect_missing_command(error_message):
     
     return None
 
-def install_package(package_name):
+def install_package(package_name, cancel=None):
     """Instala un paquete usando apt"""
     try:
         logger.info(f"Instalando paquete: {package_name}")
@@ -782,11 +1569,10 @@ def install_package(package_name):
         # Ejecutar actualización e instalación
         install_command = f"sudo apt update && sudo apt install -y {package_name}"
         
-        result = subprocess.run(
+        result = run_process(
             install_command,
+            cancel=cancel,
             shell=True,
-            capture_output=True,
-            text=True,
             timeout=300,  # 5 minutos para instalación
             env=os.environ.copy()
         )
@@ -811,6 +1597,8 @@ def install_package(package_name):
             'error': 'Instalación excedió el tiempo límite (5 minutos)',
             'package': package_name
         }
+    except Cancelled:
+        raise
     except Exception as e:
         return {
             'success': False,
@@ -818,7 +1606,7 @@ def install_package(package_name):
             'package': package_name
         }
 
-def run_system_command(command, retry_after_install=True):
+def run_system_command(command, retry_after_install=True, cancel=None):
     """Ejecuta un comando del sistema directamente, con soporte para sudo y auto-instalación"""
     try:
         # Detectar si el comando ya incluye sudo
@@ -842,11 +1630,11 @@ def run_system_command(command, retry_after_install=True):
             command_str = f"sudo {command_str}"
             logger.info(f"Agregando sudo al comando: {command_str}")
         
-        result = subprocess.run(
+        # En su propio grupo de procesos: al cancelar se termina el shell y sus hijos
+        result = run_process(
             command_str,
+            cancel=cancel,
             shell=True,
-            capture_output=True,
-            text=True,
             timeout=60,
             # Permitir ejecutar como root si es necesario
             env=os.environ.copy()
@@ -862,12 +1650,12 @@ def run_system_command(command, retry_after_install=True):
                 
                 if package_name:
                     logger.info(f"Instalando paquete: {package_name}")
-                    install_result = install_package(package_name)
+                    install_result = install_package(package_name, cancel=cancel)
                     
                     if install_result.get('success'):
                         # Reintentar el comando original después de instalar
                         logger.info(f"Reintentando comando después de instalar {package_name}: {original_command}")
-                        retry_result = run_system_command(original_command, retry_after_install=False)
+                        retry_result = run_system_command(original_command, retry_after_install=False, cancel=cancel)
                         # Marcar que se instaló y se reintentó
                         retry_result['install_attempted'] = True
                         retry_result['missing_command'] = missing_command
@@ -894,40 +1682,39 @@ def run_system_command(command, retry_after_install=True):
             'success': False,
             'error': 'Comando excedió el tiempo límite (60 segundos)'
         }
+    except Cancelled:
+        raise
     except Exception as e:
         return {
             'success': False,
             'error': str(e)
         }
 
-def run_script(script_content, language):
-    """Ejecuta un script en el lenguaje especificado"""
+def run_script(script_content, language, cancel=None):
+    """Ejecuta un script en el lenguaje especificado (cancelable con cancel)"""
     with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix=get_file_extension(language)) as f:
         f.write(script_content)
         temp_file = f.name
     
     try:
         if language == 'python':
-            result = subprocess.run(
+            result = run_process(
                 ['python3', temp_file],
-                capture_output=True,
-                text=True,
+                cancel=cancel,
                 timeout=30
             )
         elif language == 'bash':
-            result = subprocess.run(
+            result = run_process(
                 ['bash', temp_file],
-                capture_output=True,
-                text=True,
+                cancel=cancel,
                 timeout=30
             )
         elif language == 'c':
             # Compilar y ejecutar C
             compiled = temp_file.replace('.c', '')
-            compile_result = subprocess.run(
+            compile_result = run_process(
                 ['gcc', temp_file, '-o', compiled],
-                capture_output=True,
-                text=True,
+                cancel=cancel,
                 timeout=30
             )
             if compile_result.returncode != 0:
@@ -936,10 +1723,9 @@ def run_script(script_content, language):
                     'output': compile_result.stderr,
                     'error': 'Error de compilación'
                 }
-            result = subprocess.run(
+            result = run_process(
                 [compiled],
-                capture_output=True,
-                text=True,
+                cancel=cancel,
                 timeout=30
             )
         else:
@@ -954,6 +1740,13 @@ def run_script(script_content, language):
         if os.path.exists(temp_file):
             os.unlink(temp_file)
 
+def warm_up_models():
+    """Carga en segundo plano los modelos de WARMUP_MODELS, reintentando hasta que estén listos"""
+    def run():
+        while not llm_client.warm_up(config.WARMUP_MODELS):
+            time.sleep(5)
+    threading.Thread(target=run, name='model-warmup', daemon=True).start()
+
 def get_file_extension(language):
     """Obtiene la extensión de archivo para un lenguaje"""
     extensions = {
@@ -966,6 +1759,9 @@ def get_file_extension(language):
     return extensions.get(language, '.txt')
 
 if __name__ == '__main__':
+    # SIGTERM (kill desde start.sh) sale por sys.exit para que atexit vacíe el escritor
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     init_db()
+    warm_up_models()
     app.run(debug=config.FLASK_DEBUG, host=config.FLASK_HOST, port=config.FLASK_PORT)
 
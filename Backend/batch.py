@@ -0,0 +1,269 @@
+"""
+Lotes de prompts para evaluación (POST /api/batch)
+
+Para comprobar el comportamiento de los modelos tras cambiar config.py o el
+prompt del sistema se lanzan cientos de prompts. Por /api/chat cada uno crea
+una conversación, pasa por la detección de comandos y espera su propio viaje
+HTTP. Aquí:
+
+- Los prompts van directamente a LLMClient.generate (sin historial guardado,
+  caché semántica, cascada ni ejecución de comandos).
+- Se agrupan por modelo y los grupos se ejecutan uno detrás de otro, así el
+  servidor de inferencia no alterna modelos en memoria. Dentro de un grupo se
+  generan hasta `concurrency` prompts a la vez.
+- Los resultados se devuelven en cuanto terminan (orden de finalización, con
+  su índice), con los tiempos de cola y de generación y los tokens.
+
+Formato de la petición:
+    {
+        "prompts": ["texto", {"id": "p2", "prompt": "...", "model": "...",
+                              "system_prompt": "...", "history": [["user", "..."], ...],
+                              "language": "en"}],
+        "model": "...", "system_prompt": "...", "language": "es",
+        "concurrency": 2, "persist": false, "title": "..."
+    }
+"""
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cancellation import Cancelled
+from usage import RequestUsage
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ROLES = ('user', 'assistant')
+
+
+class BatchError(ValueError):
+    """La petición del lote no tiene el formato esperado"""
+
+
+class BatchItem:
+    __slots__ = ('index', 'id', 'prompt', 'model', 'system_prompt', 'history', 'language')
+
+    def __init__(self, index, id, prompt, model, system_prompt=None, history=None, language='es'):
+        self.index = index
+        self.id = id
+        self.prompt = prompt
+        self.model = model
+        self.system_prompt = system_prompt
+        self.history = history
+        self.language = language
+
+
+def _history(value, index):
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise BatchError(f"prompts[{index}].history debe ser una lista de [rol, contenido]")
+    history = []
+    for entry in value:
+        if (
+            not isinstance(entry, (list, tuple)) or len(entry) != 2
+            or entry[0] not in HISTORY_ROLES or not isinstance(entry[1], str)
+        ):
+            raise BatchError(f"prompts[{index}].history: cada entrada es [\"user\"|\"assistant\", texto]")
+        history.append((entry[0], entry[1]))
+    return history
+
+
+def parse_batch(data, default_model, default_language='es', max_prompts=1000):
+    """
+    Valida el cuerpo de la petición
+
+    Returns:
+        Lista de BatchItem
+
+    Raises:
+        BatchError si falta algo o hay más de max_prompts prompts
+    """
+    if not isinstance(data, dict):
+        raise BatchError("Se esperaba un objeto JSON")
+    prompts = data.get('prompts')
+    if not isinstance(prompts, list) or not prompts:
+        raise BatchError("prompts debe ser una lista no vacía")
+    if len(prompts) > max_prompts:
+        raise BatchError(f"Como máximo {max_prompts} prompts por lote")
+
+    model = data.get('model') or default_model
+    system_prompt = data.get('system_prompt')
+    language = data.get('language') or default_language
+    items = []
+    for index, entry in enumerate(prompts):
+        if isinstance(entry, str):
+            entry = {'prompt': entry}
+        if not isinstance(entry, dict) or not isinstance(entry.get('prompt'), str) or not entry['prompt'].strip():
+            raise BatchError(f"prompts[{index}] debe ser un texto o un objeto con prompt")
+        items.append(BatchItem(
+            index,
+            entry.get('id', index),
+            entry['prompt'],
+            entry.get('model') or model,
+            system_prompt=entry.get('system_prompt') or system_prompt,
+            history=_history(entry.get('history'), index),
+            language=entry.get('language') or language
+        ))
+    return items
+
+
+def group_by_model(items):
+    """Prompts agrupados por modelo, en el orden en que aparece cada modelo"""
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(item.model, []).append(item)
+    return groups
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(results, elapsed):
+    """Resumen del lote por modelo (latencias, tokens y estados)"""
+    models = OrderedDict()
+    statuses = Counter()
+    for result in results:
+        statuses[result['status']] += 1
+        entry = models.setdefault(result['model'], {
+            'statuses': Counter(), 'latencies': [], 'eval_tokens': 0, 'eval_ms': 0.0
+        })
+        entry['statuses'][result['status']] += 1
+        if result['status'] == 'ok':
+            entry['latencies'].append(result['timings']['latency_ms'])
+            entry['eval_tokens'] += result['usage']['eval_tokens']
+            entry['eval_ms'] += result['timings']['eval_ms'] or 0.0
+    by_model = {}
+    for model, entry in models.items():
+        latencies = entry['latencies']
+        by_model[model] = {
+            'items': sum(entry['statuses'].values()),
+            'statuses': dict(entry['statuses']),
+            'latency_ms': {
+                'avg': round(sum(latencies) / len(latencies), 1) if latencies else None,
+                'p50': _percentile(latencies, 0.5),
+                'p95': _percentile(latencies, 0.95),
+                'max': max(latencies) if latencies else None
+            },
+            'eval_tokens': entry['eval_tokens'],
+            'tokens_per_s': round(entry['eval_tokens'] / (entry['eval_ms'] / 1000), 1) if entry['eval_ms'] else None
+        }
+    return {
+        'items': len(results),
+        'statuses': dict(statuses),
+        'elapsed_ms': round(elapsed * 1000, 1),
+        'by_model': by_model
+    }
+
+
+class BatchRunner:
+    def __init__(self, llm_client, max_concurrency=4):
+        """
+        Args:
+            llm_client: LLMClient con el que se generan las respuestas
+            max_concurrency: Generaciones simultáneas máximas de un lote
+        """
+        self.llm_client = llm_client
+        self.max_concurrency = max(1, max_concurrency)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        # Uso de la generación en curso de cada hilo del lote
+        self._local = threading.local()
+        llm_client.usage_listeners.append(self._record_usage)
+
+    def _record_usage(self, model, usage):
+        current = getattr(self._local, 'usage', None)
+        if current is not None:
+            current.add(model, usage)
+
+    def _count(self, **values):
+        with self._stats_lock:
+            self.stats.update(values)
+
+    def run(self, items, concurrency=1, username='Usuario', cancel=None):
+        """
+        Genera las respuestas del lote
+
+        Yields:
+            Un resultado por prompt (ver _run_item) en orden de finalización.
+            Si se cancela el lote, los prompts que faltan salen como 'cancelled'.
+        """
+        concurrency = max(1, min(int(concurrency), self.max_concurrency))
+        start = time.monotonic()
+        self._count(batches=1, items=len(items))
+        for model, group in group_by_model(items).items():
+            logger.info(f"Lote: {len(group)} prompts con {model} ({concurrency} en paralelo)")
+            executor = ThreadPoolExecutor(max_workers=min(concurrency, len(group)), thread_name_prefix='batch')
+            try:
+                futures = [executor.submit(self._run_item, item, username, cancel, start) for item in group]
+                for future in as_completed(futures):
+                    result = future.result()
+                    self._count(**{result['status']: 1})
+                    yield result
+            finally:
+                # Si el cliente deja de leer, los prompts que no han empezado no se generan
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_item(self, item, username, cancel, batch_start):
+        """
+        Returns:
+            dict con index, id, model, status ('ok', 'error', 'unavailable' o
+            'cancelled'), la respuesta, usage y timings (ms)
+        """
+        started = time.monotonic()
+        usage = RequestUsage()
+        response = {}
+        if cancel is not None and cancel.is_cancelled:
+            status = 'cancelled'
+        else:
+            self._local.usage = usage
+            try:
+                response = self.llm_client.generate(
+                    item.prompt,
+                    system_prompt=item.system_prompt,
+                    history=item.history,
+                    username=username,
+                    language=item.language,
+                    model=item.model,
+                    cancel=cancel
+                )
+                status = 'unavailable' if response.get('unavailable') else 'error' if response.get('failed') else 'ok'
+            except Cancelled:
+                status = 'cancelled'
+            except Exception as e:
+                logger.error(f"Error en el prompt {item.index} del lote: {str(e)}", exc_info=True)
+                status = 'error'
+                response = {'content': f"Error al procesar el prompt: {str(e)}"}
+            finally:
+                self._local.usage = None
+        row = usage.as_row(item.model)
+        result = {
+            'index': item.index,
+            'id': item.id,
+            'model': item.model,
+            'status': status,
+            'content': response.get('content'),
+            'needs_code': response.get('needs_code', False),
+            'code': response.get('code'),
+            'language': response.get('language'),
+            'usage': {'prompt_tokens': row['prompt_tokens'], 'eval_tokens': row['eval_tokens']},
+            'timings': {
+                'queued_ms': round((started - batch_start) * 1000, 1),
+                'latency_ms': row['latency_ms'],
+                'load_ms': row['load_ms'],
+                'prompt_eval_ms': row['prompt_eval_ms'],
+                'eval_ms': row['eval_ms']
+            }
+        }
+        if response.get('retry_after'):
+            result['retry_after'] = response['retry_after']
+        return result
+
+    def snapshot(self):
+        with self._stats_lock:
+            return dict(self.stats)
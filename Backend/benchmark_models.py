@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Benchmark de modelos candidatos para elegir LLAMA_MODEL y DEEPSEEK_MODEL
+
+Ejecuta un conjunto fijo de prompts contra cada modelo a través de LLMClient y mide:
+- Tiempo de carga del modelo (load_duration de Ollama)
+- Tiempo hasta el primer token (TTFT)
+- Tokens por segundo (eval_count / eval_duration)
+- Pico de RSS de los procesos de Ollama
+- Tasa de acierto de la detección de comandos de _analyze_response
+
+Uso:
+    python benchmark_models.py
+    python benchmark_models.py --models mistral:7b phi3:mini --json resultados.json
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+import config
+from inference_backends import BackendError
+from llama_integration import LLMClient, CHAT_OPTIONS, CODE_OPTIONS
+from tuning import host_resources
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Segundos máximos de una descarga con --pull
+PULL_TIMEOUT = 3600
+
+# Prompts de chat: (mensaje, se espera un comando del sistema)
+CHAT_PROMPTS = [
+    ("escanea 127.0.0.1 los puertos más comunes", True),
+    ("conexiones activas", True),
+    ("ping google", True),
+    ("muestra los procesos que más memoria usan", True),
+    ("hola, ¿cómo estás?", False),
+    ("¿qué diferencia hay entre TCP y UDP?", False),
+]
+
+# Prompts de código: se espera un bloque de código en la respuesta
+CODE_PROMPTS = [
+    "Script en python que lea un archivo de texto y cuente las palabras",
+    "Script en bash que haga ping a una lista de IPs y muestre cuáles responden",
+    "Programa en c que imprima los números primos menores que 100",
+]
+
+# Fracción de la RAM total que puede usar un modelo
+RAM_HEADROOM = 0.75
+
+# Velocidad mínima aceptable para uso interactivo
+MIN_TOKENS_PER_SECOND = 3.0
+
+
+def ollama_rss_bytes():
+    """Suma el RSS de todos los procesos de Ollama (servidor y runners)"""
+    total = 0
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/comm') as f:
+                if 'ollama' not in f.read():
+                    continue
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class RSSSampler:
+    """Muestrea en segundo plano el RSS de Ollama y guarda el pico"""
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, ollama_rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def list_local_models(client):
+    """Devuelve los modelos disponibles en los backends (None si ninguno responde)"""
+    available = [models for models in client.list_models().values() if models is not None]
+    if not available:
+        return None
+    return {model for models in available for model in models}
+
+
+def run_prompt(client, model, messages, system_prompt, options, purpose='chat'):
+    """Ejecuta un prompt en streaming y devuelve el texto y las métricas"""
+    start = time.perf_counter()
+    first_token = None
+    parts = []
+    usage = {}
+    for chunk in client.stream_chat(model, messages, system_prompt, options, purpose):
+        content = chunk['content']
+        if content and first_token is None:
+            first_token = time.perf_counter() - start
+        parts.append(content)
+        if chunk['done']:
+            usage = chunk['usage'] or {}
+    wall = time.perf_counter() - start
+    eval_count = usage.get('eval_tokens', 0)
+    # Los servidores OpenAI no informan duraciones: se usa el tiempo de pared
+    eval_seconds = (usage.get('eval_duration_ms') or 0) / 1000 or (wall - (first_token or 0))
+    return {
+        'text': ''.join(parts),
+        'wall_s': wall,
+        'ttft_s': first_token,
+        'load_s': (usage.get('load_duration_ms') or 0) / 1000,
+        'eval_count': eval_count,
+        'tokens_per_s': eval_count / eval_seconds if eval_seconds else 0.0
+    }
+
+
+def benchmark_model(client, model, role):
+    """Ejecuta el conjunto de prompts contra un modelo y agrega las métricas"""
+    logger.info(f"🔬 Benchmark de {model} ({role})")
+    # Descargar el modelo para medir una carga en frío
+    client.unload_model(model)
+    time.sleep(1)
+
+    runs = []
+    hits = 0
+    with RSSSampler() as sampler:
+        if role == 'code':
+            system_prompt = "Eres un experto programador que genera código limpio, eficiente y seguro."
+            for prompt in CODE_PROMPTS:
+                run = run_prompt(client, model, [{"role": "user", "content": prompt}], system_prompt, CODE_OPTIONS, 'code')
+                needs_code, code_info = client._analyze_response(run['text'])
+                hits += 1 if needs_code and not code_info.get('is_system_command') else 0
+                runs.append(run)
+        else:
+            system_prompt = client._build_system_prompt("Usuario", "es")
+            for prompt, expects_command in CHAT_PROMPTS:
+                run = run_prompt(client, model, [{"role": "user", "content": prompt}], system_prompt, CHAT_OPTIONS)
+                _, code_info = client._analyze_response(run['text'])
+                hits += 1 if code_info.get('is_system_command', False) == expects_command else 0
+                runs.append(run)
+
+    ttfts = [r['ttft_s'] for r in runs if r['ttft_s'] is not None]
+    speeds = [r['tokens_per_s'] for r in runs if r['tokens_per_s']]
+    result = {
+        'model': model,
+        'role': role,
+        'load_s': runs[0]['load_s'] if runs else None,
+        'ttft_s': sum(ttfts) / len(ttfts) if ttfts else None,
+        'tokens_per_s': sum(speeds) / len(speeds) if speeds else 0.0,
+        'peak_rss_gb': sampler.peak / (1024 ** 3) if sampler.peak else None,
+        'hit_rate': hits / len(runs) if runs else 0.0,
+        'prompts': len(runs)
+    }
+    logger.info(
+        f"   carga={result['load_s'] or 0:.1f}s ttft={result['ttft_s'] or 0:.2f}s "
+        f"{result['tokens_per_s']:.1f} tok/s rss={result['peak_rss_gb'] or 0:.1f}GB "
+        f"aciertos={result['hit_rate']:.0%}"
+    )
+    # Liberar memoria antes del siguiente modelo
+    client.unload_model(model)
+    return result
+
+
+def rank_results(results, host):
+    """Ordena los resultados y sugiere LLAMA_MODEL/DEEPSEEK_MODEL para el host"""
+    budget = host['ram_total_gb'] * RAM_HEADROOM if host['ram_total_gb'] else None
+
+    def fits(result):
+        ram = result['peak_rss_gb'] or config.MODEL_CATALOG.get(result['model'], {}).get('ram_gb')
+        if budget is not None and ram is not None and ram > budget:
+            return False
+        return result['tokens_per_s'] >= MIN_TOKENS_PER_SECOND
+
+    def score(result):
+        # Prioridad: acierto en detección, después velocidad y latencia
+        return (result['hit_rate'], result['tokens_per_s'], -(result['ttft_s'] or 0))
+
+    ranked = sorted(results, key=score, reverse=True)
+    for result in ranked:
+        result['fits_host'] = fits(result)
+
+    def best(role):
+        for result in ranked:
+            if result['role'] == role and result['fits_host']:
+                return result['model']
+        return None
+
+    return ranked, {
+        'LLAMA_MODEL': best('general') or config.LLAMA_MODEL,
+        'DEEPSEEK_MODEL': best('code') or config.DEEPSEEK_MODEL
+    }
+
+
+def print_report(ranked, suggestion, host):
+    """Imprime el informe ordenado"""
+    print()
+    print(f"Host: {host['cpu_count']} cores, "
+          f"{host['ram_total_gb'] or 0:.1f}GB RAM total, "
+          f"{host['ram_available_gb'] or 0:.1f}GB disponible")
+    print()
+    header = f"{'#':>2}  {'Modelo':<20} {'Rol':<8} {'Carga':>7} {'TTFT':>7} {'tok/s':>7} {'RSS GB':>7} {'Aciertos':>9}  Cabe"
+    print(header)
+    print('-' * len(header))
+    for i, r in enumerate(ranked, 1):
+        print(f"{i:>2}  {r['model']:<20} {r['role']:<8} "
+              f"{r['load_s'] or 0:>6.1f}s {r['ttft_s'] or 0:>6.2f}s {r['tokens_per_s']:>7.1f} "
+              f"{r['peak_rss_gb'] or 0:>7.1f} {r['hit_rate']:>8.0%}  {'✅' if r['fits_host'] else '❌'}")
+    print()
+    print("Configuración sugerida (config.py):")
+    print(f"  LLAMA_MODEL = '{suggestion['LLAMA_MODEL']}'")
+    print(f"  DEEPSEEK_MODEL = '{suggestion['DEEPSEEK_MODEL']}'")
+
+
+def pull_model(model):
+    """Descarga un modelo con ollama pull (sin shell: el nombre viene de config o de la línea de comandos)"""
+    try:
+        result = subprocess.run(['ollama', 'pull', model], check=False, timeout=PULL_TIMEOUT)
+    except FileNotFoundError:
+        logger.error("❌ No se encontró el comando ollama")
+        return False
+    except subprocess.TimeoutExpired:
+        logger.error(f"❌ La descarga de {model} superó {PULL_TIMEOUT} s")
+        return False
+    if result.returncode != 0:
+        logger.error(f"❌ Error descargando {model}")
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de modelos Ollama para GP-Test")
+    parser.add_argument('--models', nargs='+', help="Modelos a evaluar (por defecto MODEL_CATALOG)")
+    parser.add_argument('--pull', action='store_true', help="Descargar los modelos que no estén disponibles")
+    parser.add_argument('--json', dest='json_path', help="Guardar los resultados en un archivo JSON")
+    args = parser.parse_args()
+
+    client = LLMClient()
+    host = host_resources()
+    local_models = list_local_models(client)
+    if local_models is None:
+        logger.error("❌ No se puede conectar con ningún backend. Inicia Ollama con: ollama serve")
+        sys.exit(1)
+
+    candidates = args.models or list(config.MODEL_CATALOG.keys())
+    results = []
+    for model in candidates:
+        role = config.MODEL_CATALOG.get(model, {}).get('role', 'general')
+        if model not in local_models and f"{model}:latest" not in local_models:
+            if not args.pull:
+                logger.info(f"⏭️  {model} no está descargado (usa --pull para descargarlo)")
+                continue
+            logger.info(f"📥 Descargando {model}...")
+            if not pull_model(model):
+                continue
+        try:
+            results.append(benchmark_model(client, model, role))
+        except (requests.exceptions.RequestException, BackendError) as e:
+            logger.error(f"❌ Error evaluando {model}: {str(e)}")
+
+    if not results:
+        logger.error("❌ No se evaluó ningún modelo")
+        sys.exit(1)
+
+    ranked, suggestion = rank_results(results, host)
+    print_report(ranked, suggestion, host)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({'host': host, 'results': ranked, 'suggestion': suggestion}, f, indent=2)
+        logger.info(f"💾 Resultados guardados en {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
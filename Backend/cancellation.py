@@ -0,0 +1,366 @@
+"""
+Cancelación de peticiones en curso
+
+Cada petición de chat o ejecución registra un CancelToken. El token se
+cancela si el cliente se desconecta (el hilo vigilante revisa el socket de la
+petición) o si se llama a POST /api/chat/<request_id>/cancel. Al cancelarse:
+
+- Las conexiones HTTP abiertas con el servidor de inferencia se cierran
+  (shutdown del socket): Ollama detecta la desconexión y deja de generar, y
+  la plaza del endpoint queda libre para las peticiones en cola.
+- Los procesos lanzados con run_process se terminan junto con todo su grupo
+  (el shell y sus hijos), no solo el proceso directo.
+
+Los request_id los elige el cliente, así que solo son únicos por usuario: el
+registro usa (user_id, request_id) y un usuario no ve ni bloquea los ids de
+otro. Con varios workers, cada petición registrada se anuncia en SharedState
+(active:<user_id>:<request_id>). La cancelación que llega a otro proceso solo
+deja la marca si la petición del usuario está activa, y el vigilante del
+worker que la atiende la recoge.
+"""
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+logger = logging.getLogger(__name__)
+
+# Segundos entre SIGTERM y SIGKILL al terminar un grupo de procesos
+KILL_GRACE_SECONDS = 2
+
+_current = threading.local()
+
+
+class Cancelled(Exception):
+    """La petición se canceló (cliente desconectado o cancelación explícita)"""
+
+
+class CancelToken:
+    def __init__(self, request_id, user_id=None, sock=None):
+        """
+        Args:
+            request_id: Identificador de la petición (lo elige el cliente)
+            user_id: Dueño de la petición (solo él puede cancelarla)
+            sock: Socket del cliente, para detectar la desconexión
+        """
+        self.request_id = request_id
+        self.user_id = user_id
+        self.sock = sock
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._closers = {}
+
+    @property
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='cancelada'):
+        """Marca el token y ejecuta los cierres registrados (una sola vez)"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            closers = list(self._closers.values())
+            self._closers.clear()
+        logger.info(f"Petición {self.request_id} cancelada: {reason}")
+        for closer in closers:
+            try:
+                closer()
+            except Exception as e:
+                logger.warning(f"Error cerrando recursos de {self.request_id}: {str(e)}")
+        return True
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+    def add_closer(self, closer):
+        """
+        Registra una función que libera un recurso al cancelar
+
+        Returns:
+            Función para retirar el cierre cuando el recurso ya no está en uso
+            (si el token ya estaba cancelado, el cierre se ejecuta enseguida)
+        """
+        key = object()
+        with self._lock:
+            if not self._event.is_set():
+                self._closers[key] = closer
+                return lambda: self._closers.pop(key, None)
+        closer()
+        return lambda: None
+
+
+# Conexiones HTTP cancelables
+
+@contextmanager
+def bind(token):
+    """Asocia el token al hilo actual: las conexiones que abra la sesión se cierran al cancelar"""
+    previous = getattr(_current, 'token', None)
+    _current.token = token
+    try:
+        if token is not None:
+            token.raise_if_cancelled()
+        yield token
+    finally:
+        _current.token = previous
+
+
+def _shutdown(conn):
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        try:
+            # shutdown (no close) despierta al hilo bloqueado leyendo la respuesta
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _TrackedPoolMixin:
+    """Registra en el token del hilo cada conexión que se toma del pool"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        token = getattr(_current, 'token', None)
+        if token is not None:
+            conn._cancel_release = token.add_closer(lambda: _shutdown(conn))
+        return conn
+
+    def _put_conn(self, conn):
+        release = getattr(conn, '_cancel_release', None)
+        if release is not None:
+            release()
+            conn._cancel_release = None
+        super()._put_conn(conn)
+
+
+class _TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CancellableAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TrackedHTTPConnectionPool,
+            'https': _TrackedHTTPSConnectionPool,
+        }
+
+
+def cancellable_session(pool_maxsize=32):
+    """Sesión de requests cuyas peticiones se abortan al cancelar el token asociado con bind()"""
+    session = requests.Session()
+    adapter = _CancellableAdapter(pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Procesos cancelables
+
+def _signal_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _terminate_group(proc):
+    """SIGTERM al grupo y SIGKILL si sigue vivo pasado el margen"""
+    _signal_group(proc, signal.SIGTERM)
+    timer = threading.Timer(KILL_GRACE_SECONDS, _signal_group, (proc, signal.SIGKILL))
+    timer.daemon = True
+    timer.start()
+
+
+def run_process(args, cancel=None, timeout=None, shell=False, env=None):
+    """
+    Equivalente a subprocess.run(capture_output=True, text=True) cancelable
+
+    El proceso se lanza en su propia sesión (grupo de procesos); al cancelar
+    o al agotar el tiempo se termina el grupo completo.
+
+    Raises:
+        Cancelled si el token se cancela
+        subprocess.TimeoutExpired si se supera el timeout
+    """
+    if cancel is not None:
+        cancel.raise_if_cancelled()
+    proc = subprocess.Popen(
+        args, shell=shell, env=env, text=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True
+    )
+    release = cancel.add_closer(lambda: _terminate_group(proc)) if cancel is not None else None
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _signal_group(proc, signal.SIGKILL)
+        proc.communicate()
+        raise
+    finally:
+        if release is not None:
+            release()
+    if cancel is not None and cancel.is_cancelled:
+        _signal_group(proc, signal.SIGKILL)
+        raise Cancelled(cancel.reason)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+# Registro de peticiones en curso
+
+def client_disconnected(sock):
+    """True si el cliente cerró la conexión (lectura disponible pero vacía)"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        # Socket ya cerrado, o TLS (no admite MSG_PEEK): no se puede saber
+        return isinstance(sock, socket.socket) and sock.fileno() == -1
+
+
+def _shared_key(kind, user_id, request_id):
+    """Clave en SharedState de una petición ('active' o 'cancel')"""
+    return f'{kind}:{user_id}:{request_id}'
+
+
+class CancelRegistry:
+    def __init__(self, shared_state=None, poll_interval=0.5, flag_ttl=300):
+        """
+        Args:
+            shared_state: SharedState para recibir cancelaciones de otros workers
+            poll_interval: Segundos entre revisiones de sockets y marcas
+            flag_ttl: Segundos que se guarda una marca de cancelación sin reclamar
+                (y que dura el anuncio de una petición activa sin renovarse)
+        """
+        self.shared_state = shared_state
+        self.poll_interval = poll_interval
+        self.flag_ttl = flag_ttl
+        self._announced_at = 0.0
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'registered': 0, 'cancelled': 0, 'disconnected': 0}
+
+    def start(self):
+        if self._thread is None and self.poll_interval:
+            self._thread = threading.Thread(target=self._run, name='cancel-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def register(self, request_id=None, user_id=None, sock=None):
+        """
+        Registra una petición en curso
+
+        Returns:
+            CancelToken, o None si el usuario ya tiene una petición en curso con ese id
+        """
+        request_id = request_id or uuid.uuid4().hex
+        with self._lock:
+            if (user_id, request_id) in self._tokens:
+                return None
+            token = self._tokens[(user_id, request_id)] = CancelToken(request_id, user_id, sock)
+            self.stats['registered'] += 1
+        self._announce(token)
+        return token
+
+    def unregister(self, token):
+        key = (token.user_id, token.request_id)
+        with self._lock:
+            if self._tokens.get(key) is not token:
+                return
+            del self._tokens[key]
+        if self.shared_state is not None:
+            try:
+                self.shared_state.cache_delete(_shared_key('active', token.user_id, token.request_id))
+            except Exception as e:
+                logger.warning(f"Error retirando la petición activa {token.request_id}: {str(e)}")
+
+    def _announce(self, token):
+        """Anuncia la petición a los demás workers (para que puedan cancelarla)"""
+        if self.shared_state is None:
+            return
+        try:
+            self.shared_state.cache_set(
+                _shared_key('active', token.user_id, token.request_id), token.user_id, ttl=self.flag_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Error anunciando la petición activa {token.request_id}: {str(e)}")
+
+    def cancel(self, request_id, user_id, reason='cancelada por el usuario'):
+        """
+        Cancela una petición del usuario
+
+        Returns:
+            True si se canceló en este proceso, 'pending' si está activa en
+            otro worker y se dejó la marca, False si el usuario no tiene una
+            petición en curso con ese id
+        """
+        with self._lock:
+            token = self._tokens.get((user_id, request_id))
+        if token is not None:
+            if token.cancel(reason):
+                with self._lock:
+                    self.stats['cancelled'] += 1
+            return True
+        if self.shared_state is not None:
+            if self.shared_state.cache_get(_shared_key('active', user_id, request_id)) is None:
+                return False
+            self.shared_state.cache_set(_shared_key('cancel', user_id, request_id), user_id, ttl=self.flag_ttl)
+            return 'pending'
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                tokens = list(self._tokens.values())
+            # Las peticiones largas (lotes) renuevan su anuncio antes de que caduque
+            if self.shared_state is not None and time.monotonic() - self._announced_at > self.flag_ttl / 3:
+                self._announced_at = time.monotonic()
+                for token in tokens:
+                    if not token.is_cancelled:
+                        self._announce(token)
+            for token in tokens:
+                if token.is_cancelled:
+                    continue
+                if token.sock is not None and client_disconnected(token.sock):
+                    if token.cancel('cliente desconectado'):
+                        with self._lock:
+                            self.stats['disconnected'] += 1
+                    continue
+                if self.shared_state is not None:
+                    key = _shared_key('cancel', token.user_id, token.request_id)
+                    try:
+                        owner = self.shared_state.cache_get(key)
+                    except Exception as e:
+                        logger.warning(f"Error leyendo cancelaciones compartidas: {str(e)}")
+                        break
+                    if owner is not None and token.cancel('cancelada por el usuario'):
+                        self.shared_state.cache_delete(key)
+                        with self._lock:
+                            self.stats['cancelled'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, active=len(self._tokens))
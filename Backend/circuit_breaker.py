@@ -0,0 +1,215 @@
+"""
+Circuit breaker por endpoint y modelo
+
+Cuando un servidor de inferencia está caído, se reinicia o tiene un modelo
+atascado, cada petición esperaba al error de conexión o al timeout (120 s) y
+los hilos se acumulaban. Con el circuit breaker:
+
+- closed: las peticiones pasan. Se guarda el resultado de las de los últimos
+  window segundos; si hay al menos min_requests y la tasa de errores supera
+  error_rate o la de peticiones lentas (> slow_ms) supera slow_rate, se abre.
+- open: las peticiones fallan al instante (CircuitOpen) durante open_seconds.
+- half_open: pasado ese tiempo se dejan pasar half_open_requests peticiones
+  de prueba; si van bien se cierra y si alguna falla se vuelve a abrir.
+
+Los errores 4xx son de la petición, no del servidor, y no cuentan. Las
+transiciones se cuentan y se registran en el log para las métricas.
+"""
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class Breaker:
+    """Estado del circuito de un par (endpoint, modelo)"""
+
+    def __init__(self, endpoint, model):
+        self.endpoint = endpoint
+        self.model = model
+        self.state = CLOSED
+        self.results = deque()  # (instante, error, lenta)
+        self.opened_at = None
+        self.trials = 0  # Peticiones de prueba en curso (half_open)
+        self.last_reason = None
+
+    def rates(self):
+        total = len(self.results)
+        if not total:
+            return 0, 0.0, 0.0
+        errors = sum(1 for _, error, _ in self.results if error)
+        slow = sum(1 for _, _, is_slow in self.results if is_slow)
+        return total, errors / total, slow / total
+
+
+class CircuitBreakers:
+    def __init__(self, enabled=True, window=60, min_requests=3, error_rate=0.5, slow_ms=60000,
+                 slow_rate=0.8, open_seconds=30, half_open_requests=1):
+        """
+        Args:
+            window: Segundos de resultados que se tienen en cuenta
+            min_requests: Peticiones mínimas en la ventana para abrir el circuito
+            error_rate: Fracción de errores que abre el circuito
+            slow_ms: Latencia a partir de la cual una petición cuenta como lenta
+            slow_rate: Fracción de peticiones lentas que abre el circuito
+            open_seconds: Segundos que el circuito permanece abierto
+            half_open_requests: Peticiones de prueba simultáneas en half_open
+        """
+        self.enabled = enabled
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow = slow_ms / 1000.0
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_requests = half_open_requests
+        self.transitions = Counter()  # 'closed->open' -> veces
+        self.rejected = 0
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, endpoint, model):
+        key = (endpoint, model)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = Breaker(endpoint, model)
+        return breaker
+
+    def _transition(self, breaker, state, reason):
+        previous = breaker.state
+        breaker.state = state
+        breaker.last_reason = reason
+        self.transitions[f'{previous}->{state}'] += 1
+        if state == OPEN:
+            breaker.opened_at = time.monotonic()
+        elif state == CLOSED:
+            breaker.opened_at = None
+            breaker.results.clear()
+        level = logging.WARNING if state == OPEN else logging.INFO
+        logger.log(level, f"Circuito {breaker.endpoint} / {breaker.model}: {previous} -> {state} ({reason})",
+                   extra={'breaker_endpoint': breaker.endpoint, 'breaker_model': breaker.model,
+                          'breaker_from': previous, 'breaker_to': state})
+
+    def allow(self, endpoint, model):
+        """
+        True si una petición puede ir a este endpoint (en half_open reserva
+        una de las peticiones de prueba: hay que llamar después a record o release)
+        """
+        if not self.enabled:
+            return True
+        with self._lock:
+            breaker = self._get(endpoint, model)
+            if breaker.state == OPEN:
+                if time.monotonic() - breaker.opened_at < self.open_seconds:
+                    return False
+                self._transition(breaker, HALF_OPEN, 'fin del tiempo abierto')
+            if breaker.state == HALF_OPEN:
+                if breaker.trials >= self.half_open_requests:
+                    return False
+                breaker.trials += 1
+            return True
+
+    def retry_after(self, endpoint, model):
+        """Segundos hasta que el circuito deje pasar una petición de prueba"""
+        with self._lock:
+            breaker = self._breakers.get((endpoint, model))
+            if breaker is None or breaker.state != OPEN:
+                return 0
+            return max(self.open_seconds - (time.monotonic() - breaker.opened_at), 0)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record(self, endpoint, model, latency, error=False):
+        """Resultado de una petición que pasó por allow()"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        slow = latency >= self.slow
+        with self._lock:
+            breaker = self._get(endpoint, model)
+            if breaker.state == HALF_OPEN:
+                breaker.trials = max(breaker.trials - 1, 0)
+                if error or slow:
+                    self._transition(breaker, OPEN, 'falló la petición de prueba' if error else 'petición de prueba lenta')
+                else:
+                    self._transition(breaker, CLOSED, 'petición de prueba correcta')
+                return
+            if breaker.state == OPEN:
+                return  # Petición que empezó antes de abrirse
+            breaker.results.append((now, error, slow))
+            while breaker.results and breaker.results[0][0] < now - self.window:
+                breaker.results.popleft()
+            total, errors, slow_fraction = breaker.rates()
+            if total < self.min_requests:
+                return
+            if errors >= self.error_rate:
+                self._transition(breaker, OPEN, f'{errors:.0%} de errores en {total} peticiones')
+            elif slow_fraction >= self.slow_rate:
+                self._transition(breaker, OPEN, f'{slow_fraction:.0%} de peticiones lentas en {total}')
+
+    def release(self, endpoint, model):
+        """Libera la reserva de allow() de una petición sin resultado (cancelada)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            breaker = self._breakers.get((endpoint, model))
+            if breaker is not None and breaker.state == HALF_OPEN:
+                breaker.trials = max(breaker.trials - 1, 0)
+
+    def open_count(self):
+        with self._lock:
+            return sum(1 for b in self._breakers.values() if b.state != CLOSED)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            breakers = []
+            for breaker in self._breakers.values():
+                total, errors, slow_fraction = breaker.rates()
+                breakers.append({
+                    'endpoint': breaker.endpoint,
+                    'model': breaker.model,
+                    'state': breaker.state,
+                    'window_requests': total,
+                    'error_rate': round(errors, 3),
+                    'slow_rate': round(slow_fraction, 3),
+                    'open_for_s': round(now - breaker.opened_at, 1) if breaker.opened_at else None,
+                    'last_reason': breaker.last_reason
+                })
+            return {
+                'enabled': self.enabled,
+                'breakers': breakers,
+                'transitions': dict(self.transitions),
+                'rejected': self.rejected
+            }
+
+
+def merge_snapshots(snapshots):
+    """Agrega los circuitos de varios workers (transiciones y rechazos sumados)"""
+    transitions = Counter()
+    rejected = 0
+    states = {}
+    for snapshot in snapshots:
+        transitions.update(snapshot.get('transitions', {}))
+        rejected += snapshot.get('rejected', 0)
+        for breaker in snapshot.get('breakers', []):
+            entry = states.setdefault((breaker['endpoint'], breaker['model']), {
+                'endpoint': breaker['endpoint'],
+                'model': breaker['model'],
+                'workers': Counter()
+            })
+            entry['workers'][breaker['state']] += 1
+    return {
+        'breakers': [dict(entry, workers=dict(entry['workers'])) for entry in states.values()],
+        'transitions': dict(transitions),
+        'rejected': rejected,
+        'workers': len(snapshots)
+    }
@@ -6,11 +6,64 @@ import os
 # Configuración de la base de datos
 DB_PATH = os.getenv('DB_PATH', 'chat.db')
 
+# Escritura agrupada de mensajes (group commit)
+WRITE_BATCH_INTERVAL_MS = int(os.getenv('WRITE_BATCH_INTERVAL_MS', 5))  # Espera máxima antes del commit
+WRITE_BATCH_MAX_ROWS = int(os.getenv('WRITE_BATCH_MAX_ROWS', 100))  # Filas máximas por commit
+WRITE_THREADS = int(os.getenv('WRITE_THREADS', 1))  # Hilos escritores por worker (con fragmentos, varios commits en paralelo)
+WRITER_MAX_OPEN = int(os.getenv('WRITER_MAX_OPEN', 64))  # Conexiones abiertas por hilo escritor (LRU)
+
+# Conversaciones y mensajes: 'single' (todo en DB_PATH) o 'sharded' (un archivo
+# por usuario en SHARD_DIR; DB_PATH guarda usuarios y shard_map). Para pasar
+# una base de datos existente a fragmentos: python split_shards.py
+STORAGE_MODE = os.getenv('STORAGE_MODE', 'single')
+SHARD_DIR = os.getenv('SHARD_DIR', 'shards')
+SHARD_CACHE_SIZE = int(os.getenv('SHARD_CACHE_SIZE', 1024))  # Rutas de fragmento resueltas en memoria
+
+# Importación de conversaciones (/api/import)
+IMPORT_BATCH_ROWS = int(os.getenv('IMPORT_BATCH_ROWS', 1000))  # Filas por transacción
+
 # Configuración de Ollama (más estable que vLLM)
 # Modelos SIN restricciones de seguridad - más permisivos
 OLLAMA_API_URL = os.getenv('OLLAMA_API_URL', 'http://localhost:11434/api/generate')
 OLLAMA_CHAT_URL = os.getenv('OLLAMA_CHAT_URL', 'http://localhost:11434/api/chat')
 
+# Servidor compatible con OpenAI (vLLM, llama.cpp server) para despliegues con mucha concurrencia
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'http://localhost:8000/v1')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+
+# Backends de inferencia disponibles ('ollama' u 'openai')
+INFERENCE_BACKENDS = {
+    'ollama': {'type': 'ollama', 'base_url': OLLAMA_CHAT_URL.rsplit('/api/', 1)[0]},
+    'openai': {'type': 'openai', 'base_url': OPENAI_API_BASE, 'api_key': OPENAI_API_KEY},
+}
+
+# Backend por modelo; los modelos no listados usan DEFAULT_BACKEND
+# Ejemplo: MODEL_BACKENDS=meta-llama/Llama-3.1-8B-Instruct=openai,codellama:7b=ollama
+DEFAULT_BACKEND = os.getenv('DEFAULT_BACKEND', 'ollama')
+MODEL_BACKENDS = dict(
+    item.split('=', 1) for item in os.getenv('MODEL_BACKENDS', '').split(',') if '=' in item
+)
+
+# Pool de endpoints por backend para balancear carga entre varias máquinas
+# Formato: url|modelo1;modelo2 separados por comas (sin modelos = los que tenga descargados)
+# Ejemplo: OLLAMA_ENDPOINTS=http://10.0.0.2:11434|mistral:7b,http://10.0.0.3:11434|mistral:7b;codellama:7b
+INFERENCE_ENDPOINTS = {
+    'ollama': [e for e in os.getenv('OLLAMA_ENDPOINTS', '').split(',') if e.strip()],
+    'openai': [e for e in os.getenv('OPENAI_ENDPOINTS', '').split(',') if e.strip()],
+}
+ENDPOINT_PROBE_INTERVAL = int(os.getenv('ENDPOINT_PROBE_INTERVAL', 10))  # Segundos entre health checks
+ENDPOINT_FAILURE_THRESHOLD = int(os.getenv('ENDPOINT_FAILURE_THRESHOLD', 3))  # Fallos seguidos para expulsar
+
+# Circuit breaker por endpoint y modelo: con el circuito abierto las peticiones fallan al instante
+BREAKER_ENABLED = os.getenv('BREAKER_ENABLED', 'True').lower() == 'true'
+BREAKER_WINDOW_SECONDS = int(os.getenv('BREAKER_WINDOW_SECONDS', 60))  # Ventana de resultados
+BREAKER_MIN_REQUESTS = int(os.getenv('BREAKER_MIN_REQUESTS', 3))  # Peticiones mínimas en la ventana para abrir
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', 0.5))  # Fracción de errores que abre el circuito
+BREAKER_SLOW_MS = int(os.getenv('BREAKER_SLOW_MS', 60000))  # Latencia a partir de la cual una petición es lenta
+BREAKER_SLOW_RATE = float(os.getenv('BREAKER_SLOW_RATE', 0.8))  # Fracción de peticiones lentas que abre el circuito
+BREAKER_OPEN_SECONDS = int(os.getenv('BREAKER_OPEN_SECONDS', 30))  # Segundos abierto antes de probar de nuevo
+BREAKER_HALF_OPEN_REQUESTS = int(os.getenv('BREAKER_HALF_OPEN_REQUESTS', 1))  # Peticiones de prueba simultáneas
+
 # ============================================================================
 # CONFIGURACIÓN DE MODELOS - MEJORES MODELOS SIN RESTRICCIONES
 # ============================================================================
@@ -61,6 +114,13 @@ OLLAMA_CHAT_URL = os.getenv('OLLAMA_CHAT_URL', 'http://localhost:11434/api/chat'
 LLAMA_MODEL = os.getenv('LLAMA_MODEL', 'mistral:7b')  # ~4GB RAM - Muy permisivo y sin restricciones
 DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'codellama:7b')  # ~4GB RAM - Excelente para código
 
+# Enrutado en cascada: turnos simples (saludos, comandos cortos) con un modelo pequeño
+# Si su respuesta no pasa la validación se escala a LLAMA_MODEL
+CASCADE_ENABLED = os.getenv('CASCADE_ENABLED', 'False').lower() == 'true'
+SMALL_MODEL = os.getenv('SMALL_MODEL', 'phi3:mini')  # ~2GB RAM (alternativa: llama3.2:1b ~1GB)
+CASCADE_MAX_CHARS = int(os.getenv('CASCADE_MAX_CHARS', 200))  # Mensajes más largos van al modelo principal
+CASCADE_MAX_HISTORY = int(os.getenv('CASCADE_MAX_HISTORY', 20))  # Conversaciones más largas van al modelo principal
+
 # ALTERNATIVAS si tienes menos RAM:
 # Opción 1: Modelos 7B (balance perfecto, ~8GB RAM total)
 # LLAMA_MODEL = 'mistral:7b'  # ~4GB RAM
@@ -70,11 +130,120 @@ DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'codellama:7b')  # ~4GB RAM - Excel
 # LLAMA_MODEL = 'llama2:13b'  # ~16GB RAM
 # DEEPSEEK_MODEL = 'codellama:13b'  # ~16GB RAM
 
+# Catálogo de modelos candidatos (usado por benchmark_models.py)
+# ram_gb es la estimación de la tabla de arriba; el benchmark mide el valor real
+MODEL_CATALOG = {
+    'mistral:7b': {'ram_gb': 4, 'role': 'general'},
+    'qwen2:7b': {'ram_gb': 4, 'role': 'general'},
+    'llama2:7b': {'ram_gb': 4, 'role': 'general'},
+    'codellama:7b': {'ram_gb': 4, 'role': 'code'},
+    'mixtral:8x7b': {'ram_gb': 12, 'role': 'general'},
+    'qwen2:14b': {'ram_gb': 14, 'role': 'general'},
+    'llama2:13b': {'ram_gb': 16, 'role': 'general'},
+    'codellama:13b': {'ram_gb': 16, 'role': 'code'},
+    'mistral-nemo:12b': {'ram_gb': 12, 'role': 'general'},
+    'phi3:mini': {'ram_gb': 2, 'role': 'general'},
+    'llama3.2:1b': {'ram_gb': 1, 'role': 'general'},
+}
+
+# Perfiles de generación por modelo (se combinan con 'default')
+# - num_thread: threads de CPU (con AUTO_TUNE se calcula al arrancar según cores libres)
+# - num_ctx: contexto mínimo; crece por petición según el prompt hasta max_ctx
+# - num_batch: tamaño de batch al procesar el prompt
+# - num_predict / code_num_predict: límite de tokens en chat / generación de código
+# - keep_alive: tiempo que Ollama mantiene el modelo cargado
+MODEL_PROFILES = {
+    'default': {
+        'num_thread': 2,
+        'num_ctx': 2048,
+        'max_ctx': 8192,
+        'num_batch': 512,
+        'num_predict': 100,  # Respuestas MUY cortas (máximo ~100 tokens)
+        'code_num_predict': 800,  # Código más conciso
+        'keep_alive': '5m'
+    },
+    'mixtral:8x7b': {'max_ctx': 32768, 'keep_alive': '30m'},
+    'codellama:13b': {'max_ctx': 16384},
+    'phi3:mini': {'max_ctx': 4096, 'num_batch': 256},
+    'llama3.2:1b': {'max_ctx': 4096, 'num_batch': 256},
+}
+
+# Auto-ajuste: threads según cores y carga actual, contexto máximo según RAM disponible
+AUTO_TUNE = os.getenv('AUTO_TUNE', 'False').lower() == 'true'
+
+# Caché semántica de respuestas (opcional): reutiliza la respuesta de mensajes parecidos
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'False').lower() == 'true'
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'nomic-embed-text')  # ollama pull nomic-embed-text
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.92))  # Similitud coseno mínima
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', 2000))  # Por idioma y usuario (LRU)
+SEMANTIC_CACHE_PATH = os.getenv('SEMANTIC_CACHE_PATH', 'semantic_cache.npz')
+
+# Modelos que se cargan en memoria al arrancar; /api/ready espera a que estén cargados
+WARMUP_MODELS = [m for m in os.getenv('WARMUP_MODELS', LLAMA_MODEL).split(',') if m]
+
 # Configuración del servidor Flask
 FLASK_HOST = os.getenv('FLASK_HOST', '0.0.0.0')
 FLASK_PORT = int(os.getenv('FLASK_PORT', 5000))
-FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'True').lower() == 'true'
+FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+
+# Modo producción (gunicorn -c gunicorn.conf.py app:app)
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', os.cpu_count() or 1))  # Procesos worker
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', 8))  # Hilos por worker
+SERVER_TIMEOUT = int(os.getenv('SERVER_TIMEOUT', 300))  # Segundos antes de reiniciar un worker bloqueado
+
+# Métricas y caché compartidas entre workers
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', 'shared_state.db')
+METRICS_PUBLISH_INTERVAL = int(os.getenv('METRICS_PUBLISH_INTERVAL', 5))  # Segundos
+
+# Límites por usuario en /api/chat y /api/execute (0 = sin límite)
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')  # 'memory' o 'sqlite' (varios workers)
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', SHARED_STATE_PATH)
+RATE_LIMIT_REQUESTS_PER_MINUTE = int(os.getenv('RATE_LIMIT_REQUESTS_PER_MINUTE', 20))
+RATE_LIMIT_TOKENS_PER_HOUR = int(os.getenv('RATE_LIMIT_TOKENS_PER_HOUR', 50000))  # eval_count de Ollama
+RATE_LIMIT_CONCURRENT = int(os.getenv('RATE_LIMIT_CONCURRENT', 2))  # Chats/scripts simultáneos
+
+# Cancelación: segundos entre comprobaciones de clientes desconectados y cancelaciones de otros workers
+CANCEL_POLL_INTERVAL = float(os.getenv('CANCEL_POLL_INTERVAL', 0.5))
+
+# Peticiones de chat duplicadas: segundos que se guarda una respuesta para reintentos
+SINGLEFLIGHT_RESULT_TTL = int(os.getenv('SINGLEFLIGHT_RESULT_TTL', 30))  # Mismo mensaje y mismo estado
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 600))  # Cabecera Idempotency-Key
+
+# Lotes de prompts de evaluación (POST /api/batch)
+BATCH_MAX_PROMPTS = int(os.getenv('BATCH_MAX_PROMPTS', 1000))  # Prompts por lote
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv('BATCH_DEFAULT_CONCURRENCY', 2))  # Generaciones simultáneas si el lote no lo indica
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', 4))  # Máximo que puede pedir un lote
+
+# Contabilidad de uso (tokens y latencias por usuario y modelo, /api/usage)
+USAGE_ROLLUP_INTERVAL = int(os.getenv('USAGE_ROLLUP_INTERVAL', 60))  # Segundos entre agregaciones (0 = solo bajo demanda)
+ADMIN_USERS = [u for u in os.getenv('ADMIN_USERS', '').split(',') if u]  # Ven el uso de todos los usuarios
+
+# Retención y mantenimiento de chat.db (archivado, incremental_vacuum, ANALYZE, checkpoint del WAL)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))  # Días sin actividad antes de archivar (0 = nunca); cada usuario puede cambiarlo
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', 3600))  # Segundos entre rondas (0 = solo bajo demanda)
+MAINTENANCE_BATCH = int(os.getenv('MAINTENANCE_BATCH', 20))  # Conversaciones archivadas por lote
+MAINTENANCE_VACUUM_PAGES = int(os.getenv('MAINTENANCE_VACUUM_PAGES', 256))  # Páginas por paso de incremental_vacuum
+MAINTENANCE_PAUSE_MS = int(os.getenv('MAINTENANCE_PAUSE_MS', 50))  # Pausa entre lotes y pasos
+
+# Compresión de respuestas (brotli si el paquete está instalado, si no gzip)
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))  # Tamaño mínimo para comprimir (0 = desactivada)
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))  # Nivel de gzip (1-9)
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))  # Calidad de brotli (0-11)
+
+# Perfilado de peticiones (cabecera X-Profile: 1 de un administrador, o muestreo)
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))  # Fracción de peticiones perfiladas (0 = ninguna)
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 5))  # Milisegundos entre muestras
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 200))  # Perfiles que se conservan
 
 # Configuración de logging
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
-LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')  # '{pid}' = un archivo por proceso (vacío = solo consola; con varios workers de gunicorn: app-{pid}.log)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # 'json' (JSON lines) o 'text'
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))  # Rotación por tamaño (0 = desactivada)
+LOG_ROTATE_SECONDS = int(os.getenv('LOG_ROTATE_SECONDS', 86400))  # Rotación por tiempo (0 = desactivada)
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 10))  # Archivos rotados (.gz) que se conservan
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 0.1))  # Fracción de peticiones con registros DEBUG
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))  # Registros en cola antes de descartar
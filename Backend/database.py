@@ -0,0 +1,394 @@
+"""
+Esquema de la base de datos SQLite
+
+init_db() no depende de app.py para que el proceso maestro de gunicorn pueda
+inicializar la base de datos una sola vez antes de crear los workers.
+
+Las conexiones de la aplicación se abren con connect(), que activa las claves
+foráneas: al borrar una conversación sus mensajes se borran en cascada.
+
+Con STORAGE_MODE=sharded la base de datos global (DB_PATH) solo guarda
+usuarios, el mapa de fragmentos y los agregados; las conversaciones y los
+mensajes de cada usuario están en su propio fragmento (ver storage.py), que
+se crea y migra con init_shard().
+"""
+import logging
+import sqlite3
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Columnas de uso de messages (solo en respuestas del asistente)
+USAGE_COLUMNS = [
+    ('model', 'TEXT'),
+    ('prompt_tokens', 'INTEGER'),
+    ('eval_tokens', 'INTEGER'),
+    ('load_ms', 'REAL'),
+    ('prompt_eval_ms', 'REAL'),
+    ('eval_ms', 'REAL'),
+    ('latency_ms', 'REAL'),
+    ('failed', 'INTEGER'),  # 1 = la generación falló (cuenta como error, no como uso)
+]
+
+# Caracteres del último mensaje que se guardan en conversations.last_preview
+PREVIEW_CHARS = 120
+
+# Resumen de cada conversación (message_count, last_message_id, last_preview)
+# mantenido por triggers: la aplicación no actualiza conversations al guardar
+# mensajes. updated_at avanza con created_at del mensaje (una importación
+# conserva la fecha original).
+SUMMARY_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS messages_summary_insert AFTER INSERT ON messages
+    BEGIN
+        UPDATE conversations SET
+            message_count = message_count + 1,
+            last_message_id = NEW.id,
+            last_preview = replace(substr(NEW.content, 1, {PREVIEW_CHARS}), char(10), ' '),
+            updated_at = MAX(COALESCE(updated_at, NEW.created_at), NEW.created_at)
+        WHERE id = NEW.conversation_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS messages_summary_delete AFTER DELETE ON messages
+    BEGIN
+        UPDATE conversations SET
+            message_count = message_count - 1,
+            last_preview = CASE WHEN last_message_id = OLD.id THEN (
+                SELECT replace(substr(content, 1, {PREVIEW_CHARS}), char(10), ' ') FROM messages
+                WHERE conversation_id = OLD.conversation_id ORDER BY id DESC LIMIT 1
+            ) ELSE last_preview END,
+            last_message_id = CASE WHEN last_message_id = OLD.id THEN (
+                SELECT MAX(id) FROM messages WHERE conversation_id = OLD.conversation_id
+            ) ELSE last_message_id END
+        WHERE id = OLD.conversation_id;
+    END
+    ''',
+]
+
+# conversation_versions.version cambia con cualquier cambio en las
+# conversaciones del usuario (incluido el resumen): es el ETag de la lista
+VERSION_TRIGGERS = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS conversation_versions_{event.lower()} AFTER {event} ON conversations
+    BEGIN
+        INSERT INTO conversation_versions (user_id, version) VALUES ({row}.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+    END
+    '''
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))
+]
+
+# Versión del esquema de los fragmentos (PRAGMA user_version); al cambiar el
+# esquema de conversaciones se incrementa y cada fragmento se migra al abrirlo
+SHARD_SCHEMA_VERSION = 1
+
+# Tabla de mensajes ({name} permite reconstruirla al migrar)
+MESSAGES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id INTEGER,
+        role TEXT,
+        content TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        model TEXT,
+        prompt_tokens INTEGER,
+        eval_tokens INTEGER,
+        load_ms REAL,
+        prompt_eval_ms REAL,
+        eval_ms REAL,
+        latency_ms REAL,
+        failed INTEGER,
+        FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+    )
+'''
+
+
+def connect(db_path=None, timeout=30):
+    """Conexión a la base de datos con claves foráneas activadas (borrado en cascada)"""
+    conn = sqlite3.connect(db_path or config.DB_PATH, timeout=timeout)
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+
+def _rebuild_messages_with_cascade(conn):
+    """
+    Reconstruye messages con ON DELETE CASCADE (SQLite no permite cambiar una
+    clave foránea con ALTER TABLE). Se conserva el contador de ids para que la
+    marca de agua de usage_rollup_state siga siendo válida.
+    """
+    cursor = conn.cursor()
+    columns = ', '.join(row[1] for row in cursor.execute('PRAGMA table_info(messages)'))
+    row = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()
+    sequence = row[0] if row else 0
+    logger.info("Migrando messages a ON DELETE CASCADE...")
+    cursor.execute('BEGIN')
+    try:
+        # Mensajes de conversaciones ya borradas (la clave foránea nunca se aplicó)
+        cursor.execute('DELETE FROM messages WHERE conversation_id NOT IN (SELECT id FROM conversations)')
+        cursor.execute(MESSAGES_TABLE.format(name='messages_new'))
+        cursor.execute(f'INSERT INTO messages_new ({columns}) SELECT {columns} FROM messages')
+        cursor.execute('DROP TABLE messages')
+        cursor.execute('ALTER TABLE messages_new RENAME TO messages')
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'messages'", (sequence,))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+def _drop_legacy_version_triggers(cursor):
+    """Triggers de la versión anterior del ETag (columna users.conversations_version)"""
+    for event in ('insert', 'update', 'delete'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS conversations_version_{event}')
+
+
+def _init_conversation_schema(conn, users_fk=True):
+    """
+    Tablas conversations y messages con sus migraciones, triggers e índices
+    
+    Args:
+        users_fk: Clave foránea de conversations a users (no en los
+            fragmentos, que no tienen tabla users)
+    """
+    cursor = conn.cursor()
+    
+    # Tabla de conversaciones (ahora con user_id)
+    users_reference = ',\n            FOREIGN KEY (user_id) REFERENCES users(id)' if users_fk else ''
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP{users_reference}
+        )
+    ''')
+    
+    # Tabla de mensajes
+    cursor.execute(MESSAGES_TABLE.format(name='messages'))
+    
+    # Migración: métricas de uso de las respuestas del asistente
+    for column, column_type in USAGE_COLUMNS:
+        try:
+            cursor.execute(f'ALTER TABLE messages ADD COLUMN {column} {column_type}')
+        except sqlite3.OperationalError:
+            pass  # La columna ya existe
+    
+    # Migración: borrado en cascada de los mensajes al borrar su conversación
+    conn.commit()
+    foreign_keys = cursor.execute('PRAGMA foreign_key_list(messages)').fetchall()
+    if not any(fk[2] == 'conversations' and fk[6] == 'CASCADE' for fk in foreign_keys):
+        _rebuild_messages_with_cascade(conn)
+    
+    # Migración: resumen de la conversación para la barra lateral
+    summary_added = False
+    for column, column_type in [('message_count', 'INTEGER NOT NULL DEFAULT 0'),
+                                ('last_message_id', 'INTEGER'),
+                                ('last_preview', 'TEXT')]:
+        try:
+            cursor.execute(f'ALTER TABLE conversations ADD COLUMN {column} {column_type}')
+            summary_added = True
+        except sqlite3.OperationalError:
+            pass  # La columna ya existe
+    if summary_added:
+        logger.info("Calculando el resumen de las conversaciones existentes...")
+        cursor.execute(f'''
+            UPDATE conversations SET
+                message_count = (SELECT COUNT(*) FROM messages WHERE conversation_id = conversations.id),
+                last_message_id = (SELECT MAX(id) FROM messages WHERE conversation_id = conversations.id),
+                last_preview = (
+                    SELECT replace(substr(content, 1, {PREVIEW_CHARS}), char(10), ' ') FROM messages
+                    WHERE conversation_id = conversations.id ORDER BY id DESC LIMIT 1
+                )
+        ''')
+    for trigger in SUMMARY_TRIGGERS:
+        cursor.execute(trigger)
+    
+    # Versión de la lista de conversaciones de cada usuario (ETag)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    _drop_legacy_version_triggers(cursor)
+    for trigger in VERSION_TRIGGERS:
+        cursor.execute(trigger)
+    
+    # Último mensaje agregado (marca de agua del rollup, junto a los mensajes)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_rollup_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_message_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO usage_rollup_state (id, last_message_id) VALUES (1, 0)')
+    
+    # Índice para leer los mensajes de una conversación por páginas
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages(conversation_id, id)')
+    
+    # Índice para buscar conversaciones inactivas (archivado)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at)')
+    
+    # Índice para la lista de conversaciones de un usuario (más recientes primero)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_user_updated ON conversations(user_id, updated_at DESC)')
+    
+    conn.commit()
+
+
+def _enable_incremental_vacuum(conn):
+    """
+    auto_vacuum incremental: el mantenimiento devuelve el espacio libre por
+    partes. Activarlo en una base de datos existente requiere un VACUUM completo (una sola vez).
+    """
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.info("Activando auto_vacuum incremental (VACUUM completo, solo la primera vez)...")
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+
+def init_db(db_path=None, with_conversations=None):
+    """
+    Inicializa la base de datos SQLite (tablas, migraciones e índices)
+    
+    Args:
+        with_conversations: Crear también conversations y messages (por
+            defecto, salvo con STORAGE_MODE=sharded)
+    """
+    if with_conversations is None:
+        with_conversations = config.STORAGE_MODE != 'sharded'
+    conn = sqlite3.connect(db_path or config.DB_PATH)
+    cursor = conn.cursor()
+    
+    # Tabla de usuarios
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            language TEXT DEFAULT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Migración: agregar columna language si no existe
+    try:
+        cursor.execute('ALTER TABLE users ADD COLUMN language TEXT DEFAULT NULL')
+    except sqlite3.OperationalError:
+        pass  # La columna ya existe
+    
+    # Migración: días de inactividad tras los que se archivan las conversaciones del usuario
+    try:
+        cursor.execute('ALTER TABLE users ADD COLUMN retention_days INTEGER DEFAULT NULL')
+    except sqlite3.OperationalError:
+        pass  # La columna ya existe
+    
+    if with_conversations:
+        _init_conversation_schema(conn)
+    
+    # Migración: la versión de la lista de conversaciones pasa de la columna
+    # users.conversations_version a la tabla conversation_versions. Los triggers
+    # que la incrementan están en conversations, y con fragmentos esa tabla vive
+    # en el archivo del usuario, donde no hay tabla users: la versión tiene que
+    # estar junto a las conversaciones (en chat.db o en cada fragmento)
+    _drop_legacy_version_triggers(cursor)
+    if any(column[1] == 'conversations_version' for column in cursor.execute('PRAGMA table_info(users)')):
+        if with_conversations:
+            # Se conserva la versión para no repetir un ETag ya emitido
+            cursor.execute('''
+                INSERT OR REPLACE INTO conversation_versions (user_id, version)
+                SELECT id, conversations_version FROM users
+            ''')
+        cursor.execute('ALTER TABLE users DROP COLUMN conversations_version')
+    
+    # Conversaciones archivadas (el contenido está en ARCHIVE_DIR, ver maintenance.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            title TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            path TEXT NOT NULL,
+            last_activity TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_conversations_user ON archived_conversations(user_id)')
+    
+    # Uso agregado por hora, usuario y modelo (lo rellena usage.UsageRollup)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_hourly (
+            hour TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            eval_tokens INTEGER NOT NULL DEFAULT 0,
+            load_ms REAL NOT NULL DEFAULT 0,
+            prompt_eval_ms REAL NOT NULL DEFAULT 0,
+            eval_ms REAL NOT NULL DEFAULT 0,
+            latency_ms REAL NOT NULL DEFAULT 0,
+            max_latency_ms REAL NOT NULL DEFAULT 0,
+            errors INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, user_id, model)
+        )
+    ''')
+    try:
+        cursor.execute('ALTER TABLE usage_hourly ADD COLUMN errors INTEGER NOT NULL DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass  # La columna ya existe
+    
+    # Fragmento de cada usuario (STORAGE_MODE=sharded; ruta relativa a SHARD_DIR)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_map (
+            user_id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    conn.commit()
+    _enable_incremental_vacuum(conn)
+    conn.close()
+    logger.info("Base de datos inicializada")
+
+
+def shard_version(path):
+    """Versión del esquema de un fragmento (0 si no existe)"""
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+    except sqlite3.OperationalError:
+        return 0
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def init_shard(path):
+    """
+    Crea o migra el fragmento de un usuario (conversations y messages)
+    
+    Llamar con el cerrojo de escritura de la base de datos global tomado
+    (storage.Storage lo hace) para que dos workers no migren a la vez.
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SHARD_SCHEMA_VERSION:
+            return
+        if version == 0:
+            # Archivo nuevo: auto_vacuum debe fijarse antes de crear tablas
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+        _init_conversation_schema(conn, users_fk=False)
+        _enable_incremental_vacuum(conn)
+        conn.execute(f'PRAGMA user_version = {SHARD_SCHEMA_VERSION}')
+        logger.info(f"Fragmento {path} en la versión {SHARD_SCHEMA_VERSION}")
+    finally:
+        conn.close()
@@ -0,0 +1,313 @@
+"""
+Pool de endpoints de inferencia con balanceo de carga y health checks
+
+Cada endpoint es un servidor (Ollama u OpenAI-compatible) etiquetado con los
+modelos que sirve. Las peticiones se enrutan al endpoint sano con menos
+peticiones en curso, prefiriendo los que ya tienen el modelo en memoria
+(afinidad) para evitar recargas. Un hilo en segundo plano sondea los endpoints:
+expulsa los que no responden y los readmite cuando vuelven. Además, un circuit
+breaker por endpoint y modelo (circuit_breaker.py) deja de enviar peticiones a
+un par que falla o va lento y hace que fallen al instante.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from circuit_breaker import CircuitBreakers
+from inference_backends import BackendError, create_backend
+
+logger = logging.getLogger(__name__)
+
+
+class NoEndpointAvailable(Exception):
+    """No hay ningún endpoint sano que sirva el modelo"""
+
+
+class CircuitOpen(NoEndpointAvailable):
+    """Los endpoints del modelo tienen el circuito abierto"""
+
+    def __init__(self, message, model, retry_after):
+        super().__init__(message)
+        self.model = model
+        self.retry_after = retry_after
+
+
+def parse_endpoint(spec, backend_type):
+    """
+    Convierte 'url|modelo1;modelo2' en un dict de endpoint
+
+    Sin lista de modelos, el endpoint sirve cualquier modelo que tenga descargado.
+    """
+    if isinstance(spec, dict):
+        return spec
+    url, _, models = spec.partition('|')
+    return {
+        'type': backend_type,
+        'base_url': url.strip(),
+        'models': [m.strip() for m in models.split(';') if m.strip()]
+    }
+
+
+class Endpoint:
+    def __init__(self, backend, models=None, name=None):
+        self.backend = backend
+        self.name = name or backend.base_url
+        self.models = set(models or [])  # Modelos configurados (vacío = cualquiera)
+        self.available_models = None  # Modelos descargados según el último sondeo
+        self.resident_models = set()  # Modelos cargados en memoria
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.last_latency = None
+        self.last_error = None
+        self.last_probe = None
+
+    def serves(self, model):
+        if self.models:
+            return model in self.models
+        return self.available_models is None or model in self.available_models
+
+    @property
+    def avg_latency(self):
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'type': self.backend.kind,
+            'healthy': self.healthy,
+            'models': sorted(self.models) or self.available_models,
+            'resident_models': sorted(self.resident_models),
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'avg_latency_ms': round(self.avg_latency * 1000, 1),
+            'last_latency_ms': round(self.last_latency * 1000, 1) if self.last_latency is not None else None,
+            'last_error': self.last_error,
+            'last_probe': self.last_probe
+        }
+
+
+class EndpointPool:
+    def __init__(self, endpoints, probe_interval=10, failure_threshold=3, affinity_slack=2, breakers=None):
+        """
+        Args:
+            endpoints: Lista de Endpoint
+            probe_interval: Segundos entre sondeos de salud
+            failure_threshold: Fallos seguidos que expulsan un endpoint
+            affinity_slack: Peticiones en curso extra que se toleran para
+                mantener la afinidad con un endpoint que ya tiene el modelo
+            breakers: CircuitBreakers (compartido entre pools; por defecto desactivado)
+        """
+        self.endpoints = list(endpoints)
+        self.probe_interval = probe_interval
+        self.failure_threshold = failure_threshold
+        self.affinity_slack = affinity_slack
+        self.breakers = breakers or CircuitBreakers(enabled=False)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_specs(cls, specs, **kwargs):
+        """Crea el pool a partir de dicts {'type', 'base_url', 'models', 'api_key'}"""
+        return cls([Endpoint(create_backend(spec), spec.get('models')) for spec in specs], **kwargs)
+
+    def start(self):
+        """Inicia el hilo de sondeo de salud"""
+        if self._thread is None and self.probe_interval:
+            self._thread = threading.Thread(target=self._probe_loop, name='endpoint-probe', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def select(self, model):
+        """
+        Elige endpoint: afinidad de modelo y, después, menos peticiones en curso
+
+        Raises:
+            NoEndpointAvailable si no hay endpoints sanos, CircuitOpen si todos
+            tienen el circuito abierto para el modelo
+        """
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.healthy and e.serves(model)]
+            if not candidates:
+                raise NoEndpointAvailable(f"No hay endpoints disponibles para {model}")
+            blocked = []
+            while candidates:
+                chosen = self._preferred(candidates, model)
+                if self.breakers.allow(chosen.name, model):
+                    break
+                candidates.remove(chosen)
+                blocked.append(chosen)
+            else:
+                self.breakers.reject()
+                retry_after = min(self.breakers.retry_after(e.name, model) for e in blocked)
+                raise CircuitOpen(
+                    f"Circuito abierto para {model}: el servidor de inferencia falla o no responde",
+                    model, retry_after
+                )
+            chosen.outstanding += 1
+            # El modelo quedará cargado en el endpoint elegido
+            chosen.resident_models.add(model)
+            return chosen
+
+    def _preferred(self, candidates, model):
+        least_loaded = min(candidates, key=lambda e: (e.outstanding, e.avg_latency))
+        resident = [e for e in candidates if model in e.resident_models]
+        if resident:
+            best_resident = min(resident, key=lambda e: (e.outstanding, e.avg_latency))
+            if best_resident.outstanding <= least_loaded.outstanding + self.affinity_slack:
+                return best_resident
+        return least_loaded
+
+    @contextmanager
+    def acquire(self, model):
+        """Reserva un endpoint para una petición y registra latencia y errores"""
+        endpoint = self.select(model)
+        start = time.monotonic()
+        error = None
+        aborted = False
+        try:
+            yield endpoint
+        except (requests.exceptions.RequestException, BackendError) as e:
+            error = e
+            raise
+        except BaseException:
+            # Cancelada o streaming abandonado: no dice nada del endpoint
+            aborted = True
+            raise
+        finally:
+            # También se libera si el consumidor abandona un streaming
+            self._record(endpoint, model, time.monotonic() - start, error, aborted)
+
+    def _record(self, endpoint, model, latency, error, aborted=False):
+        # Los 4xx son errores de la petición, no del servidor
+        server_error = error is not None and not (isinstance(error, BackendError) and error.status_code < 500)
+        if aborted:
+            self.breakers.release(endpoint.name, model)
+        else:
+            self.breakers.record(endpoint.name, model, latency, error=server_error)
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.total_latency += latency
+            endpoint.last_latency = latency
+            if error is None:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.errors += 1
+            endpoint.last_error = str(error)
+            if not server_error:
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.healthy and endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.healthy = False
+                logger.warning(f"Endpoint {endpoint.name} expulsado tras {endpoint.consecutive_failures} fallos: {error}")
+
+    def probe(self, endpoint):
+        """Sondea un endpoint y actualiza su estado y modelos"""
+        try:
+            available = endpoint.backend.list_models()
+            resident = endpoint.backend.list_running_models()
+        except (requests.exceptions.RequestException, BackendError, ValueError) as e:
+            with self._lock:
+                endpoint.last_probe = time.time()
+                endpoint.last_error = str(e)
+                if endpoint.healthy:
+                    endpoint.healthy = False
+                    logger.warning(f"Endpoint {endpoint.name} expulsado: no responde al sondeo ({e})")
+            return False
+        with self._lock:
+            endpoint.last_probe = time.time()
+            endpoint.available_models = available
+            endpoint.resident_models = set(resident)
+            endpoint.consecutive_failures = 0
+            if not endpoint.healthy:
+                endpoint.healthy = True
+                logger.info(f"Endpoint {endpoint.name} readmitido")
+        return True
+
+    def probe_all(self):
+        for endpoint in self.endpoints:
+            self.probe(endpoint)
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.probe_interval)
+
+    def is_healthy(self):
+        return any(e.healthy for e in self.endpoints)
+
+    def is_reachable(self):
+        """True si algún endpoint respondió al último sondeo (no solo se asume sano)"""
+        return any(e.healthy and e.last_probe is not None for e in self.endpoints)
+
+    def has_model(self, model, resident=False):
+        """True si algún endpoint sano tiene el modelo descargado (o cargado en memoria)"""
+        for endpoint in self.endpoints:
+            if not endpoint.healthy or endpoint.last_probe is None:
+                continue
+            models = endpoint.resident_models if resident else (endpoint.available_models or [])
+            if model in models or f"{model}:latest" in models:
+                return True
+        return False
+
+    def serving(self, model):
+        """Endpoints (sanos o no) que sirven un modelo"""
+        return [e for e in self.endpoints if e.serves(model)]
+
+    def stats(self):
+        with self._lock:
+            return [e.stats() for e in self.endpoints]
+
+
+def merge_stats(snapshots):
+    """
+    Agrega las estadísticas de los pools de varios workers
+
+    Args:
+        snapshots: Resultados de LLMClient.endpoint_stats(), uno por worker
+
+    Returns:
+        El mismo formato ({backend: [stats]}) con los contadores sumados, la
+        latencia media ponderada por peticiones y cuántos workers ven sano cada endpoint
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for backend, endpoints in snapshot.items():
+            by_name = merged.setdefault(backend, {})
+            for stats in endpoints:
+                current = by_name.get(stats['name'])
+                if current is None:
+                    current = dict(stats, outstanding=0, requests=0, errors=0,
+                                   workers=0, healthy_workers=0, resident_models=set(),
+                                   _latency_total=0.0)
+                    by_name[stats['name']] = current
+                current['workers'] += 1
+                current['healthy_workers'] += 1 if stats['healthy'] else 0
+                current['healthy'] = current['healthy_workers'] > 0
+                for key in ('outstanding', 'requests', 'errors'):
+                    current[key] += stats[key]
+                current['_latency_total'] += stats['avg_latency_ms'] * stats['requests']
+                current['resident_models'].update(stats['resident_models'])
+                if (stats['last_probe'] or 0) > (current['last_probe'] or 0):
+                    current.update(last_probe=stats['last_probe'], last_error=stats['last_error'],
+                                   last_latency_ms=stats['last_latency_ms'])
+    result = {}
+    for backend, by_name in merged.items():
+        result[backend] = []
+        for current in by_name.values():
+            latency_total = current.pop('_latency_total')
+            current['avg_latency_ms'] = round(latency_total / current['requests'], 1) if current['requests'] else 0.0
+            current['resident_models'] = sorted(current['resident_models'])
+            result[backend].append(current)
+    return result
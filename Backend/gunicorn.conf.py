@@ -0,0 +1,60 @@
+"""
+Configuración de gunicorn para el modo producción
+
+Uso:
+    gunicorn -c gunicorn.conf.py app:app
+
+El maestro inicializa la base de datos una vez y crea los workers con fork.
+La aplicación no se precarga (preload_app = False): cada worker importa app.py
+después del fork y crea su propio LLMClient, pools de endpoints (con sus hilos
+de sondeo) y escritor de mensajes, en lugar de heredar hilos y conexiones
+SQLite del maestro, que no sobreviven a un fork. Las métricas se agregan entre
+workers con shared_state.
+"""
+# Cada nombre de este archivo es un ajuste de gunicorn ("config" también lo es)
+import os
+
+import config as app_config
+from database import init_db
+from logging_setup import per_process_log_file
+
+bind = f"{app_config.FLASK_HOST}:{app_config.FLASK_PORT}"
+workers = app_config.SERVER_WORKERS
+threads = app_config.SERVER_THREADS
+worker_class = 'gthread'
+# Las generaciones largas pueden tardar más que el timeout por defecto (30s)
+timeout = app_config.SERVER_TIMEOUT
+graceful_timeout = 30
+preload_app = False
+accesslog = '-'
+loglevel = app_config.LOG_LEVEL.lower()
+
+
+def on_starting(server):
+    """En el maestro, antes de crear los workers"""
+    if server.cfg.workers > 1 and 'LOG_FILE' not in os.environ:
+        # Cada worker rota y comprime su propio archivo de log (se pasa también
+        # por el entorno por si un worker vuelve a cargar config)
+        os.environ['LOG_FILE'] = app_config.LOG_FILE = per_process_log_file(app_config.LOG_FILE)
+    elif server.cfg.workers > 1 and app_config.LOG_FILE and '{pid}' not in app_config.LOG_FILE:
+        server.log.warning(
+            f"LOG_FILE={app_config.LOG_FILE} es el mismo para {server.cfg.workers} workers: "
+            f"las rotaciones se pisan y se pierden registros. Use '{{pid}}' en el nombre "
+            f"(p. ej. {per_process_log_file(app_config.LOG_FILE)})"
+        )
+    init_db()
+
+
+def post_worker_init(worker):
+    """En cada worker, con app.py ya importado"""
+    from app import warm_up_models
+    warm_up_models()
+
+
+def worker_exit(server, worker):
+    """Confirma los mensajes pendientes antes de que el worker termine"""
+    from app import message_writer, metrics_publisher
+    from logging_setup import stop_logging
+    metrics_publisher.stop()
+    message_writer.close()
+    stop_logging()
@@ -0,0 +1,78 @@
+"""
+Compresión de respuestas y GET condicional (ETag / If-None-Match)
+
+- Las respuestas JSON o de texto por encima de un umbral se comprimen con
+  brotli (si el paquete está instalado y el cliente lo acepta) o con gzip.
+- Los endpoints de historial calculan un ETag débil a partir de datos que ya
+  mantienen los triggers (conversations.last_message_id / message_count,
+  conversation_versions.version). Si coincide con If-None-Match responden 304
+  sin leer los mensajes. El ETag incluye el id del usuario (con fragmentos,
+  los ids de conversación y mensaje se repiten entre usuarios) y la respuesta
+  lleva Vary: Authorization, así que un navegador compartido por dos cuentas
+  no revalida los datos de una con los de la otra.
+
+El ETag es el mismo para todas las codificaciones (Vary: Accept-Encoding):
+identifica la representación JSON antes de comprimir. Por eso es débil
+(W/"..."): un validador fuerte tendría que ser distinto para la respuesta sin
+comprimir, la gzip y la brotli. If-None-Match usa la comparación débil.
+"""
+import gzip
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # Opcional: sin brotli se usa gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/html', 'text/css', 'application/javascript')
+
+# Las respuestas con ETag se revalidan siempre, pero se pueden guardar (solo el navegador)
+CACHE_CONTROL = 'private, no-cache'
+
+
+def not_modified(etag):
+    """Respuesta 304 si el cliente ya tiene esta versión, o None"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    return with_etag(response, etag)
+
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    response.vary.add('Authorization')
+    return response
+
+
+def compress_response(response, min_bytes=1024, gzip_level=6, brotli_quality=5):
+    """Comprime el cuerpo si el cliente lo acepta y merece la pena"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    data = response.get_data()
+    if len(data) < min_bytes:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding = 'br'
+        compressed = brotli.compress(data, quality=brotli_quality)
+    elif accepted['gzip']:
+        encoding = 'gzip'
+        compressed = gzip.compress(data, compresslevel=gzip_level)
+    else:
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,352 @@
+"""
+Backends de inferencia para LLMClient
+
+- OllamaBackend: API nativa de Ollama (/api/chat, /api/tags, /api/ps)
+- OpenAICompatibleBackend: API compatible con OpenAI (/v1/chat/completions),
+  servida por vLLM o llama.cpp server, con batching continuo
+
+Todos los backends devuelven el mismo formato normalizado para que LLMClient
+no dependa de la forma del JSON de cada servidor.
+"""
+import json
+import logging
+import requests
+
+from cancellation import bind, cancellable_session
+
+logger = logging.getLogger(__name__)
+
+# Opciones de Ollama -> parámetros de la API de OpenAI
+# Las opciones que solo tienen sentido en Ollama (num_ctx, num_thread...) se descartan
+OPENAI_OPTION_MAP = {
+    'num_predict': 'max_tokens',
+    'temperature': 'temperature',
+    'top_p': 'top_p',
+    'top_k': 'top_k',  # Extensión soportada por vLLM y llama.cpp
+    'typical_p': 'typical_p',
+    'repeat_penalty': 'repetition_penalty',  # Nombre usado por vLLM
+    'seed': 'seed',
+    'stop': 'stop',
+}
+
+
+class BackendError(Exception):
+    """Respuesta de error (no 200) del servidor de inferencia"""
+
+    def __init__(self, status_code, text):
+        super().__init__(f"{status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+def empty_usage():
+    """Métricas normalizadas de una generación"""
+    return {
+        'prompt_tokens': 0,
+        'eval_tokens': 0,
+        'load_duration_ms': None,
+        'prompt_eval_duration_ms': None,
+        'eval_duration_ms': None
+    }
+
+
+class InferenceBackend:
+    """Interfaz común de los backends de inferencia"""
+
+    kind = None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        # Conexiones reutilizables que se cierran al cancelar la petición (cancellation.bind)
+        self.session = cancellable_session()
+
+    def chat(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        """
+        Genera una respuesta completa
+
+        keep_alive solo lo usa Ollama (tiempo que mantiene el modelo cargado).
+        cancel (CancelToken) cierra la conexión si la petición se cancela.
+
+        Returns:
+            dict con 'content' y 'usage' (ver empty_usage)
+
+        Raises:
+            BackendError si el servidor responde con error
+            requests.exceptions.RequestException si falla la conexión
+        """
+        raise NotImplementedError
+
+    def chat_stream(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        """
+        Genera una respuesta en streaming
+
+        Yields:
+            dict con 'content' (fragmento) y 'done'; el último trae 'usage'
+        """
+        raise NotImplementedError
+
+    def embed(self, model, text, timeout=30):
+        """
+        Vector de embedding de un texto
+
+        Returns:
+            lista de floats
+        """
+        raise NotImplementedError
+
+    def list_models(self, timeout=5):
+        """Modelos disponibles en el servidor"""
+        raise NotImplementedError
+
+    def list_running_models(self, timeout=5):
+        """Modelos cargados en memoria en este momento"""
+        return self.list_models(timeout)
+
+    def health_check(self, timeout=5):
+        """True si el servidor responde"""
+        try:
+            self.list_models(timeout)
+            return True
+        except (requests.exceptions.RequestException, BackendError, ValueError):
+            return False
+
+    def load_model(self, model, keep_alive=None, timeout=600):
+        """Carga un modelo en memoria sin generar nada (si el servidor lo permite)"""
+
+    def unload_model(self, model):
+        """Libera un modelo de la memoria (si el servidor lo permite)"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.base_url})"
+
+
+class OllamaBackend(InferenceBackend):
+    kind = 'ollama'
+
+    def _payload(self, model, messages, system_prompt, options, stream, keep_alive=None):
+        payload = {
+            "model": model,
+            "messages": messages,
+            "system": system_prompt,
+            "stream": stream,
+            "options": options or {}
+        }
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        return payload
+
+    @staticmethod
+    def _usage(result):
+        usage = empty_usage()
+        usage['prompt_tokens'] = result.get('prompt_eval_count', 0)
+        usage['eval_tokens'] = result.get('eval_count', 0)
+        for key in ('load_duration', 'prompt_eval_duration', 'eval_duration'):
+            if result.get(key) is not None:
+                usage[f'{key}_ms'] = result[key] / 1e6
+        return usage
+
+    def chat(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        with bind(cancel):
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json=self._payload(model, messages, system_prompt, options, False, keep_alive),
+                timeout=timeout
+            )
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        result = response.json()
+        return {
+            'content': result.get('message', {}).get('content', ''),
+            'usage': self._usage(result)
+        }
+
+    def chat_stream(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        # El token solo se asocia mientras se abre la conexión (el generador se suspende entre fragmentos)
+        with bind(cancel):
+            response = self.session.post(
+                f"{self.base_url}/api/chat",
+                json=self._payload(model, messages, system_prompt, options, True, keep_alive),
+                stream=True,
+                timeout=timeout
+            )
+        with response:
+            if response.status_code != 200:
+                raise BackendError(response.status_code, response.text)
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get('error'):
+                    raise BackendError(500, chunk['error'])
+                done = bool(chunk.get('done'))
+                yield {
+                    'content': chunk.get('message', {}).get('content', ''),
+                    'done': done,
+                    'usage': self._usage(chunk) if done else None
+                }
+                if done:
+                    break
+
+    def embed(self, model, text, timeout=30):
+        response = self.session.post(
+            f"{self.base_url}/api/embeddings",
+            json={"model": model, "prompt": text},
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        return response.json().get('embedding') or []
+
+    def list_models(self, timeout=5):
+        response = self.session.get(f"{self.base_url}/api/tags", timeout=timeout)
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        return [m.get('name') for m in response.json().get('models', [])]
+
+    def list_running_models(self, timeout=5):
+        response = self.session.get(f"{self.base_url}/api/ps", timeout=timeout)
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        return [m.get('name') for m in response.json().get('models', [])]
+
+    def load_model(self, model, keep_alive=None, timeout=600):
+        # Un generate sin prompt carga el modelo y responde cuando está listo
+        payload = {"model": model}
+        if keep_alive is not None:
+            payload["keep_alive"] = keep_alive
+        response = self.session.post(f"{self.base_url}/api/generate", json=payload, timeout=timeout)
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+
+    def unload_model(self, model):
+        try:
+            self.session.post(f"{self.base_url}/api/generate", json={"model": model, "keep_alive": 0}, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"No se pudo descargar el modelo {model}: {str(e)}")
+
+
+class OpenAICompatibleBackend(InferenceBackend):
+    kind = 'openai'
+
+    def __init__(self, base_url, api_key=None):
+        super().__init__(base_url)
+        self.api_key = api_key
+
+    def _headers(self):
+        if self.api_key:
+            return {'Authorization': f'Bearer {self.api_key}'}
+        return {}
+
+    @staticmethod
+    def map_options(options):
+        """Traduce las opciones de Ollama a parámetros de OpenAI"""
+        params = {}
+        for key, value in (options or {}).items():
+            if key in OPENAI_OPTION_MAP:
+                params[OPENAI_OPTION_MAP[key]] = value
+        return params
+
+    def _payload(self, model, messages, system_prompt, options, stream):
+        # OpenAI no tiene campo "system": va como primer mensaje
+        chat_messages = list(messages)
+        if system_prompt:
+            chat_messages.insert(0, {"role": "system", "content": system_prompt})
+        payload = {"model": model, "messages": chat_messages, "stream": stream}
+        payload.update(self.map_options(options))
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    @staticmethod
+    def _usage(result):
+        usage = empty_usage()
+        data = result.get('usage') or {}
+        usage['prompt_tokens'] = data.get('prompt_tokens', 0)
+        usage['eval_tokens'] = data.get('completion_tokens', 0)
+        return usage
+
+    def chat(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        with bind(cancel):
+            response = self.session.post(
+                f"{self.base_url}/chat/completions",
+                json=self._payload(model, messages, system_prompt, options, False),
+                headers=self._headers(),
+                timeout=timeout
+            )
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        result = response.json()
+        choices = result.get('choices') or [{}]
+        return {
+            'content': choices[0].get('message', {}).get('content') or '',
+            'usage': self._usage(result)
+        }
+
+    def chat_stream(self, model, messages, system_prompt=None, options=None, timeout=120, keep_alive=None, cancel=None):
+        # El token solo se asocia mientras se abre la conexión (el generador se suspende entre fragmentos)
+        with bind(cancel):
+            response = self.session.post(
+                f"{self.base_url}/chat/completions",
+                json=self._payload(model, messages, system_prompt, options, True),
+                headers=self._headers(),
+                stream=True,
+                timeout=timeout
+            )
+        with response:
+            if response.status_code != 200:
+                raise BackendError(response.status_code, response.text)
+            usage = empty_usage()
+            # Server-Sent Events: líneas "data: {...}" terminadas con "data: [DONE]"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                chunk = json.loads(data)
+                if chunk.get('usage'):
+                    usage = self._usage(chunk)
+                for choice in chunk.get('choices') or []:
+                    content = (choice.get('delta') or {}).get('content')
+                    if content:
+                        yield {'content': content, 'done': False, 'usage': None}
+            yield {'content': '', 'done': True, 'usage': usage}
+
+    def embed(self, model, text, timeout=30):
+        response = self.session.post(
+            f"{self.base_url}/embeddings",
+            json={"model": model, "input": text},
+            headers=self._headers(),
+            timeout=timeout
+        )
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        data = response.json().get('data') or [{}]
+        return data[0].get('embedding') or []
+
+    def list_models(self, timeout=5):
+        response = self.session.get(f"{self.base_url}/models", headers=self._headers(), timeout=timeout)
+        if response.status_code != 200:
+            raise BackendError(response.status_code, response.text)
+        return [m.get('id') for m in response.json().get('data', [])]
+
+
+BACKEND_TYPES = {
+    'ollama': OllamaBackend,
+    'openai': OpenAICompatibleBackend,
+}
+
+
+def create_backend(spec):
+    """
+    Crea un backend a partir de su configuración
+
+    Args:
+        spec: dict con 'type' ('ollama' u 'openai'), 'base_url' y opcionalmente 'api_key'
+    """
+    backend_type = spec.get('type', 'ollama')
+    if backend_type not in BACKEND_TYPES:
+        raise ValueError(f"Tipo de backend desconocido: {backend_type}")
+    if backend_type == 'openai':
+        return OpenAICompatibleBackend(spec['base_url'], spec.get('api_key'))
+    return OllamaBackend(spec['base_url'])
@@ -1,16 +1,43 @@
 """
 Integración con modelos LLM usando Ollama (más estable que vLLM)
-Soporta Llama y DeepSeek localmente
+Soporta Llama y DeepSeek localmente, y servidores compatibles con OpenAI
+(vLLM, llama.cpp server) a través de inference_backends
 """
 import logging
 import requests
-import json
 import re
+from cancellation import Cancelled
+from inference_backends import BackendError
+from circuit_breaker import CircuitBreakers
+from endpoint_pool import CircuitOpen, EndpointPool, NoEndpointAvailable, parse_endpoint
+from tuning import get_profile, resolve_options, stable_threads
 
 logger = logging.getLogger(__name__)
 
+# Opciones de muestreo para el chat general
+# Los recursos (threads, contexto, límite de tokens) salen de config.MODEL_PROFILES
+CHAT_OPTIONS = {
+    "temperature": 0.7,  # Más creativo para evitar restricciones del modelo
+    "repeat_penalty": 1.2,  # Evita repeticiones
+    "top_p": 0.95,  # Más opciones para evitar filtros
+    "top_k": 40,  # Más opciones
+    "typical_p": 0.9  # Ayuda a evitar respuestas filtradas
+}
+
+# Opciones de muestreo para código (DeepSeek)
+CODE_OPTIONS = {
+    "temperature": 0.3,
+    "repeat_penalty": 1.2  # Evita repeticiones
+}
+
+# Comandos del sistema que se detectan y ejecutan directamente (nmap, ping, etc.)
+SYSTEM_COMMANDS = ['nmap', 'ping', 'curl', 'wget', 'netstat', 'ss', 'tcpdump',
+                   'grep', 'find', 'ls', 'cat', 'tail', 'head', 'ps', 'top',
+                   'iptables', 'ufw', 'systemctl', 'service', 'journalctl', 'whois',
+                   'dig', 'nslookup', 'arp', 'route', 'ifconfig', 'ip']
+
 class LLMClient:
-    def __init__(self, api_url=None, chat_url=None, llama_model=None, deepseek_model=None):
+    def __init__(self, api_url=None, chat_url=None, llama_model=None, deepseek_model=None, endpoints=None):
         """
         Inicializa el cliente LLM usando Ollama
         
@@ -19,14 +46,95 @@ class LLMClient:
             chat_url: URL del servidor Ollama para chat
             llama_model: Modelo de Llama a usar
             deepseek_model: Modelo de DeepSeek a usar
+            endpoints: Pool de endpoints por backend, p. ej.
+                {'ollama': ['http://10.0.0.2:11434|mistral:7b', ...]}
+                (por defecto config.INFERENCE_ENDPOINTS)
         """
         import config
         self.api_url = api_url or config.OLLAMA_API_URL
         self.chat_url = chat_url or config.OLLAMA_CHAT_URL
         self.llama_model = llama_model or config.LLAMA_MODEL
         self.deepseek_model = deepseek_model or config.DEEPSEEK_MODEL
+        self.model_backends = dict(config.MODEL_BACKENDS)
+        self.default_backend = config.DEFAULT_BACKEND
+        # Funciones (model, usage) a las que se notifica el consumo de cada generación
+        self.usage_listeners = []
+        
+        # Circuit breaker por endpoint y modelo (compartido por los pools)
+        self.breakers = CircuitBreakers(
+            enabled=config.BREAKER_ENABLED,
+            window=config.BREAKER_WINDOW_SECONDS,
+            min_requests=config.BREAKER_MIN_REQUESTS,
+            error_rate=config.BREAKER_ERROR_RATE,
+            slow_ms=config.BREAKER_SLOW_MS,
+            slow_rate=config.BREAKER_SLOW_RATE,
+            open_seconds=config.BREAKER_OPEN_SECONDS,
+            half_open_requests=config.BREAKER_HALF_OPEN_REQUESTS
+        )
+        
+        # Un pool de endpoints por backend; sin endpoints configurados se usa
+        # el servidor único del backend (chat_url para Ollama)
+        endpoints = endpoints if endpoints is not None else config.INFERENCE_ENDPOINTS
+        if chat_url:
+            endpoints = dict(endpoints, ollama=[])
+        used = {self.default_backend, *self.model_backends.values(), *(n for n, e in endpoints.items() if e)}
+        self.pools = {}
+        for name, spec in config.INFERENCE_BACKENDS.items():
+            if name not in used:
+                continue
+            if name == 'ollama':
+                spec = dict(spec, base_url=self.chat_url.rsplit('/api/', 1)[0])
+            specs = [dict(spec, **parse_endpoint(e, spec['type'])) for e in endpoints.get(name) or []] or [spec]
+            self.pools[name] = EndpointPool.from_specs(
+                specs,
+                probe_interval=config.ENDPOINT_PROBE_INTERVAL,
+                failure_threshold=config.ENDPOINT_FAILURE_THRESHOLD,
+                breakers=self.breakers
+            )
+            self.pools[name].start()
+        
+        if config.AUTO_TUNE:
+            # Se fija al arrancar: con cada num_thread distinto Ollama recargaría el modelo
+            logger.info(f"AUTO_TUNE: num_thread={stable_threads()}")
+    
+    def pool_for(self, model):
+        """Devuelve el pool de endpoints del backend configurado para un modelo"""
+        name = self.model_backends.get(model, self.default_backend)
+        if name not in self.pools:
+            raise ValueError(f"Backend no configurado para {model}: {name}")
+        return self.pools[name]
+    
+    def _chat(self, model, messages, system_prompt, base_options, purpose, timeout, cancel=None):
+        """
+        Envía la petición al endpoint elegido por el pool del modelo
+        
+        Raises:
+            Cancelled si el token se cancela (la conexión se cierra y Ollama deja de generar)
+        """
+        prompt_chars = len(system_prompt or '') + sum(len(m['content'] or '') for m in messages)
+        options, keep_alive = resolve_options(model, base_options, purpose, prompt_chars)
+        with self.pool_for(model).acquire(model) as endpoint:
+            try:
+                result = endpoint.backend.chat(
+                    model, messages, system_prompt, options,
+                    timeout=timeout, keep_alive=keep_alive, cancel=cancel
+                )
+            except requests.exceptions.RequestException:
+                # Una conexión cerrada al cancelar no cuenta como fallo del endpoint
+                if cancel is not None and cancel.is_cancelled:
+                    raise Cancelled(cancel.reason)
+                raise
+        self._notify_usage(model, result['usage'])
+        return result
+    
+    def _notify_usage(self, model, usage):
+        for listener in self.usage_listeners:
+            try:
+                listener(model, usage)
+            except Exception as e:
+                logger.warning(f"Error notificando el consumo de {model}: {str(e)}")
     
-    def generate(self, prompt, system_prompt=None, history=None, username="Usuario", language="es", use_deepseek=False):
+    def generate(self, prompt, system_prompt=None, history=None, username="Usuario", language="es", use_deepseek=False, model=None, cancel=None):
         """
         Genera una respuesta usando Llama o DeepSeek según corresponda
         
@@ -37,11 +145,16 @@ class LLMClient:
             username: Nombre del usuario para personalización
             language: Idioma del usuario ('es' o 'en')
             use_deepseek: Si True, usa DeepSeek en lugar de Llama
+            model: Modelo concreto a usar (tiene prioridad sobre use_deepseek)
+            cancel: CancelToken de la petición (opcional)
         
         Returns:
-            dict con la respuesta y metadatos
+            dict con la respuesta y metadatos ('failed' si no se pudo generar)
+        
+        Raises:
+            Cancelled si la petición se cancela
         """
-        model = self.deepseek_model if use_deepseek else self.llama_model
+        model = model or (self.deepseek_model if use_deepseek else self.llama_model)
         
         # Construir mensajes en formato Ollama
         messages = []
@@ -65,62 +178,62 @@ class LLMClient:
         })
         
         try:
-            # Llamada a Ollama usando API de chat (más estable)
-            # Configuración optimizada para bajo consumo de recursos
-            response = requests.post(
-                self.chat_url,
-                json={
-                    "model": model,
-                    "messages": messages,
-                    "system": system_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7,  # Más creativo para evitar restricciones del modelo
-                        "num_predict": 100,  # Respuestas MUY cortas (máximo ~100 tokens)
-                        "num_ctx": 2048,  # Contexto reducido
-                        "num_thread": 2,  # Menos threads para menos CPU
-                        "repeat_penalty": 1.2,  # Evita repeticiones
-                        "top_p": 0.95,  # Más opciones para evitar filtros
-                        "top_k": 40,  # Más opciones
-                        "typical_p": 0.9  # Ayuda a evitar respuestas filtradas
-                    }
-                },
-                timeout=120
-            )
+            # Llamada al backend del modelo (Ollama por defecto)
+            result = self._chat(model, messages, system_prompt, CHAT_OPTIONS, 'chat', timeout=120, cancel=cancel)
+            response_text = result['content']
             
-            if response.status_code == 200:
-                result = response.json()
-                response_text = result.get('message', {}).get('content', '')
-                
-                # Analizar si la respuesta contiene código o necesita DeepSeek
-                needs_code, code_info = self._analyze_response(response_text)
-                
-                return {
-                    'content': response_text,
-                    'needs_code': needs_code,
-                    'code': code_info.get('code') if needs_code else None,
-                    'language': code_info.get('language') if needs_code else None,
-                    'needs_deepseek': code_info.get('needs_deepseek', False),
-                    'is_system_command': code_info.get('is_system_command', False)
-                }
-            else:
-                logger.error(f"Error en llamada a Ollama: {response.status_code} - {response.text}")
-                return {
-                    'content': f'Error al procesar la solicitud: {response.status_code}',
-                    'needs_code': False,
-                    'code': None,
-                    'language': None
-                }
+            # Analizar si la respuesta contiene código o necesita DeepSeek
+            needs_code, code_info = self._analyze_response(response_text)
+            
+            return {
+                'content': response_text,
+                'needs_code': needs_code,
+                'code': code_info.get('code') if needs_code else None,
+                'language': code_info.get('language') if needs_code else None,
+                'needs_deepseek': code_info.get('needs_deepseek', False),
+                'is_system_command': code_info.get('is_system_command', False)
+            }
+        except BackendError as e:
+            logger.error(f"Error en llamada a {model}: {e.status_code} - {e.text}")
+            return {
+                'content': f'Error al procesar la solicitud: {e.status_code}',
+                'failed': True,
+                'needs_code': False,
+                'code': None,
+                'language': None
+            }
+        except CircuitOpen as e:
+            # Sin esperar al timeout: el servidor ya estaba fallando
+            logger.warning(str(e))
+            return {
+                'content': f'{str(e)}. Inténtalo de nuevo en {int(e.retry_after) + 1} s.',
+                'failed': True,
+                'unavailable': True,
+                'retry_after': int(e.retry_after) + 1,
+                'needs_code': False,
+                'code': None,
+                'language': None
+            }
+        except NoEndpointAvailable as e:
+            logger.error(str(e))
+            return {
+                'content': f'{str(e)}. Ningún servidor de inferencia responde.',
+                'failed': True,
+                'needs_code': False,
+                'code': None,
+                'language': None
+            }
         except requests.exceptions.RequestException as e:
             logger.error(f"Error de conexión con Ollama: {str(e)}")
             return {
                 'content': f'Error de conexión con Ollama: {str(e)}. Asegúrate de que Ollama esté corriendo (ollama serve).',
+                'failed': True,
                 'needs_code': False,
                 'code': None,
                 'language': None
             }
     
-    def generate_code_with_deepseek(self, requirements, language="python", context="", user_language="es"):
+    def generate_code_with_deepseek(self, requirements, language="python", context="", user_language="es", cancel=None):
         """
         Genera código usando DeepSeek específicamente para generación de código
         
@@ -129,6 +242,7 @@ class LLMClient:
             language: Lenguaje de programación
             context: Contexto adicional
             user_language: Idioma del usuario ('es' o 'en')
+            cancel: CancelToken de la petición (opcional)
         
         Returns:
             dict con el código generado
@@ -161,50 +275,38 @@ Contexto adicional:
         ]
 
         try:
-            response = requests.post(
-                self.chat_url,
-                json={
-                    "model": self.deepseek_model,
-                    "messages": messages,
-                    "system": system_prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.3,
-                        "num_predict": 800,  # Código más conciso
-                        "num_ctx": 2048,  # Contexto reducido
-                        "num_thread": 2,  # Menos threads para menos CPU
-                        "repeat_penalty": 1.2  # Evita repeticiones
-                    }
-                },
-                timeout=60
-            )
-
-            if response.status_code == 200:
-                result = response.json()
-                code_content = result.get('message', {}).get('content', '')
-                
-                # Extraer código si viene en bloques markdown
-                code_pattern = r'```(?:\w+)?\n?(.*?)```'
-                code_matches = re.findall(code_pattern, code_content, re.DOTALL)
-                
-                if code_matches:
-                    code = code_matches[0].strip()
-                else:
-                    code = code_content.strip()
-                
-                return {
-                    'success': True,
-                    'code': code,
-                    'language': language,
-                    'raw_response': code_content
-                }
+            result = self._chat(self.deepseek_model, messages, system_prompt, CODE_OPTIONS, 'code', timeout=60, cancel=cancel)
+            code_content = result['content']
+            
+            # Extraer código si viene en bloques markdown
+            code_pattern = r'```(?:\w+)?\n?(.*?)```'
+            code_matches = re.findall(code_pattern, code_content, re.DOTALL)
+            
+            if code_matches:
+                code = code_matches[0].strip()
             else:
-                logger.error(f"Error en DeepSeek Ollama: {response.status_code} - {response.text}")
-                return {
-                    'success': False,
-                    'error': f'Error en DeepSeek: {response.status_code}',
-                    'code': None
-                }
+                code = code_content.strip()
+            
+            return {
+                'success': True,
+                'code': code,
+                'language': language,
+                'raw_response': code_content
+            }
+        except BackendError as e:
+            logger.error(f"Error en DeepSeek ({self.deepseek_model}): {e.status_code} - {e.text}")
+            return {
+                'success': False,
+                'error': f'Error en DeepSeek: {e.status_code}',
+                'code': None
+            }
+        except NoEndpointAvailable as e:
+            logger.error(str(e))
+            return {
+                'success': False,
+                'error': str(e),
+                'code': None
+            }
         except requests.exceptions.RequestException as e:
             logger.error(f"Error de conexión con DeepSeek: {str(e)}")
             return {
@@ -213,6 +315,130 @@ Contexto adicional:
                 'code': None
             }
     
+    def stream_chat(self, model, messages, system_prompt=None, options=None, purpose='chat', timeout=120, cancel=None):
+        """
+        Genera una respuesta en streaming con el backend del modelo
+        
+        Args:
+            model: Modelo a usar
+            messages: Lista de mensajes (role/content)
+            system_prompt: Prompt del sistema
+            options: Opciones de muestreo (por defecto CHAT_OPTIONS); los recursos
+                salen del perfil del modelo
+            purpose: 'chat' o 'code'
+            timeout: Timeout de la conexión en segundos
+            cancel: CancelToken que cierra el streaming al cancelarse
+        
+        Yields:
+            dict con 'content' y 'done'; el último fragmento trae 'usage'
+            (tokens y duraciones de carga/evaluación)
+        """
+        prompt_chars = len(system_prompt or '') + sum(len(m['content'] or '') for m in messages)
+        options, keep_alive = resolve_options(
+            model, options if options is not None else CHAT_OPTIONS, purpose, prompt_chars
+        )
+        with self.pool_for(model).acquire(model) as endpoint:
+            try:
+                for chunk in endpoint.backend.chat_stream(
+                    model, messages, system_prompt, options,
+                    timeout=timeout, keep_alive=keep_alive, cancel=cancel
+                ):
+                    if chunk['done']:
+                        self._notify_usage(model, chunk['usage'])
+                    yield chunk
+            except requests.exceptions.RequestException:
+                if cancel is not None and cancel.is_cancelled:
+                    raise Cancelled(cancel.reason)
+                raise
+    
+    def embed(self, text, model=None, timeout=30):
+        """
+        Embedding de un texto con el modelo de embeddings (config.EMBEDDING_MODEL)
+        
+        Raises:
+            BackendError, NoEndpointAvailable o requests.exceptions.RequestException
+        """
+        import config
+        model = model or config.EMBEDDING_MODEL
+        with self.pool_for(model).acquire(model) as endpoint:
+            return endpoint.backend.embed(model, text, timeout=timeout)
+    
+    def unload_model(self, model):
+        """Descarga un modelo de la memoria de los servidores (keep_alive=0 en Ollama)"""
+        for endpoint in self.pool_for(model).serving(model):
+            endpoint.backend.unload_model(model)
+    
+    def list_models(self):
+        """Modelos disponibles por endpoint (None si el endpoint no responde)"""
+        models = {}
+        for pool in self.pools.values():
+            for endpoint in pool.endpoints:
+                try:
+                    models[endpoint.name] = endpoint.backend.list_models()
+                except (requests.exceptions.RequestException, BackendError, ValueError):
+                    models[endpoint.name] = None
+        return models
+    
+    def health_check(self):
+        """Estado (según el último sondeo) de los backends usados por los modelos configurados"""
+        names = {self.model_backends.get(m, self.default_backend) for m in (self.llama_model, self.deepseek_model)}
+        return {name: self.pools[name].is_healthy() for name in names if name in self.pools}
+    
+    def health(self):
+        """
+        Salud de la inferencia sin hacer peticiones: último sondeo de cada
+        pool y circuitos abiertos (lo que sirve /api/health)
+        """
+        backends = {}
+        for name, pool in self.pools.items():
+            probes = [e.last_probe for e in pool.endpoints if e.last_probe is not None]
+            backends[name] = {
+                'healthy': pool.is_healthy(),
+                'reachable': pool.is_reachable(),
+                'healthy_endpoints': sum(1 for e in pool.endpoints if e.healthy),
+                'endpoints': len(pool.endpoints),
+                'last_probe': max(probes) if probes else None
+            }
+        return {'backends': backends, 'open_circuits': self.breakers.open_count()}
+    
+    def breaker_stats(self):
+        """Estado y transiciones de los circuit breakers"""
+        return self.breakers.snapshot()
+    
+    def warm_up(self, models):
+        """
+        Carga los modelos en memoria para que la primera petición no pague la carga
+        
+        Returns:
+            True si todos los modelos quedaron cargados
+        """
+        loaded = True
+        for model in models:
+            pool = self.pool_for(model)
+            keep_alive = get_profile(model).get('keep_alive')
+            for endpoint in pool.serving(model):
+                try:
+                    endpoint.backend.load_model(model, keep_alive)
+                    logger.info(f"Modelo {model} cargado en {endpoint.name}")
+                except (requests.exceptions.RequestException, BackendError) as e:
+                    logger.warning(f"No se pudo cargar {model} en {endpoint.name}: {str(e)}")
+                    loaded = False
+            pool.probe_all()
+        return loaded
+    
+    def readiness(self, models):
+        """Alcanzabilidad de los backends y modelos descargados/cargados (según el último sondeo)"""
+        configured = [self.llama_model, self.deepseek_model]
+        return {
+            'inference_reachable': all(self.pool_for(m).is_reachable() for m in configured),
+            'models_available': {m: self.pool_for(m).has_model(m) for m in configured},
+            'models_resident': {m: self.pool_for(m).has_model(m, resident=True) for m in models}
+        }
+    
+    def endpoint_stats(self):
+        """Latencia, errores y estado de cada endpoint por backend"""
+        return {name: pool.stats() for name, pool in self.pools.items()}
+    
     def _build_system_prompt(self, username, language="es"):
         """Construye el prompt del sistema ultra conciso con ejecución automática SIN RESTRICCIONES"""
         # Hacer el prompt más personal y conversacional como ChatGPT
@@ -325,14 +551,8 @@ Responde: 1 frase → comando. Punto."""
         """
         Analiza la respuesta para detectar código, comandos del sistema o necesidad de DeepSeek
         """
-        # Detectar comandos del sistema directamente en el texto (nmap, ping, etc.)
-        system_commands = ['nmap', 'ping', 'curl', 'wget', 'netstat', 'ss', 'tcpdump', 
-                          'grep', 'find', 'ls', 'cat', 'tail', 'head', 'ps', 'top',
-                          'iptables', 'ufw', 'systemctl', 'service', 'journalctl', 'whois',
-                          'dig', 'nslookup', 'arp', 'route', 'ifconfig', 'ip']
-        
         # Buscar comandos del sistema en el texto (formato: comando + argumentos)
-        for cmd in system_commands:
+        for cmd in SYSTEM_COMMANDS:
             pattern = r'\b' + re.escape(cmd) + r'\s+[^\n`]+'
             match = re.search(pattern, response_text, re.IGNORECASE)
             if match:
@@ -0,0 +1,235 @@
+"""
+Logging no bloqueante y estructurado
+
+Los hilos de las peticiones solo encolan el registro (QueueHandler); un hilo
+en segundo plano (QueueListener) lo formatea y lo escribe. Así el coste de
+escribir en disco, rotar y comprimir no se suma a la latencia de la petición.
+
+- Archivo en JSON lines: cada línea lleva el contexto de la petición
+  (request_id, user_id, método y ruta) y los campos pasados con extra=
+  (duration_ms, status, tokens...).
+- Rotación por tamaño y por tiempo; los archivos rotados se comprimen con gzip.
+- Los registros DEBUG se muestrean (LOG_DEBUG_SAMPLE_RATE) por petición: se
+  guardan todos los de una petición muestreada o ninguno.
+- Si la cola se llena se descartan registros en lugar de bloquear (ver stats()).
+
+Con varios workers de gunicorn cada proceso rota su propio archivo: si
+LOG_FILE no se configura, gunicorn.conf.py usa app-{pid}.log; si se configura
+sin '{pid}', el maestro avisa al arrancar (las rotaciones de varios procesos
+sobre el mismo archivo pierden registros).
+"""
+import atexit
+import contextvars
+import copy
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+import time
+import zlib
+from datetime import datetime
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_context = contextvars.ContextVar('log_context', default={})
+
+# Atributos propios de LogRecord; el resto son campos de contexto o de extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'taskName'}
+
+_queue_handler = None
+_listener = None
+
+
+def bind_context(**fields):
+    """
+    Añade campos al contexto de logging del hilo actual
+
+    Returns:
+        Token para clear_context() (restaura el contexto anterior)
+    """
+    return _context.set({**_context.get(), **fields})
+
+
+def clear_context(token=None):
+    if token is not None:
+        _context.reset(token)
+    else:
+        _context.set({})
+
+
+def get_context():
+    return _context.get()
+
+
+class ContextFilter(logging.Filter):
+    """Copia el contexto de la petición en el registro (en el hilo que lo emite)"""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """Deja pasar solo una fracción de los registros DEBUG"""
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+        self._threshold = int(rate * 0x100000000)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            # Misma decisión para todos los registros de la petición
+            return zlib.crc32(str(request_id).encode()) < self._threshold
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # El mensaje se interpola aquí: los argumentos pueden cambiar antes de
+        # que el hilo escritor lo formatee. El traceback se pasa como texto.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """Rota al superar max_bytes o cada rotate_seconds; los archivos rotados van en .gz"""
+
+    def __init__(self, filename, max_bytes=0, backup_count=10, rotate_seconds=0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotate_seconds = rotate_seconds
+        self.rollover_at = time.time() + rotate_seconds if rotate_seconds else None
+        self.namer = lambda name: f'{name}.gz'
+        self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rotate_seconds:
+            self.rollover_at = time.time() + self.rotate_seconds
+
+
+def per_process_log_file(log_file):
+    """Nombre con '{pid}' delante de la extensión (app.log -> app-{pid}.log)"""
+    if not log_file or '{pid}' in log_file:
+        return log_file
+    root, ext = os.path.splitext(log_file)
+    return f'{root}-{{pid}}{ext}'
+
+
+def setup_logging(level='INFO', log_file=None, json_format=True, max_bytes=50 * 1024 * 1024,
+                  backup_count=10, rotate_seconds=86400, debug_sample_rate=1.0, queue_size=10000):
+    """
+    Configura el logger raíz con una cola y un hilo escritor
+
+    Args:
+        level: Nivel mínimo ('DEBUG', 'INFO'...)
+        log_file: Archivo de log ('{pid}' se sustituye por el pid; None = solo consola)
+        json_format: JSON lines en el archivo (la consola siempre en texto)
+        max_bytes, rotate_seconds: Rotación por tamaño / por tiempo (0 = desactivada)
+        backup_count: Archivos rotados que se conservan
+        debug_sample_rate: Fracción de peticiones cuyos registros DEBUG se guardan
+        queue_size: Registros en cola como máximo antes de descartar
+    """
+    global _queue_handler, _listener
+    if _listener is not None:
+        return _listener
+
+    handlers = []
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers.append(console)
+    if log_file:
+        log_file = log_file.replace('{pid}', str(os.getpid()))
+        if os.path.dirname(log_file):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        file_handler = CompressingRotatingFileHandler(log_file, max_bytes, backup_count, rotate_seconds)
+        file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue(queue_size)
+    _queue_handler = _NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(ContextFilter())
+    _queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """Escribe los registros pendientes y detiene el hilo escritor"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats():
+    if _queue_handler is None:
+        return {}
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
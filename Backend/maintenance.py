@@ -0,0 +1,344 @@
+"""
+Retención, archivado y mantenimiento en línea de chat.db
+
+Un hilo en segundo plano ejecuta periódicamente, en pasos pequeños y con
+pausas para no bloquear al escritor de mensajes:
+
+- Archivado: las conversaciones sin actividad durante más de los días de
+  retención del usuario (users.retention_days, o ARCHIVE_AFTER_DAYS) se
+  guardan en ARCHIVE_DIR/<user_id>/<conversation_id>.ndjson.gz (el formato de
+  exportación de transfer.py) y se borran de la base de datos; sus mensajes
+  se borran en cascada. restore() las devuelve con el mismo id.
+- PRAGMA incremental_vacuum: devuelve al sistema las páginas libres por partes.
+- ANALYZE limitado + PRAGMA optimize: estadísticas del planificador al día.
+- PRAGMA wal_checkpoint(PASSIVE): copia el WAL a la base de datos sin esperar
+  a lectores ni escritores.
+
+Con varios workers solo uno ejecuta cada ronda (cerrojo en SharedState).
+
+Con fragmentos por usuario (storage.py) el archivado recorre cada fragmento
+con la base de datos global adjunta (users y archived_conversations están en
+ella) y los pasos de SQLite se aplican a la base de datos global y a cada
+fragmento.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from database import connect
+from transfer import export_records, gzip_ndjson, import_records, read_ndjson
+
+logger = logging.getLogger(__name__)
+
+
+class Maintenance:
+    def __init__(self, db_path, archive_dir, retention_days=90, interval=3600, batch=20,
+                 vacuum_pages=256, pause_ms=50, max_archived=500, shared_state=None, is_busy=None,
+                 storage=None):
+        """
+        Args:
+            db_path: Base de datos SQLite
+            archive_dir: Directorio de los archivos de conversaciones archivadas
+            retention_days: Días de inactividad por defecto antes de archivar (0 = nunca)
+            interval: Segundos entre rondas de mantenimiento (0 = solo bajo demanda)
+            batch: Conversaciones archivadas por lote
+            vacuum_pages: Páginas liberadas por paso de incremental_vacuum
+            pause_ms: Pausa entre lotes y pasos
+            max_archived: Conversaciones archivadas como máximo por ronda
+            shared_state: SharedState para que solo un worker ejecute cada ronda
+            is_busy: Función sin argumentos; mientras devuelva True se aplaza el siguiente paso
+            storage: storage.Storage (conversaciones fragmentadas por usuario)
+        """
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.retention_days = retention_days
+        self.interval = interval
+        self.batch = batch
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause_ms / 1000.0
+        self.max_archived = max_archived
+        self.shared_state = shared_state
+        self.is_busy = is_busy
+        self.storage = storage
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self._claim():
+                continue
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Error en el mantenimiento de la base de datos: {str(e)}")
+
+    def _claim(self):
+        """True si este worker ejecuta la ronda (los demás la saltan)"""
+        if self.shared_state is None:
+            return True
+        try:
+            return self.shared_state.cache_add('maintenance:lock', os.getpid(), ttl=max(self.interval - 1, 1))
+        except Exception as e:
+            logger.warning(f"Mantenimiento: no se pudo reclamar la ronda: {str(e)}")
+            return False
+
+    def _yield(self):
+        """Pausa entre pasos; se alarga mientras la aplicación tenga escrituras pendientes"""
+        self._stop.wait(self.pause)
+        waited = 0.0
+        while self.is_busy is not None and self.is_busy() and waited < 5 and not self._stop.is_set():
+            self._stop.wait(self.pause)
+            waited += self.pause
+
+    def run_once(self):
+        """
+        Ejecuta una ronda completa de mantenimiento
+
+        Returns:
+            dict con lo realizado en cada paso y la duración
+        """
+        with self._lock:
+            start = time.monotonic()
+            report = {'archived': self.archive_idle()}
+            vacuum = {'freed_pages': 0, 'free_pages': 0}
+            optimize = True
+            checkpoint = {'busy': False, 'wal_frames': 0, 'checkpointed': 0}
+            paths = self._all_paths()
+            for path in paths:
+                if self._stop.is_set():
+                    break
+                conn = connect(path, timeout=5)
+                try:
+                    for key, value in self._incremental_vacuum(conn).items():
+                        vacuum[key] += value
+                    optimize = self._optimize(conn) and optimize
+                    result = self._checkpoint(conn)
+                    checkpoint['busy'] = checkpoint['busy'] or result['busy']
+                    checkpoint['wal_frames'] += max(result['wal_frames'], 0)
+                    checkpoint['checkpointed'] += max(result['checkpointed'], 0)
+                finally:
+                    conn.close()
+                if len(paths) > 1:
+                    self._yield()
+            report['databases'] = len(paths)
+            report['vacuum'] = vacuum
+            report['optimize'] = optimize
+            report['checkpoint'] = checkpoint
+            report['duration_ms'] = round((time.monotonic() - start) * 1000, 1)
+            report['finished_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+            self.last_report = report
+        logger.info(f"Mantenimiento completado: {report}")
+        return report
+
+    def _all_paths(self):
+        return self.storage.all_paths() if self.storage is not None else [self.db_path]
+
+    def _conversation_paths(self):
+        return self.storage.conversation_paths() if self.storage is not None else [self.db_path]
+
+    def _connect(self, path, timeout=30):
+        """Conexión a una base de datos de conversaciones (con la global adjunta si es un fragmento)"""
+        conn = connect(path, timeout=timeout)
+        if path != self.db_path:
+            conn.execute('ATTACH DATABASE ? AS g', (self.db_path,))
+        return conn
+
+    # Archivado
+
+    def archive_idle(self):
+        """
+        Archiva las conversaciones inactivas, en lotes
+
+        Returns:
+            Número de conversaciones archivadas
+        """
+        archived = 0
+        for path in self._conversation_paths():
+            if archived >= self.max_archived or self._stop.is_set():
+                break
+            archived += self._archive_idle_in(path, self.max_archived - archived)
+        return archived
+
+    def _archive_idle_in(self, path, limit):
+        """Archiva las conversaciones inactivas de una base de datos (como mucho limit)"""
+        archived = 0
+        while archived < limit and not self._stop.is_set():
+            conn = self._connect(path, timeout=5)
+            try:
+                candidates = conn.execute('''
+                    SELECT c.id, c.user_id, c.title, c.updated_at, c.message_count
+                    FROM conversations c
+                    JOIN users u ON u.id = c.user_id
+                    WHERE COALESCE(u.retention_days, ?) > 0
+                      AND c.updated_at < datetime('now', '-' || COALESCE(u.retention_days, ?) || ' days')
+                    ORDER BY c.updated_at
+                    LIMIT ?
+                ''', (self.retention_days, self.retention_days, min(self.batch, limit - archived))).fetchall()
+                if not candidates:
+                    break
+                for candidate in candidates:
+                    if self._archive(conn, path, *candidate):
+                        archived += 1
+            finally:
+                conn.close()
+            self._yield()
+        return archived
+
+    def _archive(self, conn, db_path, conversation_id, user_id, title, updated_at, message_count):
+        user_dir = os.path.join(self.archive_dir, str(user_id))
+        os.makedirs(user_dir, exist_ok=True)
+        path = os.path.join(user_dir, f'{conversation_id}.ndjson.gz')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in gzip_ndjson(export_records(db_path, user_id, conversation_ids=[conversation_id])):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        try:
+            # Solo si no ha habido actividad desde la exportación
+            cursor = conn.execute(
+                'DELETE FROM conversations WHERE id = ? AND updated_at = ?', (conversation_id, updated_at)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                os.remove(path)
+                return False
+            conn.execute('''
+                INSERT INTO archived_conversations (user_id, conversation_id, title, message_count, path, last_activity)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, conversation_id, title, message_count, path, updated_at))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            os.remove(path)
+            raise
+        logger.info(f"Conversación {conversation_id} archivada ({message_count} mensajes) en {path}")
+        return True
+
+    def list_archived(self, user_id):
+        """Conversaciones archivadas de un usuario, las más recientes primero"""
+        conn = connect(self.db_path)
+        try:
+            rows = conn.execute('''
+                SELECT id, conversation_id, title, message_count, last_activity, archived_at
+                FROM archived_conversations
+                WHERE user_id = ?
+                ORDER BY last_activity DESC
+            ''', (user_id,)).fetchall()
+        finally:
+            conn.close()
+        return [{
+            'id': row[0],
+            'conversation_id': row[1],
+            'title': row[2],
+            'message_count': row[3],
+            'last_activity': row[4],
+            'archived_at': row[5]
+        } for row in rows]
+
+    def restore(self, archive_id, user_id):
+        """
+        Devuelve una conversación archivada a la base de datos (con su id original)
+
+        Returns:
+            dict con conversation_id y messages, o None si no existe
+        """
+        conn = connect(self.db_path)
+        try:
+            row = conn.execute(
+                'SELECT conversation_id, path FROM archived_conversations WHERE id = ? AND user_id = ?',
+                (archive_id, user_id)
+            ).fetchone()
+            if not row:
+                return None
+            conversation_id, path = row
+            db_path = self.storage.path_for(user_id) if self.storage is not None else self.db_path
+            user_conn = connect(db_path) if db_path != self.db_path else conn
+            try:
+                # Restos de una restauración anterior interrumpida
+                user_conn.execute('DELETE FROM conversations WHERE id = ? AND user_id = ?', (conversation_id, user_id))
+                user_conn.commit()
+
+                with open(path, 'rb') as f:
+                    stats = import_records(db_path, user_id, read_ndjson(f), keep_ids=True)
+
+                user_conn.execute('UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?', (conversation_id,))
+                user_conn.commit()
+            finally:
+                if user_conn is not conn:
+                    user_conn.close()
+            conn.execute('DELETE FROM archived_conversations WHERE id = ?', (archive_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.warning(f"No se pudo borrar el archivo {path}: {str(e)}")
+        logger.info(f"Conversación {conversation_id} restaurada ({stats['messages']} mensajes)")
+        return {'conversation_id': conversation_id, 'messages': stats['messages']}
+
+    # Mantenimiento de SQLite
+
+    def _incremental_vacuum(self, conn):
+        """Libera las páginas libres en pasos de vacuum_pages"""
+        freed = 0
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        while free > 0 and not self._stop.is_set():
+            try:
+                # executescript ejecuta el PRAGMA hasta el final (execute solo libera una página)
+                conn.executescript(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)});')
+            except sqlite3.OperationalError as e:
+                # Base de datos ocupada: se sigue en la próxima ronda
+                logger.info(f"incremental_vacuum aplazado: {str(e)}")
+                break
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free:
+                break
+            freed += free - remaining
+            free = remaining
+            self._yield()
+        return {'freed_pages': freed, 'free_pages': free}
+
+    def _optimize(self, conn):
+        """
+        ANALYZE limitado y PRAGMA optimize
+
+        PRAGMA optimize solo analiza las tablas que ha consultado la conexión,
+        por eso se lanza antes un ANALYZE con analysis_limit (aproximado y rápido).
+        """
+        try:
+            conn.execute('PRAGMA analysis_limit = 1000')
+            conn.execute('ANALYZE')
+            conn.execute('PRAGMA optimize')
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.info(f"ANALYZE aplazado: {str(e)}")
+            return False
+        return True
+
+    def _checkpoint(self, conn):
+        """Checkpoint del WAL sin bloquear (PASSIVE)"""
+        busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return {'busy': bool(busy), 'wal_frames': log_frames, 'checkpointed': checkpointed}
+
+    def snapshot(self):
+        return {
+            'retention_days': self.retention_days,
+            'interval': self.interval,
+            'last_report': self.last_report
+        }
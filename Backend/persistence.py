@@ -0,0 +1,254 @@
+"""
+Escritura diferida (write-behind) de mensajes con commits agrupados
+
+Un único hilo escritor recoge las inserciones de mensajes y las confirma juntas
+en una sola transacción cada pocos milisegundos o cada N filas. Así varios
+chats concurrentes comparten un mismo commit (y un solo fsync) en lugar de
+hacer uno por mensaje. El resumen de la conversación (updated_at,
+message_count, last_preview) lo actualizan los triggers de database.py.
+
+Con fragmentos por usuario (storage.py) cada mensaje va a la base de datos de
+su usuario: un lote se confirma con una transacción por fragmento, y con
+writers > 1 los fragmentos se reparten entre varios hilos escritores (por
+hash de la ruta) para que los commits de fragmentos distintos no esperen
+unos a otros. Cada hilo mantiene abiertas las conexiones más usadas.
+"""
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from storage import ConnectionCache
+
+logger = logging.getLogger(__name__)
+
+# Marca para detener el hilo escritor
+_STOP = object()
+
+
+class WriteTicket:
+    """Confirmación de durabilidad de una escritura encolada"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.row_id = None
+        self.error = None
+
+    def _resolve(self, row_id=None, error=None):
+        self.row_id = row_id
+        self.error = error
+        self._event.set()
+
+    @property
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Espera a que la escritura esté confirmada en disco
+
+        Returns:
+            True si se confirmó, False si se agotó el timeout
+
+        Raises:
+            sqlite3.Error si la escritura falló
+        """
+        if not self._event.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class _Write:
+    __slots__ = ('kind', 'path', 'conversation_id', 'role', 'content', 'usage', 'ticket')
+
+    def __init__(self, kind, path=None, conversation_id=None, role=None, content=None, usage=None):
+        self.kind = kind
+        self.path = path
+        self.conversation_id = conversation_id
+        self.role = role
+        self.content = content
+        self.usage = usage or {}
+        self.ticket = WriteTicket()
+
+
+class MessageWriter:
+    def __init__(self, db_path, flush_interval_ms=5, max_batch_rows=100, resolve=None, writers=1, max_open=64):
+        """
+        Inicia los hilos escritores
+
+        Args:
+            db_path: Ruta de la base de datos SQLite
+            flush_interval_ms: Tiempo máximo que una escritura espera a su grupo
+            max_batch_rows: Número máximo de filas por commit
+            resolve: Función user_id -> base de datos del usuario (Storage.path_for)
+            writers: Hilos escritores (útil con fragmentos)
+            max_open: Conexiones abiertas por hilo escritor
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch_rows = max_batch_rows
+        self.resolve = resolve
+        self.max_open = max_open
+        self._queues = [queue.Queue() for _ in range(max(writers, 1))]
+        self._closed = False
+        self._lock = threading.Lock()
+        self.stats = {'commits': 0, 'rows': 0, 'errors': 0}
+        self._threads = []
+        for index, write_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(write_queue,), name=f'message-writer-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.close)
+
+    def enqueue_message(self, conversation_id, role, content, usage=None, user_id=None):
+        """
+        Encola la inserción de un mensaje
+
+        Args:
+            conversation_id: Conversación a la que pertenece
+            role: 'user', 'assistant' o 'system'
+            content: Texto del mensaje
+            usage: Métricas de la respuesta (model, prompt_tokens, eval_tokens,
+                load_ms, prompt_eval_ms, eval_ms, latency_ms; failed=1 si la
+                generación falló)
+            user_id: Dueño de la conversación (elige el fragmento)
+
+        Returns:
+            WriteTicket para esperar la confirmación (row_id = id del mensaje)
+        """
+        path = self.resolve(user_id) if self.resolve is not None and user_id is not None else self.db_path
+        return self._put(_Write('message', path, conversation_id, role, content, usage))
+
+    def pending(self):
+        """Escrituras encoladas aún sin confirmar (aproximado)"""
+        return sum(write_queue.qsize() for write_queue in self._queues)
+
+    def flush(self, timeout=None):
+        """Espera a que todo lo encolado hasta ahora esté confirmado"""
+        tickets = [self._put(_Write('barrier'), write_queue) for write_queue in self._queues]
+        return all(ticket.wait(timeout) for ticket in tickets)
+
+    def close(self, timeout=10):
+        """Vacía las colas, confirma lo pendiente y detiene los hilos escritores"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for write_queue in self._queues:
+            write_queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+            if thread.is_alive():
+                logger.error("El escritor de mensajes no terminó a tiempo; pueden perderse escrituras")
+
+    def _put(self, write, write_queue=None):
+        if self._closed:
+            raise RuntimeError("MessageWriter cerrado")
+        if write_queue is None:
+            write_queue = self._queues[hash(write.path) % len(self._queues)]
+        write_queue.put(write)
+        return write.ticket
+
+    def _run(self, write_queue):
+        connections = ConnectionCache(self.max_open)
+        stopping = False
+        while not stopping:
+            item = write_queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # Agrupar hasta llenar el lote o agotar el intervalo
+            while len(batch) < self.max_batch_rows:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = write_queue.get(timeout=remaining) if remaining > 0 else write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(connections, batch)
+        # Vaciar lo que quede en la cola antes de salir
+        pending = []
+        while True:
+            try:
+                item = write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                pending.append(item)
+        for start in range(0, len(pending), self.max_batch_rows):
+            self._commit_batch(connections, pending[start:start + self.max_batch_rows])
+        connections.close()
+
+    def _commit_batch(self, connections, batch):
+        """Confirma un lote: una transacción por base de datos; las barreras al final"""
+        by_path = OrderedDict()
+        barriers = []
+        for write in batch:
+            if write.kind == 'barrier':
+                barriers.append(write)
+            else:
+                by_path.setdefault(write.path, []).append(write)
+        for path, writes in by_path.items():
+            try:
+                conn = connections.get(path)
+            except sqlite3.Error as e:
+                logger.error(f"No se pudo abrir {path}: {str(e)}")
+                self.stats['errors'] += 1
+                for write in writes:
+                    write.ticket._resolve(error=e)
+                continue
+            self._commit(conn, writes)
+        for write in barriers:
+            write.ticket._resolve()
+
+    def _commit(self, conn, batch):
+        """Confirma un lote en una sola transacción"""
+        try:
+            row_ids = self._apply(conn, batch)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error en commit agrupado ({len(batch)} escrituras), reintentando una a una: {str(e)}")
+            self.stats['errors'] += 1
+            # Reintentar individualmente para que una fila mala no tumbe al resto
+            for write in batch:
+                try:
+                    row_id = self._apply(conn, [write])[0]
+                    conn.commit()
+                    write.ticket._resolve(row_id=row_id)
+                except sqlite3.Error as row_error:
+                    conn.rollback()
+                    write.ticket._resolve(error=row_error)
+            return
+        self.stats['commits'] += 1
+        self.stats['rows'] += len(batch)
+        for write, row_id in zip(batch, row_ids):
+            write.ticket._resolve(row_id=row_id)
+
+    def _apply(self, conn, batch):
+        cursor = conn.cursor()
+        row_ids = []
+        for write in batch:
+            row_id = None
+            if write.kind == 'message':
+                usage = write.usage
+                cursor.execute('''
+                    INSERT INTO messages (conversation_id, role, content, model, prompt_tokens, eval_tokens,
+                                          load_ms, prompt_eval_ms, eval_ms, latency_ms, failed)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (write.conversation_id, write.role, write.content, usage.get('model'),
+                      usage.get('prompt_tokens'), usage.get('eval_tokens'), usage.get('load_ms'),
+                      usage.get('prompt_eval_ms'), usage.get('eval_ms'), usage.get('latency_ms'),
+                      usage.get('failed')))
+                row_id = cursor.lastrowid
+            row_ids.append(row_id)
+        return row_ids
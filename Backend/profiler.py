@@ -0,0 +1,167 @@
+"""
+Perfilado por muestreo de peticiones individuales
+
+Un hilo muestrea cada pocos milisegundos la pila del hilo que atiende la
+petición (sys._current_frames) y cuenta las pilas repetidas. Es tiempo de
+reloj: una petición esperando a Ollama aparece en la lectura del socket, una
+consulta lenta en sqlite3, etc. El hilo de la petición no se instrumenta, así
+que el coste sobre ella es mínimo, y nulo si no se perfila.
+
+Al terminar se escriben en PROFILE_DIR:
+    <fecha>-<request_id>.collapsed.txt   pilas colapsadas (flamegraph.pl, speedscope)
+    <fecha>-<request_id>.speedscope.json formato de https://www.speedscope.app
+    <fecha>-<request_id>.meta.json       método, ruta, duración y muestras
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+SPEEDSCOPE_SCHEMA = 'https://www.speedscope.app/file-format-schema.json'
+
+
+class RequestProfiler:
+    def __init__(self, output_dir, request_id, method=None, path=None, interval_ms=5, keep=200):
+        """
+        Args:
+            output_dir: Directorio donde se escriben los perfiles
+            request_id: Identificador de la petición (nombre de los archivos)
+            interval_ms: Milisegundos entre muestras
+            keep: Perfiles que se conservan (se borran los más antiguos)
+        """
+        self.output_dir = output_dir
+        self.request_id = re.sub(r'[^A-Za-z0-9_.-]', '_', str(request_id))[:64]
+        self.method = method
+        self.path = path
+        self.interval = interval_ms / 1000.0
+        self.keep = keep
+        self.thread_id = threading.get_ident()
+        self.samples = Counter()
+        self._frames = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._start = None
+
+    def start(self):
+        self._start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, status=None):
+        """Detiene el muestreo; los archivos se escriben en el hilo del perfilador"""
+        self.status = status
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.samples[self._stack(frame)] += 1
+        try:
+            self._write(round((time.monotonic() - self._start) * 1000, 1))
+        except OSError as e:
+            logger.warning(f"No se pudo guardar el perfil de {self.request_id}: {str(e)}")
+
+    def _stack(self, frame):
+        """Pila desde la raíz como tupla de nombres de función"""
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            name = self._frames.get(key)
+            if name is None:
+                name = self._frames[key] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            stack.append(name)
+            frame = frame.f_back
+        stack.reverse()
+        return tuple(stack)
+
+    def _write(self, duration_ms):
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.request_id}")
+
+        with open(f'{base}.collapsed.txt', 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        frame_index = {}
+        frames = []
+        samples = []
+        weights = []
+        for stack, count in self.samples.items():
+            indexes = []
+            for name in stack:
+                if name not in frame_index:
+                    frame_index[name] = len(frames)
+                    frames.append({'name': name})
+                indexes.append(frame_index[name])
+            samples.append(indexes)
+            weights.append(round(count * self.interval * 1000, 3))
+        with open(f'{base}.speedscope.json', 'w') as f:
+            json.dump({
+                '$schema': SPEEDSCOPE_SCHEMA,
+                'name': f'{self.method} {self.path} ({self.request_id})',
+                'exporter': 'gp-test',
+                'activeProfileIndex': 0,
+                'shared': {'frames': frames},
+                'profiles': [{
+                    'type': 'sampled',
+                    'name': f'{self.method} {self.path}',
+                    'unit': 'milliseconds',
+                    'startValue': 0,
+                    'endValue': duration_ms,
+                    'samples': samples,
+                    'weights': weights
+                }]
+            }, f)
+
+        meta = {
+            'name': os.path.basename(base),
+            'request_id': self.request_id,
+            'method': self.method,
+            'path': self.path,
+            'status': getattr(self, 'status', None),
+            'duration_ms': duration_ms,
+            'samples': sum(self.samples.values()),
+            'interval_ms': self.interval * 1000,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S')
+        }
+        with open(f'{base}.meta.json', 'w') as f:
+            json.dump(meta, f)
+        logger.info(f"Perfil guardado: {base} ({meta['samples']} muestras, {duration_ms} ms)")
+        prune_profiles(self.output_dir, self.keep)
+
+
+def list_profiles(output_dir, limit=50):
+    """Metadatos de los perfiles más recientes"""
+    if not os.path.isdir(output_dir):
+        return []
+    names = sorted((n for n in os.listdir(output_dir) if n.endswith('.meta.json')), reverse=True)
+    profiles = []
+    for name in names[:limit]:
+        try:
+            with open(os.path.join(output_dir, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def prune_profiles(output_dir, keep):
+    """Borra los perfiles más antiguos por encima de keep"""
+    names = sorted(n for n in os.listdir(output_dir) if n.endswith('.meta.json'))
+    for name in names[:max(len(names) - keep, 0)]:
+        base = name[:-len('.meta.json')]
+        for suffix in ('.meta.json', '.collapsed.txt', '.speedscope.json'):
+            try:
+                os.remove(os.path.join(output_dir, base + suffix))
+            except OSError:
+                pass
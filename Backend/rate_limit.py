@@ -0,0 +1,244 @@
+"""
+Límites por usuario: token buckets y concurrencia
+
+Por cada user_id del JWT se aplican tres límites:
+- Peticiones por minuto (bucket que se recarga de forma continua)
+- Tokens generados por hora (eval_count de Ollama); se comprueba que quede
+  saldo antes de la petición y se descuenta el consumo real al terminar,
+  pudiendo quedar en negativo
+- Ejecuciones simultáneas (chats en curso y scripts)
+
+El estado vive en memoria del proceso (MemoryStore) o, con varios workers de
+gunicorn, en un archivo SQLite compartido (SQLiteStore).
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryStore:
+    """Buckets y contadores de concurrencia en memoria (un solo proceso)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = {}
+
+    def take(self, key, capacity, rate, amount, require_positive=False, force=False):
+        """
+        Recarga el bucket y descuenta `amount`
+
+        Args:
+            capacity: Tamaño máximo del bucket
+            rate: Tokens que se recargan por segundo
+            amount: Tokens a descontar (0 para solo consultar)
+            require_positive: Si True, solo hace falta saldo > 0 (puede quedar en negativo)
+            force: Descuenta siempre, haya saldo o no
+
+        Returns:
+            (permitido, tokens restantes)
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = force or (tokens > 0 if require_positive else tokens >= amount)
+            if allowed:
+                tokens -= amount
+            self._buckets[key] = (tokens, now)
+            return allowed, tokens
+
+    def acquire_slot(self, key, limit, max_hold):
+        with self._lock:
+            holders = self._slots.setdefault(key, set())
+            if len(holders) >= limit:
+                return None
+            holder = uuid.uuid4().hex
+            holders.add(holder)
+            return holder
+
+    def release_slot(self, key, holder):
+        with self._lock:
+            self._slots.get(key, set()).discard(holder)
+
+    def active_slots(self, key):
+        with self._lock:
+            return len(self._slots.get(key, ()))
+
+
+class SQLiteStore:
+    """Buckets y contadores de concurrencia compartidos entre procesos"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_slots (
+                holder TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                pid INTEGER NOT NULL,
+                acquired_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_slots_key ON rate_slots(key)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # isolation_level=None: las transacciones se abren a mano con BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate, amount, require_positive=False, force=False):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+            allowed = force or (tokens > 0 if require_positive else tokens >= amount)
+            if allowed:
+                tokens -= amount
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, tokens
+
+    def acquire_slot(self, key, limit, max_hold):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Plazas de peticiones que nunca se liberaron (worker reiniciado)
+            conn.execute('DELETE FROM rate_slots WHERE key = ? AND acquired_at < ?', (key, now - max_hold))
+            active = conn.execute('SELECT COUNT(*) FROM rate_slots WHERE key = ?', (key,)).fetchone()[0]
+            holder = None
+            if active < limit:
+                holder = uuid.uuid4().hex
+                conn.execute(
+                    'INSERT INTO rate_slots (holder, key, pid, acquired_at) VALUES (?, ?, ?, ?)',
+                    (holder, key, os.getpid(), now)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return holder
+
+    def release_slot(self, key, holder):
+        self._conn().execute('DELETE FROM rate_slots WHERE holder = ?', (holder,))
+
+    def active_slots(self, key):
+        return self._conn().execute('SELECT COUNT(*) FROM rate_slots WHERE key = ?', (key,)).fetchone()[0]
+
+
+class RateLimitDecision:
+    """Resultado de comprobar los límites de una petición"""
+
+    def __init__(self, allowed, reason=None, retry_after=0, headers=None, slot=None):
+        self.allowed = allowed
+        self.reason = reason
+        self.retry_after = retry_after
+        self.headers = headers or {}
+        self.slot = slot
+
+
+class RateLimiter:
+    def __init__(self, store, requests_per_minute=20, tokens_per_hour=50000, max_concurrent=2, max_hold=600):
+        """
+        Args:
+            store: MemoryStore o SQLiteStore
+            requests_per_minute: Peticiones por minuto (0 = sin límite)
+            tokens_per_hour: Tokens generados por hora (0 = sin límite)
+            max_concurrent: Ejecuciones simultáneas por usuario (0 = sin límite)
+            max_hold: Segundos tras los que una plaza no liberada se da por perdida
+        """
+        self.store = store
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_hour = tokens_per_hour
+        self.max_concurrent = max_concurrent
+        self.max_hold = max_hold
+
+    def check(self, user_id):
+        """
+        Comprueba los tres límites y, si se permite, reserva una plaza de concurrencia
+
+        Returns:
+            RateLimitDecision (llamar a release() con ella al terminar)
+        """
+        headers = {}
+        if self.tokens_per_hour:
+            rate = self.tokens_per_hour / 3600.0
+            allowed, tokens = self.store.take(f'tokens:{user_id}', self.tokens_per_hour, rate, 0, require_positive=True)
+            headers['X-RateLimit-Tokens-Limit'] = str(self.tokens_per_hour)
+            headers['X-RateLimit-Tokens-Remaining'] = str(max(0, int(tokens)))
+            if not allowed:
+                retry = math.ceil((1 - tokens) / rate)
+                return RateLimitDecision(False, 'Límite de tokens por hora alcanzado', retry, headers)
+
+        # La plaza se reserva antes de gastar el token de peticiones por minuto:
+        # una petición rechazada por concurrencia no consume cuota
+        slot = None
+        if self.max_concurrent:
+            slot = self.store.acquire_slot(f'concurrent:{user_id}', self.max_concurrent, self.max_hold)
+            headers['X-RateLimit-Concurrent-Limit'] = str(self.max_concurrent)
+            if slot is None:
+                return RateLimitDecision(False, 'Demasiadas ejecuciones simultáneas', 1, headers)
+
+        if self.requests_per_minute:
+            rate = self.requests_per_minute / 60.0
+            allowed, tokens = self.store.take(f'requests:{user_id}', self.requests_per_minute, rate, 1)
+            headers['X-RateLimit-Limit'] = str(self.requests_per_minute)
+            headers['X-RateLimit-Remaining'] = str(max(0, int(tokens)))
+            headers['X-RateLimit-Reset'] = str(math.ceil((self.requests_per_minute - tokens) / rate))
+            if not allowed:
+                if slot is not None:
+                    self.store.release_slot(f'concurrent:{user_id}', slot)
+                retry = math.ceil((1 - tokens) / rate)
+                return RateLimitDecision(False, 'Demasiadas peticiones por minuto', retry, headers)
+
+        return RateLimitDecision(True, headers=headers, slot=slot)
+
+    def release(self, user_id, decision):
+        """Libera la plaza de concurrencia reservada por check()"""
+        if decision.slot is not None:
+            self.store.release_slot(f'concurrent:{user_id}', decision.slot)
+
+    def charge_tokens(self, user_id, tokens):
+        """Descuenta los tokens generados (puede dejar el saldo en negativo)"""
+        if self.tokens_per_hour and tokens:
+            rate = self.tokens_per_hour / 3600.0
+            self.store.take(f'tokens:{user_id}', self.tokens_per_hour, rate, tokens, force=True)
+
+
+def create_store(backend, db_path=None):
+    """Crea el almacén de estado: 'memory' o 'sqlite'"""
+    if backend == 'sqlite':
+        return SQLiteStore(db_path)
+    if backend != 'memory':
+        raise ValueError(f"Backend de rate limit desconocido: {backend}")
+    return MemoryStore()
@@ -0,0 +1,153 @@
+"""
+Enrutado en cascada: los turnos simples los responde un modelo pequeño
+
+Antes de llamar a LLMClient.generate se clasifica el mensaje con
+características baratas (longitud, palabras clave de comandos del detector de
+_analyze_response, estado de la conversación). Los turnos fáciles (saludos,
+"conexiones activas", un ping...) van al modelo pequeño; si su respuesta no
+pasa la validación se escala al modelo principal.
+
+Cada decisión se registra en el log con la latencia de cada nivel para poder
+ajustar los umbrales.
+"""
+import logging
+import re
+import threading
+import time
+
+from llama_integration import SYSTEM_COMMANDS
+
+logger = logging.getLogger(__name__)
+
+# Peticiones que necesitan el modelo principal (generación de código)
+CODE_KEYWORDS = ['```', 'script', 'código', 'codigo', 'programa', 'code', 'función', 'function',
+                 'python', 'bash', 'rust', 'golang', 'exploit', 'deepseek']
+
+# Límite de palabras del prompt del sistema ("Más de 100 palabras totales")
+MAX_REPLY_WORDS = 100
+
+_COMMAND_RE = re.compile(r'\b(' + '|'.join(re.escape(c) for c in SYSTEM_COMMANDS) + r')\b', re.IGNORECASE)
+
+
+class CascadeRouter:
+    def __init__(self, llm_client, small_model, enabled=False, max_chars=200, max_history=20):
+        """
+        Args:
+            llm_client: LLMClient usado para ambos niveles
+            small_model: Modelo pequeño y rápido (p. ej. phi3:mini)
+            enabled: Si False, todo va al modelo principal
+            max_chars: Mensajes más largos van directamente al modelo principal
+            max_history: Conversaciones con más mensajes van al modelo principal
+        """
+        self.llm_client = llm_client
+        self.small_model = small_model
+        self.enabled = enabled
+        self.max_chars = max_chars
+        self.max_history = max_history
+        self._lock = threading.Lock()
+        self.stats = {
+            'small': 0, 'large': 0, 'escalated': 0,
+            'small_latency_ms': 0.0, 'large_latency_ms': 0.0
+        }
+
+    def classify(self, message, history=None):
+        """
+        Clasifica un turno
+
+        Returns:
+            (nivel, motivo) con nivel 'small' o 'large'
+        """
+        text = message.lower()
+        if len(message) > self.max_chars:
+            return 'large', f'longitud {len(message)} > {self.max_chars}'
+        if any(keyword in text for keyword in CODE_KEYWORDS):
+            return 'large', 'pide código'
+        if history and len(history) > self.max_history:
+            return 'large', f'historial {len(history)} > {self.max_history}'
+        last_reply = next((content for role, content in reversed(history or []) if role == 'assistant'), None)
+        if last_reply and ('❌' in last_reply or last_reply.startswith('Error')):
+            return 'large', 'el turno anterior falló'
+        if _COMMAND_RE.search(message):
+            return 'small', 'comando simple'
+        return 'small', 'turno corto'
+
+    def validate(self, message, response):
+        """
+        Valida la respuesta del modelo pequeño
+
+        Returns:
+            None si es válida, o el motivo para escalar
+        """
+        content = (response.get('content') or '').strip()
+        if response.get('failed'):
+            return 'error del modelo pequeño'
+        if not content:
+            return 'respuesta vacía'
+        if len(content.split()) > MAX_REPLY_WORDS:
+            return 'respuesta demasiado larga'
+        if response.get('needs_deepseek'):
+            return 'pide generar código'
+        if _COMMAND_RE.search(message) and not response.get('is_system_command'):
+            return 'se esperaba un comando'
+        return None
+
+    def generate(self, message, history=None, username="Usuario", language="es", cancel=None):
+        """Genera la respuesta por el nivel adecuado, escalando si hace falta"""
+        if not self.enabled:
+            return self.llm_client.generate(message, None, history, username, language=language, cancel=cancel)
+
+        tier, reason = self.classify(message, history)
+        if tier == 'small':
+            start = time.monotonic()
+            response = self.llm_client.generate(
+                message, None, history, username, language=language, model=self.small_model, cancel=cancel
+            )
+            small_ms = (time.monotonic() - start) * 1000
+            failure = self.validate(message, response)
+            if failure is None:
+                self._record('small', small_ms)
+                logger.info(f"Cascada: nivel=small modelo={self.small_model} motivo='{reason}' latencia_small={small_ms:.0f}ms")
+                return response
+            self._record('small', small_ms, escalated=True)
+            reason = f"{reason}; escalado: {failure}"
+        else:
+            small_ms = None
+
+        start = time.monotonic()
+        response = self.llm_client.generate(message, None, history, username, language=language, cancel=cancel)
+        large_ms = (time.monotonic() - start) * 1000
+        self._record('large', large_ms)
+        small_info = f" latencia_small={small_ms:.0f}ms" if small_ms is not None else ''
+        logger.info(
+            f"Cascada: nivel=large modelo={self.llm_client.llama_model} motivo='{reason}'"
+            f"{small_info} latencia_large={large_ms:.0f}ms"
+        )
+        return response
+
+    def _record(self, tier, latency_ms, escalated=False):
+        with self._lock:
+            self.stats[tier] += 1
+            self.stats[f'{tier}_latency_ms'] += latency_ms
+            if escalated:
+                self.stats['escalated'] += 1
+
+    def snapshot(self):
+        """Copia de los contadores (con la latencia acumulada, para sumar entre workers)"""
+        with self._lock:
+            return dict(self.stats)
+
+    def report(self, stats=None):
+        """
+        Contadores y latencia media por nivel
+
+        Args:
+            stats: Contadores a resumir (por defecto los de este proceso)
+        """
+        stats = dict(stats) if stats is not None else self.snapshot()
+        for tier in ('small', 'large'):
+            count = stats[tier]
+            total = stats.pop(f'{tier}_latency_ms')
+            stats[f'{tier}_avg_latency_ms'] = round(total / count, 1) if count else None
+        stats['enabled'] = self.enabled
+        stats['small_model'] = self.small_model
+        return stats
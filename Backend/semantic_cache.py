@@ -0,0 +1,294 @@
+"""
+Caché semántica de respuestas del modelo
+
+Los mensajes se convierten en embeddings (endpoint de embeddings de Ollama)
+y se guardan normalizados en una matriz NumPy por idioma. Una búsqueda es un
+único producto matriz-vector (similitud coseno con todos los mensajes
+cacheados); si la mejor similitud supera el umbral se reutiliza la respuesta.
+
+Las entradas son de un usuario (el prompt del sistema lleva su nombre y la
+respuesta puede depender de él) y solo se cachean los primeros turnos de una
+conversación: con historial la respuesta depende de los mensajes anteriores.
+Un índice por (idioma, usuario); los índices guardados sin usuario (versiones
+anteriores) se descartan al cargar.
+
+Solo se guarda la respuesta del modelo tal y como la generó, antes de ejecutar
+comandos: la salida de los comandos nunca se reutiliza porque
+process_with_llama los vuelve a ejecutar con la respuesta cacheada.
+
+El índice se persiste con np.savez y se expulsan las entradas usadas hace más
+tiempo (LRU) al llegar al máximo. Con varios workers cada uno guarda en un
+archivo temporal propio y, con el cerrojo {path}.lock, mezcla su índice con
+el del disco antes de sustituirlo: no se pisan las entradas de los demás.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Campos de la respuesta de LLMClient.generate que se guardan
+CACHED_FIELDS = ('content', 'needs_code', 'code', 'language', 'needs_deepseek', 'is_system_command')
+
+
+class _LanguageIndex:
+    """Vectores normalizados y respuestas de un idioma"""
+
+    def __init__(self, dim, capacity=64):
+        self.dim = dim
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.prompts = []
+        self.responses = []
+
+    @property
+    def size(self):
+        return len(self.prompts)
+
+    def search(self, vector):
+        """(índice, similitud) de la entrada más parecida, o (None, 0.0)"""
+        if not self.size:
+            return None, 0.0
+        scores = self.vectors[:self.size] @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def add(self, vector, prompt, response, now):
+        if self.size == len(self.vectors):
+            grown = len(self.vectors) * 2
+            self.vectors = np.resize(self.vectors, (grown, self.dim))
+            self.last_used = np.resize(self.last_used, grown)
+        self.vectors[self.size] = vector
+        self.last_used[self.size] = now
+        self.prompts.append(prompt)
+        self.responses.append(response)
+
+    def remove(self, index):
+        """Elimina una entrada moviendo la última a su lugar"""
+        last = self.size - 1
+        if index != last:
+            self.vectors[index] = self.vectors[last]
+            self.last_used[index] = self.last_used[last]
+            self.prompts[index] = self.prompts[last]
+            self.responses[index] = self.responses[last]
+        self.prompts.pop()
+        self.responses.pop()
+
+
+class SemanticCache:
+    def __init__(self, embed, threshold=0.92, max_entries=2000, path=None, min_chars=10, save_every=50):
+        """
+        Args:
+            embed: Función texto -> lista de floats (p. ej. LLMClient.embed)
+            threshold: Similitud coseno mínima para reutilizar una respuesta
+            max_entries: Entradas máximas por idioma (se expulsa la menos usada)
+            path: Archivo .npz donde se persiste el índice (None = solo memoria)
+            min_chars: Mensajes más cortos no se cachean ("sí", "ok"...
+                dependen del contexto de la conversación)
+            save_every: Inserciones entre guardados del índice
+        """
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.path = path
+        self.min_chars = min_chars
+        self.save_every = save_every
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.stats = {
+            'lookups': 0, 'hits': 0, 'stores': 0, 'evictions': 0, 'errors': 0,
+            'embed_ms': 0.0, 'search_ms': 0.0
+        }
+        if path:
+            self.load()
+            atexit.register(self.save)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _key(language, scope):
+        return f'{language}:{scope}'
+
+    def lookup(self, prompt, language, scope, history=None):
+        """
+        Busca una respuesta cacheada para un mensaje
+
+        Args:
+            scope: Dueño de las entradas (id del usuario)
+            history: Turnos anteriores de la conversación (sin el mensaje
+                actual); si hay alguno el mensaje no se cachea
+
+        Returns:
+            (respuesta o None, vector) — el vector se pasa a store() para no
+            calcular el embedding dos veces; es None si el mensaje no se cachea
+        """
+        if history or len(prompt.strip()) < self.min_chars:
+            return None, None
+        start = time.monotonic()
+        try:
+            vector = self._normalize(self.embed(prompt))
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            logger.warning(f"Caché semántica: no se pudo calcular el embedding: {str(e)}")
+            return None, None
+        embedded = time.monotonic()
+
+        with self._lock:
+            self.stats['lookups'] += 1
+            self.stats['embed_ms'] += (embedded - start) * 1000
+            index = self._indexes.get(self._key(language, scope))
+            if index is None or index.dim != len(vector):
+                self.stats['search_ms'] += (time.monotonic() - embedded) * 1000
+                return None, vector
+            best, score = index.search(vector)
+            self.stats['search_ms'] += (time.monotonic() - embedded) * 1000
+            if best is None or score < self.threshold:
+                return None, vector
+            self.stats['hits'] += 1
+            index.last_used[best] = time.time()
+            logger.info(f"Caché semántica: acierto ({score:.3f}) '{prompt[:40]}' ≈ '{index.prompts[best][:40]}'")
+            return dict(index.responses[best], cached=True), vector
+
+    def store(self, prompt, language, scope, response, vector):
+        """Guarda la respuesta del modelo (antes de ejecutar comandos)"""
+        if vector is None or response.get('failed'):
+            return
+        entry = {field: response.get(field) for field in CACHED_FIELDS}
+        key = self._key(language, scope)
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None or index.dim != len(vector):
+                index = self._indexes[key] = _LanguageIndex(len(vector))
+            best, score = index.search(vector)
+            if best is not None and score >= 0.999:
+                # El mismo mensaje: se actualiza la respuesta
+                index.responses[best] = entry
+                index.last_used[best] = time.time()
+            else:
+                if index.size >= self.max_entries:
+                    index.remove(int(np.argmin(index.last_used[:index.size])))
+                    self.stats['evictions'] += 1
+                index.add(vector, prompt, entry, time.time())
+            self.stats['stores'] += 1
+            self._unsaved += 1
+            should_save = self.path and self._unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def _merge(self, key, other):
+        """Añade las entradas de otro índice (p. ej. el guardado por otro worker) que no estén en este"""
+        index = self._indexes.get(key)
+        if index is None or index.dim != other.dim:
+            self._indexes[key] = index = _LanguageIndex(other.dim)
+        positions = {prompt: i for i, prompt in enumerate(index.prompts)}
+        for i, prompt in enumerate(other.prompts):
+            if prompt in positions:
+                index.last_used[positions[prompt]] = max(index.last_used[positions[prompt]], other.last_used[i])
+            else:
+                index.add(other.vectors[i], prompt, other.responses[i], other.last_used[i])
+        while index.size > self.max_entries:
+            index.remove(int(np.argmin(index.last_used[:index.size])))
+
+    def save(self):
+        """
+        Persiste el índice en self.path
+
+        Con el cerrojo del archivo se mezcla primero con el índice del disco
+        (entradas de otros workers) y se escribe en un temporal propio del
+        proceso que sustituye al archivo de forma atómica.
+        """
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}-{uuid.uuid4().hex}.tmp.npz"
+        try:
+            with open(f"{self.path}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    on_disk = self._read()
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(f"Caché semántica: se sustituye el índice guardado ({str(e)})")
+                    on_disk = {}
+                with self._lock:
+                    for key, index in on_disk.items():
+                        self._merge(key, index)
+                    arrays = {}
+                    for key, index in self._indexes.items():
+                        arrays[f'{key}__vectors'] = index.vectors[:index.size].copy()
+                        arrays[f'{key}__last_used'] = index.last_used[:index.size].copy()
+                        arrays[f'{key}__prompts'] = np.array(json.dumps(index.prompts))
+                        arrays[f'{key}__responses'] = np.array(json.dumps(index.responses))
+                    self._unsaved = 0
+                np.savez(tmp_path, **arrays)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Caché semántica: no se pudo guardar el índice: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read(self):
+        """Índices guardados en self.path ({} si no existe)"""
+        indexes = {}
+        if not os.path.exists(self.path):
+            return indexes
+        with np.load(self.path, allow_pickle=False) as data:
+            # Índices sin usuario ('es__...', versiones anteriores): no se reutilizan
+            keys = {name.split('__')[0] for name in data.files if ':' in name.split('__')[0]}
+            for key in keys:
+                vectors = data[f'{key}__vectors']
+                index = _LanguageIndex(vectors.shape[1], capacity=max(64, len(vectors)))
+                index.vectors[:len(vectors)] = vectors
+                index.last_used[:len(vectors)] = data[f'{key}__last_used']
+                index.prompts = json.loads(str(data[f'{key}__prompts']))
+                index.responses = json.loads(str(data[f'{key}__responses']))
+                indexes[key] = index
+        return indexes
+
+    def load(self):
+        """Carga el índice persistido (si existe)"""
+        if not self.path:
+            return
+        try:
+            self._indexes = self._read()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Caché semántica: índice ignorado ({str(e)})")
+            self._indexes = {}
+            return
+        if self._indexes:
+            logger.info(f"Caché semántica: {sum(i.size for i in self._indexes.values())} entradas cargadas")
+
+    def snapshot(self):
+        """Contadores acumulados (para sumar entre workers)"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = sum(index.size for index in self._indexes.values())
+        return stats
+
+    def report(self, stats=None):
+        """
+        Tasa de aciertos y latencias medias
+
+        Args:
+            stats: Contadores a resumir (por defecto los de este proceso)
+        """
+        stats = dict(stats) if stats is not None else self.snapshot()
+        lookups = stats.get('lookups', 0)
+        embed_ms = stats.pop('embed_ms', 0.0)
+        search_ms = stats.pop('search_ms', 0.0)
+        stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 3) if lookups else None
+        stats['avg_embed_ms'] = round(embed_ms / lookups, 1) if lookups else None
+        stats['avg_search_ms'] = round(search_ms / lookups, 3) if lookups else None
+        stats['threshold'] = self.threshold
+        return stats
@@ -0,0 +1,173 @@
+"""
+Estado compartido entre procesos (workers de gunicorn)
+
+Con varios workers cada proceso tiene su propio LLMClient, pools y escritor,
+así que sus métricas y cachés en memoria solo ven una parte del tráfico.
+SharedState guarda en un archivo SQLite (WAL) aparte:
+
+- Métricas: cada worker publica periódicamente una instantánea de sus
+  contadores; collect() devuelve las de los workers vivos para agregarlas.
+- Caché: pares clave/valor JSON con caducidad, visibles para todos los workers.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SharedState:
+    def __init__(self, db_path, stale_after=30):
+        """
+        Args:
+            db_path: Archivo SQLite compartido por todos los workers
+            stale_after: Segundos tras los que se ignora la instantánea de un
+                worker que ha dejado de publicar (terminado o reiniciado)
+        """
+        self.db_path = db_path
+        self.stale_after = stale_after
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS metrics (
+                scope TEXT NOT NULL,
+                worker INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (scope, worker)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            )
+        ''')
+        conn.commit()
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se reutilizan tras un fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # Métricas
+
+    def publish(self, scope, data):
+        """Guarda la instantánea de métricas de este worker"""
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO metrics (scope, worker, data, updated_at) VALUES (?, ?, ?, ?)',
+            (scope, os.getpid(), json.dumps(data), time.time())
+        )
+        conn.commit()
+
+    def collect(self, scope):
+        """Instantáneas de los workers vivos: {pid: data}"""
+        cursor = self._conn().execute(
+            'SELECT worker, data FROM metrics WHERE scope = ? AND updated_at >= ?',
+            (scope, time.time() - self.stale_after)
+        )
+        return {worker: json.loads(data) for worker, data in cursor}
+
+    def purge_stale(self):
+        """Elimina las instantáneas de workers que ya no publican"""
+        conn = self._conn()
+        conn.execute('DELETE FROM metrics WHERE updated_at < ?', (time.time() - self.stale_after,))
+        conn.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?', (time.time(),))
+        conn.commit()
+
+    # Caché
+
+    def cache_get(self, key, default=None):
+        row = self._conn().execute(
+            'SELECT value, expires_at FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def cache_set(self, key, value, ttl=None):
+        conn = self._conn()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), time.time() + ttl if ttl else None)
+        )
+        conn.commit()
+
+    def cache_add(self, key, value, ttl=None):
+        """Guarda el valor solo si la clave no existe (o caducó); True si se guardó"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('DELETE FROM cache WHERE key = ? AND expires_at IS NOT NULL AND expires_at < ?', (key, now))
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), now + ttl if ttl else None)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+    def cache_delete(self, key):
+        conn = self._conn()
+        conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        conn.commit()
+
+
+def sum_counters(snapshots):
+    """Suma campo a campo los valores numéricos de varias instantáneas"""
+    total = {}
+    for data in snapshots:
+        for key, value in data.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+class MetricsPublisher:
+    """Hilo que publica periódicamente las métricas de este worker"""
+
+    def __init__(self, state, sources, interval=5):
+        """
+        Args:
+            state: SharedState
+            sources: dict {scope: función sin argumentos que devuelve las métricas}
+            interval: Segundos entre publicaciones
+        """
+        self.state = state
+        self.sources = sources
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-publisher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def publish_now(self):
+        for scope, source in self.sources.items():
+            try:
+                self.state.publish(scope, source())
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudieron publicar las métricas '{scope}': {str(e)}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.publish_now()
+            try:
+                self.state.purge_stale()
+            except sqlite3.Error:
+                pass
+            self._stop.wait(self.interval)
@@ -0,0 +1,241 @@
+"""
+Single-flight: una sola generación para peticiones idénticas en curso
+
+Si un usuario envía dos veces el mismo mensaje (doble clic, reintento del
+frontend) mientras la primera generación sigue en marcha, la segunda petición
+no lanza otra: espera a la primera (líder) y recibe el mismo resultado. Solo
+el líder guarda mensajes y consume tokens.
+
+- Dentro de un proceso los seguidores esperan a un threading.Event.
+- Con varios workers, el líder reclama la clave en SharedState y los
+  seguidores de otros procesos consultan el resultado allí.
+- Los resultados se guardan un tiempo (result_ttl) para los reintentos que
+  llegan cuando la generación ya terminó, salvo los que el llamador no quiere
+  repetir (errores, respuestas que crean una conversación nueva). Esos solo
+  se publican unos segundos para los seguidores de otros workers que ya
+  estaban esperando y no se devuelven a peticiones posteriores.
+- La generación usa su propio CancelToken: solo se cancela cuando se han
+  cancelado todas las peticiones que la esperan.
+"""
+import logging
+import os
+import threading
+import time
+
+from cancellation import CancelToken, Cancelled
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    def __init__(self, key):
+        self.key = key
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+        self.token = CancelToken(f'flight:{key[:16]}')
+
+
+class SingleFlight:
+    def __init__(self, shared_state=None, result_ttl=30, max_wait=300, poll_interval=0.2):
+        """
+        Args:
+            shared_state: SharedState para coordinar varios workers (None = solo este proceso)
+            result_ttl: Segundos que se guarda un resultado para reintentos tardíos
+            max_wait: Segundos máximos que un seguidor espera a un líder de otro worker
+            poll_interval: Segundos entre comprobaciones de los seguidores
+        """
+        self.shared_state = shared_state
+        self.result_ttl = result_ttl
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        # Tiempo que se publica un resultado no repetible para los seguidores remotos
+        self.handoff_ttl = max(2, poll_interval * 10)
+        self._flights = {}
+        self._results = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self.stats = {'leaders': 0, 'coalesced': 0, 'replayed': 0, 'remote': 0}
+
+    def replay(self, key):
+        """Resultado guardado de una clave ya terminada, o None"""
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.stats['replayed'] += 1
+                return entry[0]
+        if self.shared_state is not None:
+            state = self._shared_get(key)
+            if state and state.get('state') == 'done' and state.get('replay', True):
+                with self._lock:
+                    self.stats['replayed'] += 1
+                return state['result']
+        return None
+
+    def remember(self, key, result, ttl=None):
+        """Guarda un resultado bajo una clave (p. ej. la de idempotencia del cliente)"""
+        ttl = ttl or self.result_ttl
+        with self._lock:
+            self._results[key] = (result, time.monotonic() + ttl)
+        if self.shared_state is not None:
+            self._shared_set(key, {'state': 'done', 'result': result}, ttl)
+
+    def run(self, key, fn, cancel=None, cacheable=None):
+        """
+        Ejecuta fn(token) una sola vez para todas las peticiones con la misma clave
+
+        Args:
+            key: Clave de la generación
+            fn: Función que recibe el CancelToken de la generación y devuelve
+                un resultado serializable en JSON
+            cancel: CancelToken de esta petición; al cancelarse deja de esperar
+            cacheable: Función que recibe el resultado y dice si se guarda
+                para reintentos tardíos (None = siempre)
+
+        Returns:
+            (resultado, rol) con rol 'leader', 'coalesced', 'replayed' o 'remote'
+
+        Raises:
+            Cancelled si se cancela esta petición (o la generación compartida)
+            La excepción de fn si el líder falla
+        """
+        self._purge()
+        cached = self.replay(key)
+        if cached is not None:
+            return cached, 'replayed'
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(key)
+                self.stats['leaders'] += 1
+            else:
+                self.stats['coalesced'] += 1
+            flight.waiters += 1
+
+        release = cancel.add_closer(lambda: self._detach(flight)) if cancel is not None else None
+        try:
+            if leader:
+                return self._lead(flight, fn, cacheable)
+            return self._follow(flight, cancel), 'coalesced'
+        finally:
+            if release is not None:
+                release()
+
+    def _lead(self, flight, fn, cacheable=None):
+        role = 'leader'
+        try:
+            if self.shared_state is not None and not self._shared_claim(flight.key):
+                # Otro worker ya está generando esta respuesta
+                role = 'remote'
+                with self._lock:
+                    self.stats['leaders'] -= 1
+                    self.stats['remote'] += 1
+                flight.result = self._wait_remote(flight)
+                if flight.result is None:
+                    # El líder remoto desapareció sin resultado: generar aquí
+                    role = 'leader'
+                    flight.result = fn(flight.token)
+            else:
+                flight.result = fn(flight.token)
+            if role == 'leader':
+                if cacheable is None or cacheable(flight.result):
+                    self.remember(flight.key, flight.result)
+                elif self.shared_state is not None:
+                    # Solo para los seguidores remotos que ya esperaban
+                    self._shared_set(
+                        flight.key, {'state': 'done', 'result': flight.result, 'replay': False},
+                        self.handoff_ttl
+                    )
+            return flight.result, role
+        except BaseException as e:
+            flight.error = e
+            if role == 'leader' and self.shared_state is not None:
+                self._shared_delete(flight.key)
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(flight.key, None)
+            flight.done.set()
+
+    def _follow(self, flight, cancel):
+        while not flight.done.wait(self.poll_interval):
+            if cancel is not None:
+                cancel.raise_if_cancelled()
+        if flight.error is not None:
+            if isinstance(flight.error, Cancelled):
+                raise Cancelled(str(flight.error))
+            raise flight.error
+        return flight.result
+
+    def _wait_remote(self, flight):
+        """Espera el resultado publicado por el líder de otro worker"""
+        deadline = time.monotonic() + self.max_wait
+        while time.monotonic() < deadline:
+            flight.token.raise_if_cancelled()
+            state = self._shared_get(flight.key)
+            if state is None:
+                return None
+            if state.get('state') == 'done':
+                return state['result']
+            time.sleep(self.poll_interval)
+        return None
+
+    def _detach(self, flight):
+        """Una petición deja de esperar; si era la última se cancela la generación"""
+        with self._lock:
+            flight.waiters -= 1
+            abandoned = flight.waiters == 0 and not flight.done.is_set()
+        if abandoned:
+            flight.token.cancel('todas las peticiones se cancelaron')
+
+    def _purge(self):
+        now = time.monotonic()
+        if now - self._last_purge < 10:
+            return
+        with self._lock:
+            self._last_purge = now
+            for key in [k for k, (_, expires) in self._results.items() if expires <= now]:
+                del self._results[key]
+
+    # Coordinación entre workers (errores de SharedState: se sigue solo en local)
+
+    def _shared_claim(self, key):
+        running = {'state': 'running', 'worker': os.getpid()}
+        try:
+            if self.shared_state.cache_add(f'singleflight:{key}', running, ttl=self.max_wait):
+                return True
+            state = self.shared_state.cache_get(f'singleflight:{key}')
+            if state and state.get('state') == 'done' and not state.get('replay', True):
+                # Resultado de una generación anterior que no se repite: generar de nuevo
+                self.shared_state.cache_set(f'singleflight:{key}', running, ttl=self.max_wait)
+                return True
+            return False
+        except Exception as e:
+            logger.warning(f"Single-flight: no se pudo reclamar la clave en el estado compartido: {str(e)}")
+            return True
+
+    def _shared_get(self, key):
+        try:
+            return self.shared_state.cache_get(f'singleflight:{key}')
+        except Exception as e:
+            logger.warning(f"Single-flight: error leyendo el estado compartido: {str(e)}")
+            return None
+
+    def _shared_set(self, key, value, ttl):
+        try:
+            self.shared_state.cache_set(f'singleflight:{key}', value, ttl=ttl)
+        except Exception as e:
+            logger.warning(f"Single-flight: error guardando el resultado compartido: {str(e)}")
+
+    def _shared_delete(self, key):
+        try:
+            self.shared_state.cache_delete(f'singleflight:{key}')
+        except Exception:
+            pass
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._flights))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Reparte las conversaciones de un chat.db existente en fragmentos por usuario
+
+Copia las conversaciones y mensajes de cada usuario a SHARD_DIR/user-<id>.db
+(con los mismos ids) y los registra en shard_map. Los resúmenes de las
+conversaciones los recalculan los triggers del fragmento y la marca de agua
+del uso se copia, así que no se vuelve a agregar lo ya agregado.
+
+Ejecutar con la aplicación parada y arrancarla después con STORAGE_MODE=sharded.
+Se puede repetir: los usuarios ya registrados en shard_map se saltan.
+
+Uso:
+    python split_shards.py
+    python split_shards.py --db chat.db --shard-dir shards --drop
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import config
+from database import init_db, init_shard
+from storage import shard_file_name
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Columnas copiadas (el resumen de conversations lo rellenan los triggers)
+CONVERSATION_COLUMNS = 'id, user_id, title, created_at, updated_at'
+MESSAGE_COLUMNS = ('id, conversation_id, role, content, created_at, model, prompt_tokens, eval_tokens, '
+                   'load_ms, prompt_eval_ms, eval_ms, latency_ms, failed')
+
+
+def split_user(db_path, shard_dir, user_id):
+    """
+    Copia las conversaciones de un usuario a su fragmento
+
+    Returns:
+        (conversaciones, mensajes) copiados
+    """
+    name = shard_file_name(user_id)
+    path = os.path.join(shard_dir, name)
+    # Restos de una ejecución interrumpida (el usuario aún no está en shard_map)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    init_shard(path)
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        conn.execute('ATTACH DATABASE ? AS src', (db_path,))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conversations = conn.execute(f'''
+                INSERT INTO main.conversations ({CONVERSATION_COLUMNS})
+                SELECT {CONVERSATION_COLUMNS} FROM src.conversations WHERE user_id = ? ORDER BY id
+            ''', (user_id,)).rowcount
+            messages = conn.execute(f'''
+                INSERT INTO main.messages ({MESSAGE_COLUMNS})
+                SELECT {', '.join(f'm.{column.strip()}' for column in MESSAGE_COLUMNS.split(','))}
+                FROM src.messages m
+                JOIN src.conversations c ON c.id = m.conversation_id
+                WHERE c.user_id = ?
+                ORDER BY m.id
+            ''', (user_id,)).rowcount
+            # Los mensajes ya agregados en la base de datos original no se vuelven a contar
+            conn.execute('''
+                UPDATE main.usage_rollup_state
+                SET last_message_id = (SELECT last_message_id FROM src.usage_rollup_state WHERE id = 1)
+                WHERE id = 1
+            ''')
+            # La versión sigue creciendo para no repetir un ETag ya emitido
+            conn.execute('''
+                UPDATE main.conversation_versions
+                SET version = version + COALESCE((SELECT version FROM src.conversation_versions WHERE user_id = ?), 0)
+                WHERE user_id = ?
+            ''', (user_id, user_id))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('DETACH DATABASE src')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute('INSERT INTO shard_map (user_id, path) VALUES (?, ?)', (user_id, name))
+        conn.commit()
+    finally:
+        conn.close()
+    return conversations, messages
+
+
+def drop_conversation_tables(db_path):
+    """Borra conversations y messages de la base de datos global (ya copiadas)"""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        pending = conn.execute('''
+            SELECT COUNT(DISTINCT user_id) FROM conversations
+            WHERE user_id NOT IN (SELECT user_id FROM shard_map)
+        ''').fetchone()[0]
+        if pending:
+            logger.error(f"{pending} usuarios con conversaciones sin fragmento; no se borra nada")
+            return False
+        for table in ('messages', 'conversations', 'conversation_versions', 'usage_rollup_state'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.commit()
+        logger.info("Tablas de conversaciones borradas de la base de datos global; ejecutando VACUUM...")
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reparte chat.db en fragmentos por usuario")
+    parser.add_argument('--db', default=config.DB_PATH, help="Base de datos original (pasa a ser la global)")
+    parser.add_argument('--shard-dir', default=config.SHARD_DIR, help="Directorio de los fragmentos")
+    parser.add_argument('--drop', action='store_true',
+                        help="Borrar después conversations y messages de la base de datos global")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        logger.error(f"No existe la base de datos {args.db}")
+        sys.exit(1)
+    os.makedirs(args.shard_dir, exist_ok=True)
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        has_conversations = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not has_conversations:
+        logger.info(f"{args.db} no tiene conversaciones que repartir")
+        return
+
+    # Esquema al día (incluidas las migraciones de conversations y messages)
+    init_db(args.db, with_conversations=True)
+
+    conn = sqlite3.connect(args.db, timeout=30)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        user_ids = [row[0] for row in conn.execute('''
+            SELECT DISTINCT user_id FROM conversations
+            WHERE user_id NOT IN (SELECT user_id FROM shard_map)
+            ORDER BY user_id
+        ''')]
+    finally:
+        conn.close()
+
+    logger.info(f"Usuarios a repartir: {len(user_ids)}")
+    start = time.monotonic()
+    total_conversations = total_messages = 0
+    for index, user_id in enumerate(user_ids, 1):
+        conversations, messages = split_user(args.db, args.shard_dir, user_id)
+        total_conversations += conversations
+        total_messages += messages
+        logger.info(f"[{index}/{len(user_ids)}] Usuario {user_id}: {conversations} conversaciones, {messages} mensajes")
+
+    logger.info(
+        f"Copiadas {total_conversations} conversaciones y {total_messages} mensajes "
+        f"en {time.monotonic() - start:.1f}s"
+    )
+    if args.drop and not drop_conversation_tables(args.db):
+        sys.exit(1)
+    logger.info("Arranque la aplicación con STORAGE_MODE=sharded")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,20 +8,22 @@ cd "$(dirname "$0")"
 if [ ! -d "venv" ]; then
     echo "📦 Creando entorno virtual..."
     python3 -m venv venv
+    venv/bin/pip install --upgrade pip --quiet
 fi
 
 # Activar venv
 echo "🔌 Activando entorno virtual..."
 source venv/bin/activate
 
-# Actualizar pip si es necesario
-pip install --upgrade pip --quiet
-
-# Instalar/actualizar dependencias
-echo "📦 Instalando dependencias..."
-pip install -r requirements.txt
+# Instalar dependencias solo si cambió requirements.txt
+REQUIREMENTS_HASH=$(sha256sum requirements.txt | cut -d' ' -f1)
+if [ "$(cat venv/.requirements.sha256 2>/dev/null)" != "$REQUIREMENTS_HASH" ]; then
+    echo "📦 Instalando dependencias..."
+    pip install -r requirements.txt && echo "$REQUIREMENTS_HASH" > venv/.requirements.sha256
+else
+    echo "✅ Dependencias sin cambios"
+fi
 
-# Iniciar aplicación
+# Iniciar aplicación (estado de arranque en /api/ready)
 echo "🚀 Iniciando backend Flask..."
 python app.py
-
@@ -0,0 +1,187 @@
+"""
+Ubicación de las conversaciones y los mensajes de cada usuario
+
+STORAGE_MODE=single: todo está en DB_PATH (comportamiento original).
+
+STORAGE_MODE=sharded: DB_PATH es la base de datos global (usuarios,
+autenticación, shard_map, archivadas y uso agregado) y las conversaciones y
+mensajes de cada usuario están en su propio archivo SHARD_DIR/user-<id>.db.
+Cada archivo tiene su propio cerrojo de escritura, así que los chats de
+usuarios distintos ya no esperan unos a otros.
+
+- shard_map (en la base de datos global) guarda el archivo de cada usuario;
+  el fragmento se crea la primera vez que se necesita.
+- Cada fragmento lleva la versión de su esquema (PRAGMA user_version) y se
+  migra con database.init_shard() al abrirlo por primera vez en el proceso.
+- Las rutas ya resueltas se guardan en una LRU (sin consultar shard_map en
+  cada petición) y los hilos escritores mantienen abiertas las conexiones de
+  los fragmentos más usados (ConnectionCache).
+
+split_shards.py reparte un chat.db existente en fragmentos.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from database import SHARD_SCHEMA_VERSION, connect, init_shard, shard_version
+
+logger = logging.getLogger(__name__)
+
+STORAGE_MODES = ('single', 'sharded')
+
+
+def shard_file_name(user_id):
+    return f'user-{int(user_id)}.db'
+
+
+class Storage:
+    def __init__(self, db_path, mode='single', shard_dir='shards', cache_size=1024):
+        """
+        Args:
+            db_path: Base de datos global
+            mode: 'single' o 'sharded'
+            shard_dir: Directorio de los fragmentos
+            cache_size: Rutas de fragmento resueltas que se recuerdan
+        """
+        if mode not in STORAGE_MODES:
+            raise ValueError(f"STORAGE_MODE desconocido: {mode}")
+        self.db_path = db_path
+        self.mode = mode
+        self.shard_dir = shard_dir
+        self.cache_size = cache_size
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+        if self.sharded:
+            os.makedirs(shard_dir, exist_ok=True)
+
+    @property
+    def sharded(self):
+        return self.mode == 'sharded'
+
+    def path_for(self, user_id):
+        """
+        Base de datos con las conversaciones del usuario (crea y migra su
+        fragmento si hace falta)
+        """
+        if not self.sharded:
+            return self.db_path
+        with self._lock:
+            path = self._paths.get(user_id)
+            if path is not None:
+                self._paths.move_to_end(user_id)
+                return path
+        path = self._resolve(user_id)
+        with self._lock:
+            self._paths[user_id] = path
+            self._paths.move_to_end(user_id)
+            while len(self._paths) > self.cache_size:
+                self._paths.popitem(last=False)
+        return path
+
+    def existing_path(self, user_id):
+        """Como path_for, pero None si el usuario aún no tiene fragmento"""
+        if not self.sharded or user_id in self._paths:
+            return self.path_for(user_id)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            row = conn.execute('SELECT 1 FROM shard_map WHERE user_id = ?', (user_id,)).fetchone()
+        finally:
+            conn.close()
+        return self.path_for(user_id) if row else None
+
+    def connect(self, user_id, timeout=30):
+        """Conexión a la base de datos con las conversaciones del usuario"""
+        return connect(self.path_for(user_id), timeout=timeout)
+
+    def _resolve(self, user_id):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            row = conn.execute('SELECT path FROM shard_map WHERE user_id = ?', (user_id,)).fetchone()
+            if row:
+                path = os.path.join(self.shard_dir, row[0])
+                if shard_version(path) >= SHARD_SCHEMA_VERSION:
+                    return path
+            # Crear o migrar con el cerrojo de escritura de la base de datos
+            # global: otro worker puede estar haciendo lo mismo
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT path FROM shard_map WHERE user_id = ?', (user_id,)).fetchone()
+                name = row[0] if row else shard_file_name(user_id)
+                path = os.path.join(self.shard_dir, name)
+                init_shard(path)
+                if not row:
+                    conn.execute('INSERT INTO shard_map (user_id, path) VALUES (?, ?)', (user_id, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            if not row:
+                logger.info(f"Fragmento creado para el usuario {user_id}: {path}")
+            return path
+        finally:
+            conn.close()
+
+    def shard_paths(self):
+        """(user_id, ruta) de todos los fragmentos (vacío en modo single)"""
+        if not self.sharded:
+            return []
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            rows = conn.execute('SELECT user_id, path FROM shard_map ORDER BY user_id').fetchall()
+        finally:
+            conn.close()
+        return [(user_id, os.path.join(self.shard_dir, name)) for user_id, name in rows]
+
+    def conversation_paths(self):
+        """Bases de datos que contienen conversaciones"""
+        if not self.sharded:
+            return [self.db_path]
+        return [path for _, path in self.shard_paths()]
+
+    def all_paths(self):
+        """Base de datos global y fragmentos (mantenimiento)"""
+        return [self.db_path] + [path for _, path in self.shard_paths()]
+
+    def snapshot(self):
+        return {
+            'mode': self.mode,
+            'shard_dir': self.shard_dir if self.sharded else None,
+            'cached_paths': len(self._paths)
+        }
+
+
+class ConnectionCache:
+    """
+    Conexiones abiertas por ruta, las menos usadas se cierran (LRU)
+
+    No es seguro entre hilos: cada hilo escritor tiene la suya.
+    """
+
+    def __init__(self, max_open=64, timeout=30):
+        self.max_open = max_open
+        self.timeout = timeout
+        self._connections = OrderedDict()
+
+    def get(self, path):
+        conn = self._connections.get(path)
+        if conn is not None:
+            self._connections.move_to_end(path)
+            return conn
+        conn = connect(path, timeout=self.timeout)
+        # WAL: los lectores no bloquean al escritor ni viceversa
+        conn.execute('PRAGMA journal_mode=WAL')
+        self._connections[path] = conn
+        while len(self._connections) > self.max_open:
+            _, oldest = self._connections.popitem(last=False)
+            oldest.close()
+        return conn
+
+    def __len__(self):
+        return len(self._connections)
+
+    def close(self):
+        while self._connections:
+            _, conn = self._connections.popitem()
+            conn.close()
@@ -0,0 +1,264 @@
+"""
+Exportación e importación de conversaciones en NDJSON comprimido con gzip
+
+Formato: una línea JSON por registro, en este orden:
+    {"type": "header", "format": "gp-test-export", "version": 1, ...}
+    {"type": "conversation", "id": 1, "title": ..., "created_at": ..., "updated_at": ...}
+    {"type": "message", "conversation_id": 1, "role": ..., "content": ..., "created_at": ...}
+    ...
+
+Tanto la exportación como la importación trabajan en streaming: la exportación
+recorre la base de datos con cursores y comprime por trozos, y la importación
+descomprime y procesa el cuerpo de la petición línea a línea, insertando por
+lotes. La memoria usada no depende del tamaño del historial.
+"""
+import json
+import logging
+import sqlite3
+import zlib
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT = 'gp-test-export'
+EXPORT_VERSION = 1
+
+# Tamaño de los trozos que se comprimen/leen de una vez
+CHUNK_BYTES = 64 * 1024
+
+# wbits de zlib para el formato gzip (16 + 15)
+GZIP_WBITS = 31
+
+
+class ImportFormatError(ValueError):
+    """El archivo importado no tiene el formato esperado"""
+
+
+def export_records(db_path, user_id, username=None, conversation_ids=None):
+    """
+    Genera los registros de exportación de un usuario
+
+    Los mensajes se leen con un cursor por conversación, sin cargar la
+    conversación completa en memoria.
+
+    Args:
+        conversation_ids: Exportar solo estas conversaciones (None = todas)
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        yield {
+            'type': 'header',
+            'format': EXPORT_FORMAT,
+            'version': EXPORT_VERSION,
+            'exported_at': datetime.utcnow().isoformat() + 'Z',
+            'username': username
+        }
+        params = [user_id]
+        only = ''
+        if conversation_ids is not None:
+            params.extend(conversation_ids)
+            only = f"AND id IN ({', '.join('?' for _ in conversation_ids)})"
+        conversations = conn.execute(f'''
+            SELECT id, title, created_at, updated_at
+            FROM conversations
+            WHERE user_id = ? {only}
+            ORDER BY id
+        ''', params)
+        for conversation_id, title, created_at, updated_at in conversations:
+            yield {
+                'type': 'conversation',
+                'id': conversation_id,
+                'title': title,
+                'created_at': created_at,
+                'updated_at': updated_at
+            }
+            messages = conn.execute('''
+                SELECT role, content, created_at
+                FROM messages
+                WHERE conversation_id = ?
+                ORDER BY id
+            ''', (conversation_id,))
+            for role, content, created_at in messages:
+                yield {
+                    'type': 'message',
+                    'conversation_id': conversation_id,
+                    'role': role,
+                    'content': content,
+                    'created_at': created_at
+                }
+    finally:
+        conn.close()
+
+
+def gzip_ndjson(records, level=6):
+    """Serializa registros como NDJSON y los comprime en trozos gzip"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    buffer = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_BYTES:
+            chunk = compressor.compress(b''.join(buffer))
+            buffer = []
+            size = 0
+            if chunk:
+                yield chunk
+    chunk = compressor.compress(b''.join(buffer)) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def _decompressed_chunks(stream):
+    """Lee un stream (gzip o NDJSON plano) y devuelve los bytes descomprimidos"""
+    first = stream.read(CHUNK_BYTES)
+    if not first.startswith(b'\x1f\x8b'):
+        # NDJSON sin comprimir
+        while first:
+            yield first
+            first = stream.read(CHUNK_BYTES)
+        return
+
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    data = first
+    while data:
+        try:
+            chunk = decompressor.decompress(data)
+        except zlib.error as e:
+            raise ImportFormatError(f"gzip inválido: {e}")
+        if chunk:
+            yield chunk
+        # gzip concatenado (varios miembros): empezar un descompresor nuevo
+        while decompressor.eof and decompressor.unused_data:
+            rest = decompressor.unused_data
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            chunk = decompressor.decompress(rest)
+            if chunk:
+                yield chunk
+        data = stream.read(CHUNK_BYTES)
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def read_ndjson(stream):
+    """Genera los registros de un stream NDJSON (opcionalmente con gzip)"""
+    pending = b''
+    line_number = 0
+    for chunk in _decompressed_chunks(stream):
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield _parse_line(line, line_number)
+    if pending.strip():
+        yield _parse_line(pending, line_number + 1)
+
+
+def _parse_line(line, line_number):
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ImportFormatError(f"Línea {line_number}: JSON inválido ({e})")
+    if not isinstance(record, dict) or 'type' not in record:
+        raise ImportFormatError(f"Línea {line_number}: registro sin tipo")
+    return record
+
+
+def import_records(db_path, user_id, records, batch_rows=1000, keep_ids=False):
+    """
+    Importa registros para un usuario en transacciones por lotes
+
+    Las conversaciones reciben ids nuevos; los mensajes se asocian a la
+    conversación importada mediante el mapa id antiguo -> id nuevo. Con
+    keep_ids=True conservan su id original (restaurar un archivo de
+    maintenance.py: el id no se ha reutilizado gracias a AUTOINCREMENT).
+
+    Returns:
+        dict con conversations, messages y skipped (mensajes sin conversación)
+
+    Raises:
+        ImportFormatError si la cabecera o algún registro no son válidos
+        (con .stats de lo ya importado en lotes anteriores)
+    """
+    stats = {'conversations': 0, 'messages': 0, 'skipped': 0}
+    committed = dict(stats)
+    id_map = {}
+    pending = []
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        cursor = conn.cursor()
+
+        def flush_messages():
+            if pending:
+                cursor.executemany(
+                    'INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)',
+                    pending
+                )
+                stats['messages'] += len(pending)
+                pending.clear()
+
+        rows_in_batch = 0
+        header_seen = False
+        for record in records:
+            kind = record['type']
+            if kind == 'header':
+                if record.get('format') != EXPORT_FORMAT or record.get('version', 0) > EXPORT_VERSION:
+                    raise ImportFormatError(
+                        f"Formato no soportado: {record.get('format')} v{record.get('version')}"
+                    )
+                header_seen = True
+                continue
+            if not header_seen:
+                raise ImportFormatError("Falta la cabecera de exportación")
+
+            if kind == 'conversation':
+                # Las conversaciones se insertan enseguida para conocer su id nuevo
+                flush_messages()
+                cursor.execute(
+                    'INSERT INTO conversations (id, user_id, title, created_at, updated_at) VALUES (?, ?, ?, '
+                    'COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))',
+                    (record.get('id') if keep_ids else None, user_id, record.get('title'),
+                     record.get('created_at'), record.get('updated_at'))
+                )
+                id_map[record.get('id')] = cursor.lastrowid
+                stats['conversations'] += 1
+            elif kind == 'message':
+                conversation_id = id_map.get(record.get('conversation_id'))
+                if conversation_id is None:
+                    stats['skipped'] += 1
+                    continue
+                pending.append((
+                    conversation_id,
+                    record.get('role'),
+                    record.get('content'),
+                    record.get('created_at') or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                ))
+            else:
+                continue
+
+            rows_in_batch += 1
+            if rows_in_batch >= batch_rows:
+                flush_messages()
+                conn.commit()
+                committed = dict(stats)
+                rows_in_batch = 0
+
+        flush_messages()
+        conn.commit()
+    except Exception as e:
+        # Los lotes ya confirmados se mantienen; solo se descarta el lote en curso
+        conn.rollback()
+        e.stats = committed
+        raise
+    finally:
+        conn.close()
+
+    logger.info(
+        f"Importación para usuario {user_id}: {stats['conversations']} conversaciones, "
+        f"{stats['messages']} mensajes, {stats['skipped']} omitidos"
+    )
+    return stats
@@ -0,0 +1,155 @@
+"""
+Perfiles de generación por modelo con auto-ajuste según el hardware
+
+Las opciones de recursos (threads, contexto, batch, límite de tokens y
+keep_alive) salen de config.MODEL_PROFILES. Con AUTO_TUNE activo, los threads
+se derivan de los cores libres según la carga al arrancar (una vez por
+proceso: Ollama recarga el modelo cada vez que cambia num_thread) y el
+contexto máximo de la memoria disponible. num_ctx se dimensiona en cada
+petición según la longitud real del prompt.
+"""
+import math
+import os
+import threading
+import time
+
+import config
+
+# Aproximación de caracteres por token para estimar el tamaño del prompt
+CHARS_PER_TOKEN = 3.5
+
+# Memoria de KV cache por token de un modelo de ~4GB (7B): ~0.5MB en fp16
+KV_BYTES_PER_TOKEN_7B = 512 * 1024
+
+# Fracción de la memoria disponible que puede ocupar el contexto
+CTX_MEMORY_FRACTION = 0.5
+
+# Segundos que se reutiliza la lectura de recursos del host
+_HOST_CACHE_SECONDS = 5
+_host_cache = {'at': 0.0, 'value': None}
+_host_lock = threading.Lock()
+
+# Threads calculados con AUTO_TUNE (fijos durante la vida del proceso)
+_auto_threads = None
+_threads_lock = threading.Lock()
+
+
+def host_resources():
+    """
+    Cores, carga y memoria del host (cacheado unos segundos)
+
+    Returns:
+        dict con cpu_count, load_1m, ram_total_gb y ram_available_gb
+    """
+    with _host_lock:
+        if _host_cache['value'] and time.monotonic() - _host_cache['at'] < _HOST_CACHE_SECONDS:
+            return _host_cache['value']
+        mem_total = mem_available = None
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemTotal:'):
+                        mem_total = int(line.split()[1]) / (1024 * 1024)
+                    elif line.startswith('MemAvailable:'):
+                        mem_available = int(line.split()[1]) / (1024 * 1024)
+        except OSError:
+            pass
+        try:
+            load = os.getloadavg()[0]
+        except (OSError, AttributeError):
+            load = 0.0
+        value = {
+            'cpu_count': os.cpu_count() or 1,
+            'load_1m': load,
+            'ram_total_gb': mem_total,
+            'ram_available_gb': mem_available
+        }
+        _host_cache.update(at=time.monotonic(), value=value)
+        return value
+
+
+def get_profile(model):
+    """Perfil del modelo combinado con el perfil 'default'"""
+    profile = dict(config.MODEL_PROFILES.get('default', {}))
+    profile.update(config.MODEL_PROFILES.get(model, {}))
+    return profile
+
+
+def auto_threads(host):
+    """Threads según los cores que la carga actual deja libres"""
+    cores = host['cpu_count']
+    free = cores - int(round(host['load_1m']))
+    return max(1, min(cores, free))
+
+
+def stable_threads():
+    """
+    auto_threads calculado la primera vez y reutilizado después
+
+    num_thread no puede seguir a la carga: con cada valor nuevo Ollama crea
+    otro runner y recarga el modelo, y un host ocupado no dejaría de recargar.
+    """
+    global _auto_threads
+    with _threads_lock:
+        if _auto_threads is None:
+            _auto_threads = auto_threads(host_resources())
+        return _auto_threads
+
+
+def memory_ctx_limit(model, host):
+    """Contexto máximo que cabe en la memoria disponible"""
+    if not host['ram_available_gb']:
+        return None
+    ram_gb = config.MODEL_CATALOG.get(model, {}).get('ram_gb', 4)
+    kv_per_token = KV_BYTES_PER_TOKEN_7B * ram_gb / 4
+    budget = host['ram_available_gb'] * (1024 ** 3) * CTX_MEMORY_FRACTION
+    return int(budget / kv_per_token)
+
+
+def size_context(prompt_chars, num_predict, minimum, maximum):
+    """
+    num_ctx para un prompt concreto
+
+    Se redondea a potencias de dos para que Ollama no recargue el modelo
+    (lo hace cada vez que cambia num_ctx) con cada petición.
+    """
+    needed = math.ceil(prompt_chars / CHARS_PER_TOKEN) + num_predict
+    ctx = minimum
+    while ctx < needed and ctx * 2 <= maximum:
+        ctx *= 2
+    return ctx
+
+
+def resolve_options(model, base_options, purpose='chat', prompt_chars=0):
+    """
+    Opciones de generación para una petición
+
+    Args:
+        model: Modelo que atenderá la petición
+        base_options: Opciones de muestreo (temperature, top_p...)
+        purpose: 'chat' o 'code' (elige num_predict o code_num_predict)
+        prompt_chars: Longitud total del prompt (sistema + historial + mensaje)
+
+    Returns:
+        (options, keep_alive)
+    """
+    profile = get_profile(model)
+    num_predict = profile['code_num_predict'] if purpose == 'code' else profile['num_predict']
+    num_thread = profile['num_thread']
+    max_ctx = profile['max_ctx']
+
+    if config.AUTO_TUNE:
+        host = host_resources()
+        num_thread = stable_threads()
+        memory_limit = memory_ctx_limit(model, host)
+        if memory_limit:
+            max_ctx = max(profile['num_ctx'], min(max_ctx, memory_limit))
+
+    options = dict(base_options)
+    options.update({
+        'num_predict': num_predict,
+        'num_ctx': size_context(prompt_chars, num_predict, profile['num_ctx'], max_ctx),
+        'num_thread': num_thread,
+        'num_batch': profile['num_batch']
+    })
+    return options, profile.get('keep_alive')
@@ -0,0 +1,318 @@
+"""
+Contabilidad de uso por usuario y modelo
+
+- RequestUsage acumula el consumo de todas las llamadas al modelo de una
+  petición de chat (cascada, DeepSeek...) para guardarlo con la respuesta.
+- UsageRollup agrega periódicamente los mensajes nuevos en usage_hourly
+  (hora, usuario, modelo) a partir de una marca de agua (último id agregado).
+  Las respuestas de generaciones fallidas (messages.failed = 1) se cuentan
+  en errors, no en requests ni en las latencias.
+  Con fragmentos por usuario cada fragmento tiene su marca de agua y los
+  agregados se escriben en la base de datos global.
+- query_usage() lee los agregados para los informes de /api/usage, más los
+  mensajes posteriores a la marca de agua (UsageRollup.pending, solo lectura):
+  la consulta no espera a la siguiente agregación ni escribe en la base de datos.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Agrupaciones permitidas en los informes: columna -> expresión SQL
+GROUPINGS = {
+    'hour': 'u.hour',
+    'day': 'substr(u.hour, 1, 10)',
+    'model': 'u.model',
+    'user': 'u.user_id',
+}
+
+# Agregado por hora, usuario y modelo de los mensajes con id > ? ({where}:
+# condiciones adicionales); columnas en el orden de AGGREGATE_COLUMNS
+AGGREGATE_COLUMNS = ('hour, user_id, model, requests, prompt_tokens, eval_tokens, load_ms, '
+                     'prompt_eval_ms, eval_ms, latency_ms, max_latency_ms, errors')
+AGGREGATE_SELECT = '''
+    SELECT strftime('%Y-%m-%d %H:00:00', m.created_at), c.user_id, COALESCE(m.model, 'desconocido'),
+           COUNT(m.latency_ms), SUM(COALESCE(m.prompt_tokens, 0)), SUM(COALESCE(m.eval_tokens, 0)),
+           SUM(COALESCE(m.load_ms, 0)), SUM(COALESCE(m.prompt_eval_ms, 0)),
+           SUM(COALESCE(m.eval_ms, 0)), COALESCE(SUM(m.latency_ms), 0),
+           COALESCE(MAX(m.latency_ms), 0), COUNT(m.failed)
+    FROM main.messages m
+    JOIN main.conversations c ON c.id = m.conversation_id
+    WHERE m.id > ? AND m.role = 'assistant' AND (m.latency_ms IS NOT NULL OR m.failed = 1){where}
+    GROUP BY 1, 2, 3
+'''
+
+
+class RequestUsage:
+    """Consumo acumulado de las llamadas al modelo de una petición"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.models = []
+        self.prompt_tokens = 0
+        self.eval_tokens = 0
+        self.load_ms = 0.0
+        self.prompt_eval_ms = 0.0
+        self.eval_ms = 0.0
+
+    def add(self, model, usage):
+        if model not in self.models:
+            self.models.append(model)
+        self.prompt_tokens += usage.get('prompt_tokens') or 0
+        self.eval_tokens += usage.get('eval_tokens') or 0
+        self.load_ms += usage.get('load_duration_ms') or 0.0
+        self.prompt_eval_ms += usage.get('prompt_eval_duration_ms') or 0.0
+        self.eval_ms += usage.get('eval_duration_ms') or 0.0
+
+    def as_row(self, fallback_model=None, failed=False):
+        """Campos de uso para MessageWriter.enqueue_message (solo el modelo si la generación falló)"""
+        if failed:
+            return {'model': '+'.join(self.models) or fallback_model, 'failed': 1}
+        return {
+            'model': '+'.join(self.models) or fallback_model,
+            'prompt_tokens': self.prompt_tokens,
+            'eval_tokens': self.eval_tokens,
+            'load_ms': round(self.load_ms, 1),
+            'prompt_eval_ms': round(self.prompt_eval_ms, 1),
+            'eval_ms': round(self.eval_ms, 1),
+            'latency_ms': round((time.monotonic() - self.start) * 1000, 1)
+        }
+
+
+class UsageRollup:
+    def __init__(self, db_path, interval=60, batch_rows=5000, storage=None):
+        """
+        Args:
+            db_path: Base de datos SQLite (usage_hourly)
+            interval: Segundos entre agregaciones
+            batch_rows: Ids de mensaje máximos por transacción
+            storage: storage.Storage con los mensajes fragmentados por usuario
+        """
+        self.db_path = db_path
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self.storage = storage
+        # Firma (mtime de la base de datos y del WAL) de cada fragmento ya agregado
+        self._signatures = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is None and self.interval:
+            self._thread = threading.Thread(target=self._run, name='usage-rollup', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except sqlite3.Error as e:
+                logger.warning(f"Error agregando el uso: {str(e)}")
+
+    def run_once(self):
+        """
+        Agrega los mensajes posteriores a la marca de agua
+
+        Returns:
+            Número de ids de mensaje procesados
+        """
+        processed = 0
+        with self._lock:
+            if self.storage is None or not self.storage.sharded:
+                return self._rollup(self.db_path)
+            for _, path in self.storage.shard_paths():
+                signature = self._signature(path)
+                if signature is not None and self._signatures.get(path) == signature:
+                    continue  # Sin escrituras desde la última agregación
+                processed += self._rollup(path, attach=self.db_path)
+                self._signatures[path] = self._signature(path)
+        return processed
+
+    def pending(self, conn, user_id=None):
+        """
+        Agregados de los mensajes posteriores a la marca de agua, sin escribir
+
+        Args:
+            conn: Conexión de la consulta a la base de datos global (en modo
+                single se lee con ella, en la misma instantánea que usage_hourly)
+            user_id: Solo este usuario (None = todos)
+
+        Returns:
+            Filas con las columnas de AGGREGATE_COLUMNS
+        """
+        where = ' AND c.user_id = ?' if user_id is not None else ''
+        extra = (user_id,) if user_id is not None else ()
+        if self.storage is None or not self.storage.sharded:
+            return self._pending_rows(conn, where, extra)
+        if user_id is not None:
+            path = self.storage.existing_path(user_id)
+            paths = [path] if path else []
+        else:
+            paths = [path for _, path in self.storage.shard_paths()]
+        rows = []
+        for path in paths:
+            signature = self._signature(path)
+            if signature is not None and self._signatures.get(path) == signature:
+                continue  # Sin escrituras desde la última agregación de este proceso
+            shard = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+            try:
+                rows.extend(self._pending_rows(shard, where, extra))
+            finally:
+                shard.close()
+        return rows
+
+    def _pending_rows(self, conn, where, extra):
+        low = conn.execute('SELECT last_message_id FROM main.usage_rollup_state WHERE id = 1').fetchone()[0]
+        return conn.execute(AGGREGATE_SELECT.format(where=where), (low,) + extra).fetchall()
+
+    def _signature(self, path):
+        try:
+            return tuple(os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in (path, f'{path}-wal'))
+        except OSError:
+            return None
+
+    def _rollup(self, path, attach=None):
+        """
+        Agrega los mensajes nuevos de una base de datos
+
+        Args:
+            attach: Base de datos global con usage_hourly (fragmentos)
+        """
+        processed = 0
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        try:
+            target = 'usage_hourly'
+            if attach:
+                conn.execute('ATTACH DATABASE ? AS g', (attach,))
+                target = 'g.usage_hourly'
+            while True:
+                # BEGIN IMMEDIATE: con varios workers solo uno avanza la marca cada vez
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    low = conn.execute('SELECT last_message_id FROM main.usage_rollup_state WHERE id = 1').fetchone()[0]
+                    high = conn.execute(
+                        'SELECT MIN(MAX(id), ?) FROM main.messages WHERE id > ?', (low + self.batch_rows, low)
+                    ).fetchone()[0]
+                    if high is None:
+                        conn.execute('COMMIT')
+                        break
+                    conn.execute(f'''
+                        INSERT INTO {target} ({AGGREGATE_COLUMNS})
+                        {AGGREGATE_SELECT.format(where=' AND m.id <= ?')}
+                        ON CONFLICT (hour, user_id, model) DO UPDATE SET
+                            requests = requests + excluded.requests,
+                            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                            eval_tokens = eval_tokens + excluded.eval_tokens,
+                            load_ms = load_ms + excluded.load_ms,
+                            prompt_eval_ms = prompt_eval_ms + excluded.prompt_eval_ms,
+                            eval_ms = eval_ms + excluded.eval_ms,
+                            latency_ms = latency_ms + excluded.latency_ms,
+                            max_latency_ms = MAX(max_latency_ms, excluded.max_latency_ms),
+                            errors = errors + excluded.errors
+                    ''', (low, high))
+                    conn.execute('UPDATE main.usage_rollup_state SET last_message_id = ? WHERE id = 1', (high,))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                processed += high - low
+                if high < low + self.batch_rows:
+                    break
+        finally:
+            conn.close()
+        return processed
+
+
+def query_usage(db_path, user_id=None, start=None, end=None, group_by=('day', 'model'), rollup=None):
+    """
+    Informe de uso agregado
+
+    Args:
+        user_id: Solo este usuario (None = todos)
+        start, end: Horas 'YYYY-MM-DD HH:00:00' (incluida / excluida)
+        group_by: Columnas de GROUPINGS
+        rollup: UsageRollup cuyos mensajes aún no agregados se suman al informe
+
+    Returns:
+        dict con 'rows' (una por grupo) y 'totals'
+    """
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('u.user_id = ?')
+        params.append(user_id)
+    if start:
+        conditions.append('u.hour >= ?')
+        params.append(start)
+    if end:
+        conditions.append('u.hour < ?')
+        params.append(end)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    keys = [g for g in group_by if g in GROUPINGS]
+    select_keys = ''.join(f"{GROUPINGS[g]} AS {g}, " for g in keys)
+    group = f"GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}" if keys else ''
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        source = 'main.usage_hourly'
+        if rollup is not None:
+            # Misma instantánea para usage_hourly y la marca de agua (modo
+            # single); los pendientes van a una tabla temporal de esta conexión
+            conn.execute('BEGIN')
+            conn.execute('SELECT 1 FROM main.usage_hourly LIMIT 1').fetchall()
+            pending = rollup.pending(conn, user_id)
+            if pending:
+                placeholders = ', '.join('?' * len(pending[0]))
+                conn.execute(f'CREATE TEMP TABLE usage_pending AS SELECT {AGGREGATE_COLUMNS} FROM main.usage_hourly LIMIT 0')
+                conn.executemany(f'INSERT INTO temp.usage_pending VALUES ({placeholders})', pending)
+                source = (f'(SELECT {AGGREGATE_COLUMNS} FROM main.usage_hourly '
+                          f'UNION ALL SELECT {AGGREGATE_COLUMNS} FROM temp.usage_pending)')
+        cursor = conn.execute(f'''
+            SELECT {select_keys}
+                   SUM(u.requests), SUM(u.prompt_tokens), SUM(u.eval_tokens), SUM(u.load_ms),
+                   SUM(u.prompt_eval_ms), SUM(u.eval_ms), SUM(u.latency_ms), MAX(u.max_latency_ms),
+                   SUM(u.errors)
+            FROM {source} u
+            {where}
+            {group}
+        ''', params)
+        rows = []
+        for row in cursor:
+            entry = dict(zip(keys, row[:len(keys)]))
+            entry.update(_summary(*row[len(keys):]))
+            rows.append(entry)
+        if 'user' in keys:
+            usernames = dict(conn.execute('SELECT id, username FROM users'))
+            for entry in rows:
+                entry['username'] = usernames.get(entry['user'])
+    finally:
+        conn.close()
+
+    totals = {}
+    if rows:
+        for key in ('requests', 'errors', 'prompt_tokens', 'eval_tokens'):
+            totals[key] = sum(entry[key] for entry in rows)
+    return {'rows': rows, 'totals': totals}
+
+
+def _summary(requests, prompt_tokens, eval_tokens, load_ms, prompt_eval_ms, eval_ms, latency_ms, max_latency_ms,
+             errors):
+    requests = requests or 0
+    return {
+        'requests': requests,
+        'errors': errors or 0,
+        'prompt_tokens': prompt_tokens or 0,
+        'eval_tokens': eval_tokens or 0,
+        'avg_latency_ms': round(latency_ms / requests, 1) if requests else None,
+        'max_latency_ms': max_latency_ms if requests else None,
+        'avg_load_ms': round(load_ms / requests, 1) if requests else None,
+        'avg_prompt_eval_ms': round(prompt_eval_ms / requests, 1) if requests else None,
+        'avg_eval_ms': round(eval_ms / requests, 1) if requests else None,
+        'tokens_per_s': round(eval_tokens / (eval_ms / 1000), 2) if eval_ms else None
+    }
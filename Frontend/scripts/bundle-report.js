@@ -0,0 +1,94 @@
+#!/usr/bin/env node
+/*
+ * Informe del tamaño de los chunks del build y comprobación del presupuesto
+ *
+ * Lee build/asset-manifest.json (lo genera react-scripts build): los archivos
+ * de "entrypoints" se cargan al abrir la página y el resto son chunks que se
+ * descargan bajo demanda (React.lazy). Los límites, en KB comprimidos con
+ * gzip, están en "bundleBudget" de package.json:
+ *
+ *   initialJs  JS que se descarga al abrir la página
+ *   initialCss CSS que se descarga al abrir la página
+ *   lazyChunk  cada chunk cargado bajo demanda
+ *
+ * Uso:
+ *   npm run build:report   (build + informe)
+ *   npm run size           (solo el informe de un build existente)
+ *
+ * Sale con código 1 si se supera algún límite.
+ */
+const fs = require('fs');
+const path = require('path');
+const zlib = require('zlib');
+
+const root = path.resolve(__dirname, '..');
+const buildDir = path.join(root, 'build');
+const manifestPath = path.join(buildDir, 'asset-manifest.json');
+const budget = require(path.join(root, 'package.json')).bundleBudget || {};
+
+const kb = (bytes) => `${(bytes / 1024).toFixed(1)} KB`;
+
+function sizeOf(file) {
+  const data = fs.readFileSync(path.join(buildDir, file));
+  return { raw: data.length, gzip: zlib.gzipSync(data, { level: 9 }).length };
+}
+
+function main() {
+  if (!fs.existsSync(manifestPath)) {
+    console.error(`No existe ${path.relative(root, manifestPath)}: ejecute antes npm run build`);
+    process.exit(1);
+  }
+  const manifest = JSON.parse(fs.readFileSync(manifestPath, 'utf8'));
+  const initial = new Set(manifest.entrypoints || []);
+  const files = [...new Set(Object.values(manifest.files || {}))]
+    .map((file) => file.replace(/^\//, ''))
+    .filter((file) => /\.(js|css)$/.test(file));
+
+  const chunks = files.map((file) => ({
+    file,
+    type: path.extname(file).slice(1),
+    initial: initial.has(file),
+    ...sizeOf(file)
+  }));
+  chunks.sort((a, b) => (b.initial - a.initial) || (b.gzip - a.gzip));
+
+  const width = Math.max(...chunks.map((chunk) => chunk.file.length), 5);
+  console.log(`${'Chunk'.padEnd(width)}  ${'Carga'.padEnd(12)}  ${'Tamaño'.padStart(10)}  ${'gzip'.padStart(10)}`);
+  for (const chunk of chunks) {
+    console.log(
+      `${chunk.file.padEnd(width)}  ${(chunk.initial ? 'inicial' : 'bajo demanda').padEnd(12)}  ` +
+      `${kb(chunk.raw).padStart(10)}  ${kb(chunk.gzip).padStart(10)}`
+    );
+  }
+
+  const total = (type) => chunks
+    .filter((chunk) => chunk.initial && chunk.type === type)
+    .reduce((sum, chunk) => sum + chunk.gzip, 0);
+  const initialJs = total('js');
+  const initialCss = total('css');
+  console.log(`\nCarga inicial (gzip): JS ${kb(initialJs)}, CSS ${kb(initialCss)}`);
+
+  const errors = [];
+  if (budget.initialJs && initialJs > budget.initialJs * 1024) {
+    errors.push(`JS inicial ${kb(initialJs)} > ${budget.initialJs} KB`);
+  }
+  if (budget.initialCss && initialCss > budget.initialCss * 1024) {
+    errors.push(`CSS inicial ${kb(initialCss)} > ${budget.initialCss} KB`);
+  }
+  if (budget.lazyChunk) {
+    for (const chunk of chunks) {
+      if (!chunk.initial && chunk.gzip > budget.lazyChunk * 1024) {
+        errors.push(`${chunk.file} ${kb(chunk.gzip)} > ${budget.lazyChunk} KB`);
+      }
+    }
+  }
+
+  if (errors.length) {
+    console.error('\nPresupuesto de tamaño superado (gzip):');
+    errors.forEach((error) => console.error(`  - ${error}`));
+    process.exit(1);
+  }
+  console.log('Presupuesto de tamaño: OK');
+}
+
+main();
@@ -1,12 +1,27 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, Suspense } from 'react';
 import './App.css';
-import Sidebar from './components/Sidebar';
-import ChatArea from './components/ChatArea';
-import LoginModal from './components/LoginModal';
-import RegisterModal from './components/RegisterModal';
-import LanguageSelector from './components/LanguageSelector';
+import lazyWithPreload from './lazyWithPreload';
 import { login, register, isAuthenticated, getStoredUser, logout, getCurrentUser, setLanguage } from './services/api';
 
+// Cada pantalla va en su propio chunk: quien ya tiene sesión no descarga los
+// formularios de acceso y quien entra por primera vez no descarga el chat
+const Sidebar = lazyWithPreload(() => import(/* webpackChunkName: "chat" */ './components/Sidebar'));
+const ChatArea = lazyWithPreload(() => import(/* webpackChunkName: "chat" */ './components/ChatArea'));
+const LoginModal = lazyWithPreload(() => import(/* webpackChunkName: "auth" */ './components/LoginModal'));
+const RegisterModal = lazyWithPreload(() => import(/* webpackChunkName: "auth" */ './components/RegisterModal'));
+const LanguageSelector = lazyWithPreload(() => import(/* webpackChunkName: "language" */ './components/LanguageSelector'));
+
+const preloadChat = () => {
+  Sidebar.preload();
+  ChatArea.preload();
+};
+
+const loadingScreen = (
+  <div style={{ display: 'flex', justifyContent: 'center', alignItems: 'center', height: '100vh', color: 'var(--text-primary)' }}>
+    Cargando...
+  </div>
+);
+
 function App() {
   const [user, setUser] = useState(null);
   const [currentConversation, setCurrentConversation] = useState(null);
@@ -19,6 +34,8 @@ function App() {
     // Verificar si hay usuario autenticado
     const checkAuth = async () => {
       if (isAuthenticated()) {
+        // El chunk del chat se descarga en paralelo con la validación del token
+        preloadChat();
         try {
           // Verificar que el token sigue siendo válido
           const userData = await getCurrentUser();
@@ -33,6 +50,7 @@ function App() {
           setShowLogin(true);
         }
       } else {
+        LoginModal.preload();
         setShowLogin(true);
       }
       setLoading(false);
@@ -53,6 +71,7 @@ function App() {
   }, []);
 
   const handleLogin = async (email, password) => {
+    preloadChat();
     const response = await login(email, password);
     setUser(response.user);
     setShowLogin(false);
@@ -64,6 +83,8 @@ function App() {
   };
 
   const handleRegister = async (username, email, password) => {
+    LanguageSelector.preload();
+    preloadChat();
     const response = await register(username, email, password);
     setUser(response.user);
     setShowLogin(false);
@@ -90,50 +111,50 @@ function App() {
   if (loading) {
     return (
       <div className="app">
-        <div style={{ display: 'flex', justifyContent: 'center', alignItems: 'center', height: '100vh', color: 'var(--text-primary)' }}>
-          Cargando...
-        </div>
+        {loadingScreen}
       </div>
     );
   }
 
   return (
     <div className="app">
-      {showLanguageSelector && user ? (
-        <LanguageSelector 
-          onSelectLanguage={handleLanguageSelect}
-          username={user.username}
-        />
-      ) : showLogin && !user ? (
-        <LoginModal 
-          onLogin={handleLogin}
-          onSwitchToRegister={() => {
-            setShowLogin(false);
-            setShowRegister(true);
-          }}
-        />
-      ) : showRegister && !user ? (
-        <RegisterModal 
-          onRegister={handleRegister}
-          onSwitchToLogin={() => {
-            setShowRegister(false);
-            setShowLogin(true);
-          }}
-        />
-      ) : user && !showLanguageSelector ? (
-        <>
-          <Sidebar 
-            currentConversation={currentConversation}
-            onSelectConversation={setCurrentConversation}
-            user={user}
-            onLogout={handleLogout}
-          />
-          <ChatArea 
-            conversationId={currentConversation}
+      <Suspense fallback={loadingScreen}>
+        {showLanguageSelector && user ? (
+          <LanguageSelector 
+            onSelectLanguage={handleLanguageSelect}
             username={user.username}
           />
-        </>
-      ) : null}
+        ) : showLogin && !user ? (
+          <LoginModal 
+            onLogin={handleLogin}
+            onSwitchToRegister={() => {
+              setShowLogin(false);
+              setShowRegister(true);
+            }}
+          />
+        ) : showRegister && !user ? (
+          <RegisterModal 
+            onRegister={handleRegister}
+            onSwitchToLogin={() => {
+              setShowRegister(false);
+              setShowLogin(true);
+            }}
+          />
+        ) : user && !showLanguageSelector ? (
+          <>
+            <Sidebar 
+              currentConversation={currentConversation}
+              onSelectConversation={setCurrentConversation}
+              user={user}
+              onLogout={handleLogout}
+            />
+            <ChatArea 
+              conversationId={currentConversation}
+              username={user.username}
+            />
+          </>
+        ) : null}
+      </Suspense>
     </div>
   );
 }
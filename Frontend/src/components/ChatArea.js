@@ -1,41 +1,58 @@
-import React, { useState, useEffect, useRef } from 'react';
+import React, { useState, useEffect, useRef, lazy, Suspense } from 'react';
 import './ChatArea.css';
 import MessageList from './MessageList';
 import MessageInput from './MessageInput';
-import CodeExecutionModal from './CodeExecutionModal';
 import { getMessages, sendMessage, executeScript } from '../services/api';
 
+// El modal de ejecución solo se descarga cuando hay código que ejecutar
+const CodeExecutionModal = lazy(() => import(/* webpackChunkName: "code-execution" */ './CodeExecutionModal'));
+
+// Mensajes por página al abrir una conversación y al subir en el historial
+const PAGE_SIZE = 50;
+
 function ChatArea({ conversationId, username }) {
   const [messages, setMessages] = useState([]);
+  const [hasMore, setHasMore] = useState(false);
   const [loading, setLoading] = useState(false);
   const [codeToExecute, setCodeToExecute] = useState(null);
-  const messagesEndRef = useRef(null);
+  // Conversación visible: las respuestas de una conversación anterior se descartan
+  const activeConversation = useRef(conversationId);
 
   useEffect(() => {
+    activeConversation.current = conversationId;
+    setMessages([]);
+    setHasMore(false);
     if (conversationId) {
       loadMessages();
-    } else {
-      setMessages([]);
     }
   }, [conversationId]); // eslint-disable-line react-hooks/exhaustive-deps
 
-  useEffect(() => {
-    scrollToBottom();
-  }, [messages]);
-
-  const scrollToBottom = () => {
-    messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
-  };
-
   const loadMessages = async () => {
-    try {
-      const data = await getMessages(conversationId);
+    const requested = conversationId;
+    // Los mensajes guardados se muestran al momento y se sustituyen si el servidor tiene otros
+    const show = (data) => {
+      if (activeConversation.current !== requested) return;
       setMessages(data);
+      setHasMore(data.length === PAGE_SIZE);
+    };
+    try {
+      await getMessages(conversationId, { limit: PAGE_SIZE }, show);
     } catch (error) {
       console.error('Error cargando mensajes:', error);
     }
   };
 
+  const loadOlderMessages = async () => {
+    if (!conversationId || messages.length === 0) return;
+    try {
+      const data = await getMessages(conversationId, { limit: PAGE_SIZE, before: messages[0].id });
+      setMessages(prev => [...data, ...prev]);
+      setHasMore(data.length === PAGE_SIZE);
+    } catch (error) {
+      console.error('Error cargando mensajes anteriores:', error);
+    }
+  };
+
   const handleSendMessage = async (message) => {
     if (!message.trim()) return;
 
@@ -82,7 +99,9 @@ function ChatArea({ conversationId, username }) {
       console.error('Error enviando mensaje:', error);
       let errorText = 'Error al enviar el mensaje';
       
-      if (error.response) {
+      if (error.response?.data?.cancelled) {
+        errorText = 'Generación cancelada';
+      } else if (error.response) {
         // Error del servidor
         errorText = error.response.data?.error || error.response.data?.message || errorText;
       } else if (error.request) {
@@ -141,15 +160,16 @@ function ChatArea({ conversationId, username }) {
           <p>Comienza una nueva conversación escribiendo un mensaje abajo</p>
         </div>
         <MessageList messages={messages} loading={loading} />
-        <div ref={messagesEndRef} />
         <MessageInput onSend={handleSendMessage} disabled={loading} />
         {codeToExecute && (
-          <CodeExecutionModal
-            code={codeToExecute.code}
-            language={codeToExecute.language}
-            onExecute={handleExecuteCode}
-            onCancel={handleCancelExecution}
-          />
+          <Suspense fallback={null}>
+            <CodeExecutionModal
+              code={codeToExecute.code}
+              language={codeToExecute.language}
+              onExecute={handleExecuteCode}
+              onCancel={handleCancelExecution}
+            />
+          </Suspense>
         )}
       </div>
     );
@@ -161,16 +181,23 @@ function ChatArea({ conversationId, username }) {
         <h2>Chat</h2>
         {username && <span className="username">Usuario: {username}</span>}
       </div>
-      <MessageList messages={messages} loading={loading} />
-      <div ref={messagesEndRef} />
+      <MessageList
+        key={conversationId}
+        messages={messages}
+        loading={loading}
+        hasMore={hasMore}
+        onLoadOlder={loadOlderMessages}
+      />
       <MessageInput onSend={handleSendMessage} disabled={loading} />
       {codeToExecute && (
-        <CodeExecutionModal
-          code={codeToExecute.code}
-          language={codeToExecute.language}
-          onExecute={handleExecuteCode}
-          onCancel={handleCancelExecution}
-        />
+        <Suspense fallback={null}>
+          <CodeExecutionModal
+            code={codeToExecute.code}
+            language={codeToExecute.language}
+            onExecute={handleExecuteCode}
+            onCancel={handleCancelExecution}
+          />
+        </Suspense>
       )}
     </div>
   );
@@ -0,0 +1,28 @@
+import React, { useState } from 'react';
+
+// Los bloques más largos se muestran recortados hasta que el usuario los expande
+const MAX_PREVIEW_LINES = 30;
+const MAX_PREVIEW_CHARS = 4000;
+
+function CodeBlock({ language, content }) {
+  const [expanded, setExpanded] = useState(false);
+
+  const lines = content.split('\n');
+  const isLarge = lines.length > MAX_PREVIEW_LINES || content.length > MAX_PREVIEW_CHARS;
+  const visible = expanded || !isLarge
+    ? content
+    : lines.slice(0, MAX_PREVIEW_LINES).join('\n').slice(0, MAX_PREVIEW_CHARS);
+
+  return (
+    <pre className={`code-block${isLarge && !expanded ? ' collapsed' : ''}`}>
+      <code className={`language-${language}`}>{visible}</code>
+      {isLarge && (
+        <button className="code-toggle" onClick={() => setExpanded(!expanded)}>
+          {expanded ? 'Mostrar menos' : `Mostrar todo (${lines.length} líneas)`}
+        </button>
+      )}
+    </pre>
+  );
+}
+
+export default CodeBlock;
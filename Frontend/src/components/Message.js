@@ -1,52 +1,81 @@
-import React from 'react';
+import React, { useMemo, lazy, Suspense } from 'react';
 import './Message.css';
 
-function Message({ message }) {
-  const isUser = message.role === 'user';
-  const isSystem = message.role === 'system';
+// CodeBlock (y lo que crezca alrededor del renderizado de código) va en su
+// propio chunk: muchas respuestas no llevan código y no lo necesitan
+const CodeBlock = lazy(() => import(/* webpackChunkName: "code-block" */ './CodeBlock'));
 
-  // Detectar bloques de código en el contenido
-  const formatContent = (content) => {
-    const codeBlockRegex = /```(\w+)?\n([\s\S]*?)```/g;
-    const parts = [];
-    let lastIndex = 0;
-    let match;
-
-    while ((match = codeBlockRegex.exec(content)) !== null) {
-      // Agregar texto antes del bloque de código
-      if (match.index > lastIndex) {
-        parts.push({
-          type: 'text',
-          content: content.substring(lastIndex, match.index)
-        });
-      }
-
-      // Agregar bloque de código
-      parts.push({
-        type: 'code',
-        language: match[1] || 'text',
-        content: match[2]
-      });
+// Mientras llega el chunk se muestra el código sin formato
+const CodeFallback = ({ language, content }) => (
+  <pre className="code-block">
+    <code className={`language-${language}`}>{content}</code>
+  </pre>
+);
+
+// Hash del contenido (FNV-1a), cacheado por objeto mensaje
+const contentHashes = new WeakMap();
 
-      lastIndex = match.index + match[0].length;
+export const contentHash = (message) => {
+  let hash = contentHashes.get(message);
+  if (hash === undefined) {
+    const content = message.content || '';
+    hash = 0x811c9dc5;
+    for (let i = 0; i < content.length; i++) {
+      hash ^= content.charCodeAt(i);
+      hash = Math.imul(hash, 0x01000193);
     }
+    hash = `${content.length}:${hash >>> 0}`;
+    contentHashes.set(message, hash);
+  }
+  return hash;
+};
 
-    // Agregar texto restante
-    if (lastIndex < content.length) {
+// Detectar bloques de código en el contenido
+const formatContent = (content) => {
+  const codeBlockRegex = /```(\w+)?\n([\s\S]*?)```/g;
+  const parts = [];
+  let lastIndex = 0;
+  let match;
+
+  while ((match = codeBlockRegex.exec(content)) !== null) {
+    // Agregar texto antes del bloque de código
+    if (match.index > lastIndex) {
       parts.push({
         type: 'text',
-        content: content.substring(lastIndex)
+        content: content.substring(lastIndex, match.index)
       });
     }
 
-    if (parts.length === 0) {
-      parts.push({ type: 'text', content });
-    }
+    // Agregar bloque de código
+    parts.push({
+      type: 'code',
+      language: match[1] || 'text',
+      content: match[2]
+    });
 
-    return parts;
-  };
+    lastIndex = match.index + match[0].length;
+  }
+
+  // Agregar texto restante
+  if (lastIndex < content.length) {
+    parts.push({
+      type: 'text',
+      content: content.substring(lastIndex)
+    });
+  }
+
+  if (parts.length === 0) {
+    parts.push({ type: 'text', content });
+  }
+
+  return parts;
+};
+
+function Message({ message }) {
+  const isUser = message.role === 'user';
+  const isSystem = message.role === 'system';
 
-  const formattedContent = formatContent(message.content);
+  const formattedContent = useMemo(() => formatContent(message.content), [message.content]);
 
   return (
     <div className={`message ${isUser ? 'user' : isSystem ? 'system' : 'assistant'}`}>
@@ -54,17 +83,18 @@ function Message({ message }) {
         {formattedContent.map((part, index) => {
           if (part.type === 'code') {
             return (
-              <pre key={index} className="code-block">
-                <code className={`language-${part.language}`}>{part.content}</code>
-              </pre>
+              <Suspense key={index} fallback={<CodeFallback language={part.language} content={part.content} />}>
+                <CodeBlock language={part.language} content={part.content} />
+              </Suspense>
             );
           } else {
+            const lines = part.content.split('\n');
             return (
               <div key={index} className="text-content">
-                {part.content.split('\n').map((line, lineIndex) => (
+                {lines.map((line, lineIndex) => (
                   <React.Fragment key={lineIndex}>
                     {line}
-                    {lineIndex < part.content.split('\n').length - 1 && <br />}
+                    {lineIndex < lines.length - 1 && <br />}
                   </React.Fragment>
                 ))}
               </div>
@@ -76,5 +106,11 @@ function Message({ message }) {
   );
 }
 
-export default Message;
+// Solo se vuelve a renderizar si cambia el id o el contenido del mensaje
+const areEqual = (prev, next) => (
+  prev.message.id === next.message.id &&
+  prev.message.role === next.message.role &&
+  contentHash(prev.message) === contentHash(next.message)
+);
 
+export default React.memo(Message, areEqual);
@@ -1,19 +1,147 @@
-import React from 'react';
+import React, { useState, useRef, useCallback, useLayoutEffect } from 'react';
 import './MessageList.css';
 import Message from './Message';
 
-function MessageList({ messages, loading }) {
+// Altura estimada de un mensaje que todavía no se ha medido
+const ESTIMATED_ROW_HEIGHT = 80;
+// Píxeles que se renderizan por encima y por debajo de la parte visible
+const OVERSCAN_PX = 800;
+// Distancia al borde superior que dispara la carga de mensajes anteriores
+const LOAD_OLDER_THRESHOLD_PX = 200;
+// Distancia al final dentro de la cual se sigue la conversación automáticamente
+const STICK_TO_BOTTOM_PX = 80;
+
+// Fila que informa de su altura real cada vez que cambia
+function MeasuredRow({ id, onResize, children }) {
+  const ref = useRef(null);
+
+  useLayoutEffect(() => {
+    const node = ref.current;
+    onResize(id, node.offsetHeight);
+    if (typeof ResizeObserver === 'undefined') return undefined;
+    const observer = new ResizeObserver(() => onResize(id, node.offsetHeight));
+    observer.observe(node);
+    return () => observer.disconnect();
+  }, [id, onResize]);
+
+  return <div ref={ref} className="message-row">{children}</div>;
+}
+
+// Primer índice cuyo final queda por debajo de `position`
+const findIndex = (offsets, position) => {
+  let low = 0;
+  let high = offsets.length - 2;
+  while (low < high) {
+    const mid = (low + high) >> 1;
+    if (offsets[mid + 1] <= position) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return Math.max(0, low);
+};
+
+function MessageList({ messages, loading, hasMore = false, onLoadOlder }) {
+  const containerRef = useRef(null);
+  const heights = useRef(new Map());
+  const stickToBottom = useRef(true);
+  const anchor = useRef(null);
+  const loadingOlder = useRef(false);
+  const [viewport, setViewport] = useState({ scrollTop: 0, height: 0 });
+  const [, setLayoutVersion] = useState(0);
+
+  const handleResize = useCallback((id, height) => {
+    if (heights.current.get(id) !== height) {
+      heights.current.set(id, height);
+      setLayoutVersion(version => version + 1);
+    }
+  }, []);
+
+  // Posición de cada mensaje a partir de las alturas medidas (o estimadas)
+  const offsets = new Array(messages.length + 1);
+  const indexById = new Map();
+  offsets[0] = 0;
+  messages.forEach((message, index) => {
+    indexById.set(message.id, index);
+    offsets[index + 1] = offsets[index] + (heights.current.get(message.id) ?? ESTIMATED_ROW_HEIGHT);
+  });
+  const totalHeight = offsets[messages.length];
+
+  const start = messages.length ? findIndex(offsets, viewport.scrollTop - OVERSCAN_PX) : 0;
+  const end = messages.length
+    ? findIndex(offsets, viewport.scrollTop + viewport.height + OVERSCAN_PX) + 1
+    : 0;
+
+  const handleScroll = () => {
+    const container = containerRef.current;
+    if (!container) return;
+    const { scrollTop, scrollHeight, clientHeight } = container;
+    stickToBottom.current = scrollHeight - scrollTop - clientHeight < STICK_TO_BOTTOM_PX;
+
+    // Ancla: primer mensaje visible y desplazamiento dentro de él, para que el
+    // contenido no salte cuando se miden o se añaden mensajes por encima
+    if (messages.length) {
+      const index = findIndex(offsets, scrollTop);
+      anchor.current = { id: messages[index].id, delta: scrollTop - offsets[index] };
+    }
+
+    setViewport({ scrollTop, height: clientHeight });
+
+    if (scrollTop < LOAD_OLDER_THRESHOLD_PX && hasMore && onLoadOlder && !loadingOlder.current) {
+      loadingOlder.current = true;
+      stickToBottom.current = false;
+      Promise.resolve(onLoadOlder()).finally(() => {
+        loadingOlder.current = false;
+      });
+    }
+  };
+
+  // Tras cada render: seguir el final o mantener la posición del ancla
+  useLayoutEffect(() => {
+    const container = containerRef.current;
+    if (!container) return;
+    if (stickToBottom.current) {
+      const bottom = container.scrollHeight - container.clientHeight;
+      if (Math.abs(container.scrollTop - bottom) > 1) {
+        container.scrollTop = bottom;
+      }
+    } else if (anchor.current && indexById.has(anchor.current.id)) {
+      const target = offsets[indexById.get(anchor.current.id)] + anchor.current.delta;
+      if (Math.abs(container.scrollTop - target) > 1) {
+        container.scrollTop = target;
+      }
+    }
+  });
+
+  // Altura del área visible
+  useLayoutEffect(() => {
+    const container = containerRef.current;
+    const update = () => setViewport({ scrollTop: container.scrollTop, height: container.clientHeight });
+    update();
+    if (typeof ResizeObserver === 'undefined') return undefined;
+    const observer = new ResizeObserver(update);
+    observer.observe(container);
+    return () => observer.disconnect();
+  }, []);
+
   return (
-    <div className="message-list">
+    <div className="message-list" ref={containerRef} onScroll={handleScroll}>
       {messages.length === 0 && !loading ? (
         <div className="empty-messages">
           <p>No hay mensajes aún</p>
           <p className="hint">Comienza una conversación escribiendo un mensaje</p>
         </div>
       ) : (
-        messages.map(message => (
-          <Message key={message.id} message={message} />
-        ))
+        <>
+          <div style={{ height: offsets[start] }} />
+          {messages.slice(start, end).map(message => (
+            <MeasuredRow key={message.id} id={message.id} onResize={handleResize}>
+              <Message message={message} />
+            </MeasuredRow>
+          ))}
+          <div style={{ height: totalHeight - offsets[end] }} />
+        </>
       )}
       {loading && (
         <div className="loading-message">
@@ -29,4 +157,3 @@ function MessageList({ messages, loading }) {
 }
 
 export default MessageList;
-
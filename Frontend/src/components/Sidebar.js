@@ -1,20 +1,30 @@
 import React, { useState, useEffect } from 'react';
 import './Sidebar.css';
-import { getConversations, createConversation, deleteConversation } from '../services/api';
+import {
+  getConversations,
+  createConversation,
+  deleteConversation,
+  getArchivedConversations,
+  restoreArchivedConversation
+} from '../services/api';
 
 function Sidebar({ currentConversation, onSelectConversation, user, onLogout }) {
   const [conversations, setConversations] = useState([]);
   const [loading, setLoading] = useState(true);
+  const [archived, setArchived] = useState(null);
 
   useEffect(() => {
     loadConversations();
   }, []);
 
   const loadConversations = async () => {
-    try {
-      const data = await getConversations();
+    // La lista guardada se muestra al momento y se actualiza si el servidor tiene otra
+    const show = (data) => {
       setConversations(data);
       setLoading(false);
+    };
+    try {
+      await getConversations(show);
     } catch (error) {
       console.error('Error cargando conversaciones:', error);
       setLoading(false);
@@ -44,6 +54,29 @@ function Sidebar({ currentConversation, onSelectConversation, user, onLogout })
     }
   };
 
+  const toggleArchived = async () => {
+    if (archived) {
+      setArchived(null);
+      return;
+    }
+    try {
+      setArchived(await getArchivedConversations());
+    } catch (error) {
+      console.error('Error cargando conversaciones archivadas:', error);
+    }
+  };
+
+  const handleRestore = async (archiveId) => {
+    try {
+      const restored = await restoreArchivedConversation(archiveId);
+      setArchived(archived.filter(item => item.id !== archiveId));
+      await loadConversations();
+      onSelectConversation(restored.conversation_id);
+    } catch (error) {
+      console.error('Error restaurando conversación:', error);
+    }
+  };
+
   return (
     <div className="sidebar">
       <div className="sidebar-header">
@@ -78,7 +111,15 @@ function Sidebar({ currentConversation, onSelectConversation, user, onLogout })
               className={`conversation-item ${currentConversation === conv.id ? 'active' : ''}`}
               onClick={() => onSelectConversation(conv.id)}
             >
-              <span className="conversation-title">{conv.title || `Conversación ${conv.id}`}</span>
+              <div className="conversation-summary">
+                <span className="conversation-title">{conv.title || `Conversación ${conv.id}`}</span>
+                {conv.last_preview && (
+                  <span className="conversation-preview">{conv.last_preview}</span>
+                )}
+              </div>
+              {conv.message_count > 0 && (
+                <span className="message-count" title="Mensajes">{conv.message_count}</span>
+              )}
               <button
                 className="delete-btn"
                 onClick={(e) => handleDeleteConversation(conv.id, e)}
@@ -90,6 +131,27 @@ function Sidebar({ currentConversation, onSelectConversation, user, onLogout })
           ))
         )}
       </div>
+      <div className="archived-section">
+        <button className="archived-toggle" onClick={toggleArchived}>
+          {archived ? '▾' : '▸'} Archivadas
+        </button>
+        {archived && (archived.length === 0 ? (
+          <div className="hint">No hay conversaciones archivadas</div>
+        ) : (
+          archived.map(item => (
+            <div key={item.id} className="conversation-item archived">
+              <span className="conversation-title">{item.title || `Conversación ${item.conversation_id}`}</span>
+              <button
+                className="restore-btn"
+                onClick={() => handleRestore(item.id)}
+                title={`Restaurar (${item.message_count} mensajes)`}
+              >
+                ↺
+              </button>
+            </div>
+          ))
+        ))}
+      </div>
     </div>
   );
 }
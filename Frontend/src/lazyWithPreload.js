@@ -0,0 +1,22 @@
+import { lazy } from 'react';
+
+// React.lazy con preload(): el chunk se puede empezar a descargar antes de
+// renderizar el componente (por ejemplo mientras se valida el token)
+function lazyWithPreload(factory) {
+  let promise = null;
+  const load = () => {
+    if (!promise) {
+      // Si falla la descarga se puede reintentar en el siguiente render
+      promise = factory().catch((error) => {
+        promise = null;
+        throw error;
+      });
+    }
+    return promise;
+  };
+  const Component = lazy(load);
+  Component.preload = load;
+  return Component;
+}
+
+export default lazyWithPreload;
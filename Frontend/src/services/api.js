@@ -1,4 +1,5 @@
 import axios from 'axios';
+import { readEntry, writeEntry, markStale, clearCache } from './cache';
 
 const API_BASE_URL = process.env.REACT_APP_API_URL || 'http://localhost:5000/api';
 
@@ -47,6 +48,66 @@ api.interceptors.response.use(
   }
 );
 
+// Lectura con caché (stale-while-revalidate): las respuestas se guardan en
+// IndexedDB con su ETag. onData recibe al momento los datos guardados y otra
+// vez los del servidor si han cambiado (si no, el servidor responde 304 sin
+// cuerpo). Las lecturas simultáneas de la misma URL comparten la petición.
+// Durante FRESH_MS tras una validación no se vuelve a preguntar al servidor;
+// las escrituras de este cliente caducan antes las entradas afectadas.
+const FRESH_MS = 15000;
+const inflight = new Map();
+
+// Las claves llevan el id del usuario: nunca se mezclan datos de dos cuentas
+const userPrefix = () => {
+  const user = getStoredUser();
+  return `${user ? user.id : 'anon'}:`;
+};
+
+const cacheKey = (url, params) => {
+  const query = Object.entries(params).filter(([, value]) => value !== undefined && value !== null);
+  return `${userPrefix()}${url}?${new URLSearchParams(query).toString()}`;
+};
+
+const revalidate = (key, url, params, cached) => {
+  if (inflight.has(key)) {
+    return inflight.get(key);
+  }
+  const request = (async () => {
+    const response = await api.get(url, {
+      params,
+      headers: cached && cached.etag ? { 'If-None-Match': cached.etag } : {},
+      validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+    });
+    if (response.status === 304 && cached) {
+      writeEntry(key, { ...cached, validatedAt: Date.now() });
+      return { data: cached.data, changed: false };
+    }
+    writeEntry(key, { etag: response.headers.etag || null, data: response.data, validatedAt: Date.now() });
+    return { data: response.data, changed: true };
+  })().finally(() => inflight.delete(key));
+  inflight.set(key, request);
+  return request;
+};
+
+const getCached = async (url, params = {}, onData) => {
+  const key = cacheKey(url, params);
+  const cached = await readEntry(key);
+  if (cached && onData) {
+    onData(cached.data);
+  }
+  if (cached && Date.now() - cached.validatedAt < FRESH_MS) {
+    return cached.data;
+  }
+  const { data, changed } = await revalidate(key, url, params, cached);
+  if (changed && onData) {
+    onData(data);
+  }
+  return data;
+};
+
+// Caduca las entradas de este usuario cuya URL empieza por path
+const invalidate = (path) => markStale(`${userPrefix()}${path}`);
+
 // Autenticación
 export const register = async (username, email, password) => {
   const response = await api.post('/auth/register', {
@@ -74,6 +135,8 @@ export const login = async (email, password) => {
 };
 
 export const logout = () => {
+  inflight.clear();
+  clearCache();
   localStorage.removeItem('auth_token');
   localStorage.removeItem('user');
 };
@@ -103,42 +166,108 @@ export const setLanguage = async (language) => {
   return response.data;
 };
 
-// Conversaciones
-export const getConversations = async () => {
-  const response = await api.get('/conversations');
+// days: días sin actividad antes de archivar (0 = nunca, null = valor del servidor)
+export const setRetention = async (days) => {
+  const response = await api.post('/auth/retention', { days });
   return response.data;
 };
 
+// Conversaciones
+// onData opcional: recibe primero la lista guardada y después la del servidor
+export const getConversations = async (onData) => {
+  return getCached('/conversations', {}, onData);
+};
+
 export const createConversation = async (title = 'Nueva conversación') => {
   const response = await api.post('/conversations', { title });
+  invalidate('/conversations?');
   return response.data;
 };
 
 export const deleteConversation = async (id) => {
   const response = await api.delete(`/conversations/${id}`);
+  invalidate('/conversations?');
+  invalidate(`/conversations/${id}/`);
   return response.data;
 };
 
-// Mensajes
-export const getMessages = async (conversationId) => {
-  const response = await api.get(`/conversations/${conversationId}/messages`);
+// Conversaciones archivadas por inactividad
+export const getArchivedConversations = async () => {
+  const response = await api.get('/archive');
   return response.data;
 };
 
-export const sendMessage = async (message, conversationId = null) => {
-  const response = await api.post('/chat', {
-    message,
-    conversation_id: conversationId,
-  });
+export const restoreArchivedConversation = async (archiveId) => {
+  const response = await api.post(`/archive/${archiveId}/restore`);
+  invalidate('/conversations?');
   return response.data;
 };
 
+// Mensajes
+// params opcional: { limit, before } para cargar la conversación por páginas
+// onData opcional: como en getConversations
+export const getMessages = async (conversationId, params = {}, onData) => {
+  return getCached(`/conversations/${conversationId}/messages`, params, onData);
+};
+
+// Cancelación: cada chat/ejecución lleva un request_id para que el backend
+// pueda abortar la generación y los procesos si dejamos de esperar
+const pendingRequests = new Set();
+
+const newRequestId = () => (
+  window.crypto && window.crypto.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(16).slice(2)}`
+);
+
+// fetch con keepalive: llega al backend aunque se esté cerrando la página
+export const cancelRequest = (requestId) => fetch(`${API_BASE_URL}/chat/${requestId}/cancel`, {
+  method: 'POST',
+  headers: { Authorization: `Bearer ${getToken()}` },
+  keepalive: true,
+}).catch(() => {});
+
+const postCancellable = async (path, data) => {
+  const requestId = newRequestId();
+  pendingRequests.add(requestId);
+  try {
+    const response = await api.post(path, { ...data, request_id: requestId });
+    return response.data;
+  } catch (error) {
+    // Sin respuesta (timeout de 30 s o red): el backend seguiría trabajando
+    if (!error.response) {
+      cancelRequest(requestId);
+    }
+    throw error;
+  } finally {
+    pendingRequests.delete(requestId);
+  }
+};
+
+window.addEventListener('pagehide', () => {
+  pendingRequests.forEach(cancelRequest);
+});
+
+export const sendMessage = async (message, conversationId = null) => {
+  try {
+    return await postCancellable('/chat', {
+      message,
+      conversation_id: conversationId,
+    });
+  } finally {
+    // El mensaje del usuario se guarda aunque falle la generación
+    invalidate('/conversations?');
+    if (conversationId) {
+      invalidate(`/conversations/${conversationId}/`);
+    }
+  }
+};
+
 // Ejecución de scripts
 export const executeScript = async (script, language) => {
-  const response = await api.post('/execute', {
+  return postCancellable('/execute', {
     script,
     language,
   });
-  return response.data;
 };
 
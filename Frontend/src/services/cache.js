@@ -0,0 +1,128 @@
+// Caché persistente de las respuestas GET (conversaciones y mensajes)
+//
+// Cada entrada guarda los datos, el ETag con el que se pueden revalidar
+// (If-None-Match -> 304) y cuándo se validaron por última vez. Se guarda en
+// IndexedDB para que sobreviva a recargas, con una copia en memoria para no
+// leer de IndexedDB en cada render. Si IndexedDB no está disponible (modo
+// privado de algunos navegadores) funciona solo en memoria.
+
+const DB_NAME = 'gp-test-cache';
+const DB_VERSION = 1;
+const STORE = 'responses';
+// Entradas que se conservan en IndexedDB (las menos usadas se borran)
+const MAX_ENTRIES = 300;
+
+const memory = new Map();
+let dbPromise = null;
+
+const promisify = (request) => new Promise((resolve, reject) => {
+  request.onsuccess = () => resolve(request.result);
+  request.onerror = () => reject(request.error);
+});
+
+const openDb = () => {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve) => {
+      if (typeof indexedDB === 'undefined') {
+        resolve(null);
+        return;
+      }
+      const request = indexedDB.open(DB_NAME, DB_VERSION);
+      request.onupgradeneeded = () => {
+        const store = request.result.createObjectStore(STORE, { keyPath: 'key' });
+        store.createIndex('usedAt', 'usedAt');
+      };
+      request.onsuccess = () => resolve(request.result);
+      // Sin IndexedDB la caché sigue funcionando en memoria
+      request.onerror = () => resolve(null);
+      request.onblocked = () => resolve(null);
+    });
+  }
+  return dbPromise;
+};
+
+const withStore = async (mode, callback) => {
+  const db = await openDb();
+  if (!db) return null;
+  try {
+    const tx = db.transaction(STORE, mode);
+    const done = new Promise((resolve, reject) => {
+      tx.oncomplete = resolve;
+      tx.onerror = () => reject(tx.error);
+      tx.onabort = () => reject(tx.error);
+    });
+    const result = await callback(tx.objectStore(STORE));
+    await done;
+    return result;
+  } catch (error) {
+    console.warn('Caché local no disponible:', error);
+    return null;
+  }
+};
+
+export const readEntry = async (key) => {
+  if (memory.has(key)) {
+    return memory.get(key);
+  }
+  const entry = await withStore('readonly', (store) => promisify(store.get(key)));
+  if (entry) {
+    memory.set(key, entry);
+  }
+  return entry || null;
+};
+
+export const writeEntry = async (key, entry) => {
+  const stored = { ...entry, key, usedAt: Date.now() };
+  memory.set(key, stored);
+  await withStore('readwrite', async (store) => {
+    store.put(stored);
+    const count = await promisify(store.count());
+    if (count > MAX_ENTRIES) {
+      // Borrar las menos usadas
+      let excess = count - MAX_ENTRIES;
+      const cursorRequest = store.index('usedAt').openCursor();
+      await new Promise((resolve, reject) => {
+        cursorRequest.onsuccess = () => {
+          const cursor = cursorRequest.result;
+          if (!cursor || excess <= 0) {
+            resolve();
+            return;
+          }
+          memory.delete(cursor.value.key);
+          cursor.delete();
+          excess -= 1;
+          cursor.continue();
+        };
+        cursorRequest.onerror = () => reject(cursorRequest.error);
+      });
+    }
+  });
+};
+
+// Marca como caducadas las entradas cuya clave empieza por prefix: se siguen
+// mostrando, pero la siguiente lectura las revalida con el servidor
+export const markStale = async (prefix) => {
+  memory.forEach((entry, key) => {
+    if (key.startsWith(prefix)) {
+      memory.set(key, { ...entry, validatedAt: 0 });
+    }
+  });
+  await withStore('readwrite', (store) => new Promise((resolve, reject) => {
+    const cursorRequest = store.openCursor(IDBKeyRange.bound(prefix, `${prefix}\uffff`));
+    cursorRequest.onsuccess = () => {
+      const cursor = cursorRequest.result;
+      if (!cursor) {
+        resolve();
+        return;
+      }
+      cursor.update({ ...cursor.value, validatedAt: 0 });
+      cursor.continue();
+    };
+    cursorRequest.onerror = () => reject(cursorRequest.error);
+  }));
+};
+
+export const clearCache = async () => {
+  memory.clear();
+  await withStore('readwrite', (store) => promisify(store.clear()));
+};
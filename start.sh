@@ -103,24 +103,149 @@ else
     echo "✅ Ollama está instalado ($(ollama --version 2>/dev/null || echo 'versión desconocida'))"
 fi
 
-# Verificar si el servicio Ollama está corriendo
+# Espera a que una URL responda con 2xx (timeout en segundos)
+wait_for_url() {
+    local url=$1
+    local deadline=$((SECONDS + $2))
+    until curl -sf "$url" > /dev/null 2>&1; do
+        if [ $SECONDS -ge $deadline ]; then
+            return 1
+        fi
+        sleep 0.5
+    done
+}
+
+# Hash de los archivos de dependencias (para saltar instalaciones si no cambiaron)
+deps_hash() {
+    cat "$@" 2>/dev/null | sha256sum | cut -d' ' -f1
+}
+
+# Detener todos los servicios al salir
+cleanup() {
+    echo ""
+    echo "🛑 Deteniendo servicios..."
+    if [ ! -z "$BACKEND_PID" ]; then
+        kill $BACKEND_PID 2>/dev/null
+    fi
+    if [ ! -z "$FRONTEND_PID" ]; then
+        kill $FRONTEND_PID 2>/dev/null
+    fi
+    if [ ! -z "$OLLAMA_PID" ]; then
+        kill $OLLAMA_PID 2>/dev/null
+    fi
+    exit
+}
+trap cleanup INT TERM
+
+# Iniciar Ollama en segundo plano (se espera más abajo, en paralelo con el resto)
 if ! curl -s http://localhost:11434/api/tags > /dev/null 2>&1; then
     echo "🚀 Iniciando servicio Ollama..."
     ollama serve > /tmp/ollama.log 2>&1 &
     OLLAMA_PID=$!
-    sleep 3
-    
-    # Verificar que se inició correctamente
-    if ! curl -s http://localhost:11434/api/tags > /dev/null 2>&1; then
-        echo "⚠️  El servicio Ollama no se inició correctamente"
-        echo "   Intenta iniciarlo manualmente: ollama serve"
-        exit 1
-    fi
-    echo "✅ Servicio Ollama iniciado"
 else
     echo "✅ Servicio Ollama ya está corriendo"
 fi
 
+# Verificar Node.js y npm
+echo "🔍 Verificando Node.js y npm..."
+if ! command -v node &> /dev/null; then
+    echo "❌ Node.js no está instalado"
+    echo ""
+    echo "📋 Para instalar Node.js en Kali Linux:"
+    echo "   1. curl -fsSL https://deb.nodesource.com/setup_18.x | sudo -E bash -"
+    echo "   2. sudo apt-get install -y nodejs"
+    echo ""
+    echo "   O usando nvm:"
+    echo "   1. curl -o- https://raw.githubusercontent.com/nvm-sh/nvm/v0.39.0/install.sh | bash"
+    echo "   2. source ~/.bashrc"
+    echo "   3. nvm install 18"
+    echo ""
+    exit 1
+fi
+
+if ! command -v npm &> /dev/null; then
+    echo "❌ npm no está instalado"
+    echo ""
+    echo "📋 npm generalmente viene con Node.js."
+    echo "   Si Node.js está instalado pero npm no, intenta:"
+    echo "   sudo apt-get install npm"
+    echo ""
+    exit 1
+fi
+
+echo "✅ Node.js $(node --version) y npm $(npm --version) detectados"
+echo ""
+
+# Dependencias del backend: solo se instalan si cambió requirements.txt
+setup_backend() {
+    cd Backend
+    if [ ! -d "venv" ]; then
+        echo "📦 Creando entorno virtual..."
+        python3 -m venv venv
+        venv/bin/pip install --upgrade pip --quiet
+    fi
+    local hash=$(deps_hash requirements.txt)
+    if [ "$(cat venv/.requirements.sha256 2>/dev/null)" != "$hash" ]; then
+        echo "📦 Instalando dependencias del backend..."
+        venv/bin/pip install -r requirements.txt --quiet || return 1
+        echo "$hash" > venv/.requirements.sha256
+    else
+        echo "✅ Dependencias del backend sin cambios"
+    fi
+}
+
+# Dependencias del frontend: solo se instalan si cambió package.json/package-lock.json
+setup_frontend() {
+    cd Frontend
+    local hash=$(deps_hash package.json package-lock.json)
+    if [ ! -d "node_modules" ] || [ "$(cat node_modules/.deps.sha256 2>/dev/null)" != "$hash" ]; then
+        echo "📦 Instalando dependencias del frontend..."
+        npm install --no-audit --no-fund || return 1
+        echo "$hash" > node_modules/.deps.sha256
+    else
+        echo "✅ Dependencias del frontend sin cambios"
+    fi
+}
+
+echo "🔧 Configurando backend y frontend en paralelo..."
+(setup_backend) &
+BACKEND_SETUP_PID=$!
+(setup_frontend) &
+FRONTEND_SETUP_PID=$!
+
+if ! wait $BACKEND_SETUP_PID; then
+    echo "❌ Error instalando dependencias del backend"
+    echo "   Intenta ejecutar manualmente: cd Backend && source venv/bin/activate && pip install -r requirements.txt"
+    cleanup
+fi
+if ! wait $FRONTEND_SETUP_PID; then
+    echo "❌ Error instalando dependencias del frontend"
+    echo "   Intenta ejecutar manualmente: cd Frontend && npm install"
+    cleanup
+fi
+
+# Iniciar backend y frontend (el backend informa en /api/ready cuándo está listo)
+echo ""
+echo "🚀 Iniciando backend Flask..."
+cd Backend
+venv/bin/python app.py &
+BACKEND_PID=$!
+cd ..
+
+echo "🚀 Iniciando frontend React..."
+cd Frontend
+npm start &
+FRONTEND_PID=$!
+cd ..
+
+# Esperar a Ollama
+if ! wait_for_url http://localhost:11434/api/tags 60; then
+    echo "⚠️  El servicio Ollama no se inició correctamente"
+    echo "   Intenta iniciarlo manualmente: ollama serve"
+    cleanup
+fi
+echo "✅ Servicio Ollama listo"
+
 # Verificar si los modelos están descargados (SIN restricciones)
 echo ""
 echo "🔍 Verificando modelos (sin restricciones de seguridad)..."
@@ -128,9 +253,6 @@ echo "   Modelos seleccionados:"
 echo "   - Principal: $LLAMA_MODEL (sin restricciones)"
 echo "   - Código: $DEEPSEEK_MODEL (sin restricciones)"
 echo ""
-echo "⏳ IMPORTANTE: Los modelos se descargarán completamente antes de iniciar la aplicación."
-echo "   Esto puede tardar varios minutos dependiendo de tu conexión."
-echo ""
 
 # Función para verificar si un modelo está realmente disponible
 check_model_available() {
@@ -159,13 +281,13 @@ if ! check_model_available "$LLAMA_MODEL"; then
             else
                 echo "❌ Error: Modelo no disponible después de descargar"
                 echo "   Intenta manualmente: ollama pull $LLAMA_MODEL"
-                exit 1
+                cleanup
             fi
         fi
     else
         echo "❌ Error descargando modelo principal: $LLAMA_MODEL"
         echo "   Verifica tu conexión a internet y espacio en disco"
-        exit 1
+        cleanup
     fi
 else
     echo "✅ Modelo principal ya está disponible: $LLAMA_MODEL"
@@ -192,120 +314,24 @@ if ! check_model_available "$DEEPSEEK_MODEL"; then
             else
                 echo "❌ Error: Modelo no disponible después de descargar"
                 echo "   Intenta manualmente: ollama pull $DEEPSEEK_MODEL"
-                exit 1
+                cleanup
             fi
         fi
     else
         echo "❌ Error descargando modelo de código: $DEEPSEEK_MODEL"
         echo "   Verifica tu conexión a internet y espacio en disco"
-        exit 1
+        cleanup
     fi
 else
     echo "✅ Modelo de código ya está disponible: $DEEPSEEK_MODEL"
 fi
 
-echo ""
-echo "✅ Todos los modelos están listos. Continuando con la configuración..."
-echo ""
-
-# Configurar backend
-echo "🔧 Configurando backend Flask..."
-cd Backend
-
-# Verificar si existe venv, si no crearlo
-if [ ! -d "venv" ]; then
-    echo "📦 Creando entorno virtual..."
-    python3 -m venv venv
-fi
-
-# Activar venv
-echo "🔌 Activando entorno virtual..."
-source venv/bin/activate
-
-# Actualizar pip
-echo "⬆️  Actualizando pip..."
-pip install --upgrade pip --quiet
-
-# Instalar/actualizar dependencias del backend
-echo "📦 Instalando dependencias del backend..."
-pip install -r requirements.txt
-
-cd ..
-
-# Verificar Node.js y npm
-echo "🔍 Verificando Node.js y npm..."
-if ! command -v node &> /dev/null; then
-    echo "❌ Node.js no está instalado"
-    echo ""
-    echo "📋 Para instalar Node.js en Kali Linux:"
-    echo "   1. curl -fsSL https://deb.nodesource.com/setup_18.x | sudo -E bash -"
-    echo "   2. sudo apt-get install -y nodejs"
-    echo ""
-    echo "   O usando nvm:"
-    echo "   1. curl -o- https://raw.githubusercontent.com/nvm-sh/nvm/v0.39.0/install.sh | bash"
-    echo "   2. source ~/.bashrc"
-    echo "   3. nvm install 18"
-    echo ""
-    exit 1
-fi
-
-if ! command -v npm &> /dev/null; then
-    echo "❌ npm no está instalado"
-    echo ""
-    echo "📋 npm generalmente viene con Node.js."
-    echo "   Si Node.js está instalado pero npm no, intenta:"
-    echo "   sudo apt-get install npm"
-    echo ""
-    exit 1
-fi
-
-echo "✅ Node.js $(node --version) y npm $(npm --version) detectados"
-echo ""
-
-# Configurar frontend
-echo "🔧 Configurando frontend React..."
-cd Frontend
-
-# Verificar si node_modules existe, si no instalar dependencias
-if [ ! -d "node_modules" ]; then
-    echo "📦 Instalando dependencias del frontend..."
-    npm install
-    if [ $? -ne 0 ]; then
-        echo "❌ Error instalando dependencias del frontend"
-        echo "   Intenta ejecutar manualmente: cd Frontend && npm install"
-        cd ..
-        exit 1
-    fi
-else
-    echo "✅ Dependencias del frontend ya instaladas"
-fi
-
-cd ..
-
-# Iniciar backend con venv activo
-echo ""
-echo "🚀 Iniciando backend Flask..."
-cd Backend
-source venv/bin/activate
-python app.py &
-BACKEND_PID=$!
-cd ..
-
-# Esperar a que el backend esté listo
-echo "⏳ Esperando a que el backend esté listo..."
-sleep 3
-
-# Iniciar frontend
-echo "🚀 Iniciando frontend React..."
-cd Frontend
-if command -v npm &> /dev/null; then
-    npm start &
-    FRONTEND_PID=$!
-else
-    echo "❌ npm no disponible para iniciar el frontend"
-    FRONTEND_PID=""
+# Esperar a que el backend esté listo (BD, Ollama y modelos cargados)
+echo "⏳ Esperando a que el backend esté listo (cargando modelos en memoria)..."
+if ! wait_for_url http://localhost:5000/api/ready 600; then
+    echo "⚠️  El backend no está listo después de 10 minutos"
+    echo "   Revisa el estado en: http://localhost:5000/api/ready"
 fi
-cd ..
 
 echo ""
 echo "✅ Aplicación iniciada!"
@@ -316,17 +342,4 @@ echo ""
 echo "Presiona Ctrl+C para detener todos los servicios"
 
 # Esperar a que el usuario presione Ctrl+C
-cleanup() {
-    echo ""
-    echo "🛑 Deteniendo servicios..."
-    kill $BACKEND_PID 2>/dev/null
-    if [ ! -z "$FRONTEND_PID" ]; then
-        kill $FRONTEND_PID 2>/dev/null
-    fi
-    if [ ! -z "$OLLAMA_PID" ]; then
-        kill $OLLAMA_PID 2>/dev/null
-    fi
-    exit
-}
-trap cleanup INT TERM
 wait